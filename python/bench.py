@@ -0,0 +1,1285 @@
+import sys, argparse, json, os, tempfile, multiprocessing, random, threading, asyncio, tracemalloc
+import datetime as dt
+from datetime import datetime
+from threading import Thread, Lock, Semaphore
+from time import sleep, perf_counter, process_time, time
+import rpyc as rpc
+from rpyc.core import brine
+
+import server, cluster
+from server import SERVER_ADDRESSES, Command, CommandLog, ReorderBuffer, Server, PeerExecutor, QuorumCollector, AsyncFrontEnd, PresenceManager, Chatroom, MessageStore
+from contextlib import redirect_stdout
+
+# Benchmarks for the chat server
+# codec runs on its own, cluster benchmarks expect the servers to already be running, e.g.
+#     python3 bench.py latency -a 172.30.100.102:12000
+# pooling compares pooled connections against a connection per RPC on clusters it starts itself
+# and with "server.py --batch-size 1" to compare against one consensus round per write
+# scaling starts its own clusters on this machine with cluster.py
+
+def get_args(argv):
+    parser = argparse.ArgumentParser(description="chat server benchmarks")
+    subparsers = parser.add_subparsers(required=True, help='available benchmarks')
+
+    parser_latency = subparsers.add_parser('latency', description='Measure commit latency of sequential writes to one server')
+    parser_latency.add_argument('-a', '--address', required=False, default=SERVER_ADDRESSES[1], type=str, help='server to send writes to (address:port)')
+    parser_latency.add_argument('-n', '--count', required=False, default=200, type=int, help='number of messages to send')
+    parser_latency.add_argument('-r', '--room', required=False, default="bench", type=str)
+    parser_latency.set_defaults(func=latency)
+
+    parser_throughput = subparsers.add_parser('throughput', description='Measure write throughput of many concurrent writers')
+    parser_throughput.add_argument('-a', '--address', required=False, default=SERVER_ADDRESSES[1], type=str, help='comma separated servers to send writes to (address:port), writers are spread across them')
+    parser_throughput.add_argument('-t', '--threads', required=False, default=16, type=int, help='number of concurrent writers')
+    parser_throughput.add_argument('-d', '--duration', required=False, default=10, type=float, help='seconds to send writes for')
+    parser_throughput.add_argument('-r', '--room', required=False, default="bench", type=str)
+    parser_throughput.add_argument('-n', '--rooms', required=False, default=1, type=int, help='number of rooms the writers are spread across, rooms are named after --room')
+    parser_throughput.set_defaults(func=throughput)
+
+    parser_visibility = subparsers.add_parser('visibility', description='Measure how long a message written to one server takes to be visible on another')
+    parser_visibility.add_argument('-w', '--writer', required=False, default=SERVER_ADDRESSES[1], type=str, help='server to send writes to (address:port)')
+    parser_visibility.add_argument('-r', '--reader', required=False, default=SERVER_ADDRESSES[2], type=str, help='server to read messages from (address:port)')
+    parser_visibility.add_argument('-n', '--count', required=False, default=100, type=int, help='number of messages to send')
+    parser_visibility.add_argument('--room', required=False, default="bench", type=str)
+    parser_visibility.set_defaults(func=visibility)
+
+    parser_frontend = subparsers.add_parser('frontend', description='Compare request latency and connection capacity of the rpyc server and the asyncio front end')
+    parser_frontend.add_argument('-a', '--address', required=False, default=SERVER_ADDRESSES[1], type=str, help='rpyc address of the server (address:port)')
+    parser_frontend.add_argument('-A', '--async-address', required=True, type=str, help='address of the same server\'s asyncio front end (address:port)')
+    parser_frontend.add_argument('-n', '--count', required=False, default=500, type=int, help='number of sequential requests of each kind')
+    parser_frontend.add_argument('-c', '--connections', required=False, default=1000, type=int, help='number of clients connected at once')
+    parser_frontend.add_argument('-i', '--interval', required=False, default=1, type=float, help='seconds each connected client waits between polls')
+    parser_frontend.add_argument('-d', '--duration', required=False, default=10, type=float, help='seconds the connected clients poll for')
+    parser_frontend.add_argument('-t', '--threads', required=False, default=32, type=int, help='threads polling the rpyc connections, each rpyc call blocks its thread')
+    parser_frontend.add_argument('-r', '--room', required=False, default="bench", type=str)
+    parser_frontend.set_defaults(func=frontend)
+
+    parser_scaling = subparsers.add_parser('scaling', description='Measure write throughput of local clusters of different sizes started with cluster.py')
+    parser_scaling.add_argument('-n', '--servers', required=False, default="3,5,7,9", type=str, help='comma separated cluster sizes')
+    parser_scaling.add_argument('-t', '--threads', required=False, default=16, type=int, help='number of concurrent writers, spread across every server')
+    parser_scaling.add_argument('-d', '--duration', required=False, default=10, type=float, help='seconds to send writes for on each cluster')
+    parser_scaling.add_argument('-r', '--room', required=False, default="bench", type=str)
+    parser_scaling.add_argument('--rooms', required=False, default=1, type=int, help='number of rooms the writers are spread across')
+    parser_scaling.add_argument('-p', '--port', required=False, default=cluster.PORT, type=int, help='port of the first server')
+    parser_scaling.add_argument('--server-args', required=False, default="", type=str, help='options passed to every server, e.g. --server-args="--shards 0"')
+    parser_scaling.set_defaults(func=scaling)
+
+    parser_pooling = subparsers.add_parser('pooling', description='Compare commit latency of a local cluster with pooled connections between servers and with a connection per RPC')
+    parser_pooling.add_argument('-s', '--servers', required=False, default=3, type=int, help='number of servers in the local cluster')
+    parser_pooling.add_argument('-n', '--count', required=False, default=200, type=int, help='number of messages to send')
+    parser_pooling.add_argument('-r', '--room', required=False, default="bench", type=str)
+    parser_pooling.add_argument('-p', '--port', required=False, default=cluster.PORT, type=int, help='port of the first server')
+    parser_pooling.add_argument('--pool-size', required=False, default=server.POOL_SIZE, type=int, help='connections each server keeps open to every other server in the pooled run')
+    parser_pooling.add_argument('--server-args', required=False, default="", type=str, help='options passed to every server in both runs')
+    parser_pooling.set_defaults(func=pooling)
+
+    parser_updates = subparsers.add_parser('updates', description='Compare the server load of idle clients polling for changes, polling with version tags and waiting for them with waitForUpdate')
+    parser_updates.add_argument('-n', '--clients', required=False, default=1000, type=int, help='number of idle clients, spread across every server')
+    parser_updates.add_argument('-s', '--servers', required=False, default=3, type=int, help='number of servers in the local cluster')
+    parser_updates.add_argument('-r', '--rooms', required=False, default=10, type=int, help='number of rooms the clients are spread across')
+    parser_updates.add_argument('-d', '--duration', required=False, default=20, type=float, help='seconds to measure each approach for')
+    parser_updates.add_argument('-i', '--interval', required=False, default=5, type=float, help='seconds between the messages written to every room')
+    parser_updates.add_argument('-w', '--workers', required=False, default=4, type=int, help='processes running the clients, each client has its own thread as in client.py')
+    parser_updates.add_argument('-p', '--port', required=False, default=cluster.PORT, type=int, help='port of the first server')
+    parser_updates.add_argument('--modes', required=False, default="poll,wait", type=str, help='comma separated approaches to run, poll, conditional and wait')
+    parser_updates.set_defaults(func=updates)
+
+    parser_codec = subparsers.add_parser('codec', description='Compare encoding and decoding replicated commands as binary records and as pipe delimited strings')
+    parser_codec.add_argument('-n', '--count', required=False, default=100000, type=int, help='number of commands to encode and decode')
+    parser_codec.set_defaults(func=codec)
+
+    parser_log = subparsers.add_parser('log', description='Compare finding the records a peer is missing with the log index and by scanning the whole log')
+    parser_log.add_argument('-n', '--count', required=False, default=100000, type=int, help='number of commands in the log')
+    parser_log.add_argument('-b', '--behind', required=False, default=100, type=int, help='number of commands the peer is missing from each server')
+    parser_log.set_defaults(func=log)
+
+    parser_recovery = subparsers.add_parser('recovery', description='Compare restart and catch up time from the full log and from a snapshot')
+    parser_recovery.add_argument('-n', '--count', required=False, default=1000000, type=int, help='number of commands in the log')
+    parser_recovery.add_argument('-s', '--suffix', required=False, default=server.SNAPSHOT_INTERVAL, type=int, help='number of commands logged after the snapshot')
+    parser_recovery.add_argument('-r', '--rooms', required=False, default=1000, type=int, help='number of chatrooms the messages are spread across')
+    parser_recovery.set_defaults(func=recovery)
+
+    parser_durability = subparsers.add_parser('durability', description='Compare the cost of logging commands with each durability mode')
+    parser_durability.add_argument('-n', '--count', required=False, default=20000, type=int, help='number of commands to log')
+    parser_durability.add_argument('-t', '--threads', required=False, default=4, type=int, help='number of concurrent writers')
+    parser_durability.add_argument('-b', '--batch', required=False, default=server.BATCH_SIZE, type=int, help='commands per batch')
+    parser_durability.add_argument('-fi', '--fsync-interval', required=False, default=server.FSYNC_INTERVAL, type=int, help='milliseconds between fsyncs in interval mode')
+    parser_durability.set_defaults(func=durability)
+
+    parser_reorder = subparsers.add_parser('reorder', description='Compare applying a shuffled backlog of commands with the reorder buffer and with the previous list of buffered commands')
+    parser_reorder.add_argument('-n', '--count', required=False, default=100000, type=int, help='number of commands in the backlog')
+    parser_reorder.add_argument('-p', '--previous', required=False, default=2000, type=int, help='number of commands in the backlog for the previous approach, which is quadratic')
+    parser_reorder.add_argument('-r', '--rooms', required=False, default=1000, type=int, help='number of chatrooms the messages are spread across')
+    parser_reorder.set_defaults(func=reorder)
+
+    parser_contention = subparsers.add_parser('contention', description='Measure read latency of clients polling many rooms while other rooms are written to and anti-entropy runs')
+    parser_contention.add_argument('-r', '--rooms', required=False, default=100, type=int, help='number of chatrooms')
+    parser_contention.add_argument('-t', '--threads', required=False, default=16, type=int, help='number of polling clients')
+    parser_contention.add_argument('-d', '--duration', required=False, default=5, type=float, help='seconds to poll for')
+    parser_contention.add_argument('-i', '--interval', required=False, default=0.005, type=float, help='seconds each client waits between polls')
+    parser_contention.add_argument('-n', '--count', required=False, default=20000, type=int, help='number of commands in the log sent by anti-entropy')
+    parser_contention.set_defaults(func=contention)
+
+    parser_fanout = subparsers.add_parser('fanout', description='Compare fanning calls out to every server with a thread per call and with the bounded peer executor')
+    parser_fanout.add_argument('-t', '--threads', required=False, default=16, type=int, help='number of concurrent proposers')
+    parser_fanout.add_argument('-d', '--duration', required=False, default=5, type=float, help='seconds to propose for')
+    parser_fanout.add_argument('-l', '--latency', required=False, default=1, type=float, help='milliseconds each simulated call takes')
+    parser_fanout.add_argument('-s', '--slow', required=False, default=500, type=float, help='milliseconds each call to the slow server takes')
+    parser_fanout.add_argument('-w', '--workers', required=False, default=server.PEER_WORKERS, type=int, help='executor threads for each server')
+    parser_fanout.set_defaults(func=fanout)
+
+    parser_presence = subparsers.add_parser('presence', description='Compare timing out inactive clients with a purge thread per room and with the presence timer wheel')
+    parser_presence.add_argument('-r', '--rooms', required=False, default=10000, type=int, help='number of chatrooms, each with one client')
+    parser_presence.add_argument('-d', '--duration', required=False, default=10, type=float, help='seconds to measure the idle cost for')
+    parser_presence.add_argument('-n', '--count', required=False, default=1000000, type=int, help='number of heartbeats to time')
+    parser_presence.add_argument('-t', '--timeout', required=False, default=2, type=float, help='seconds before a client that stops polling times out')
+    parser_presence.set_defaults(func=presence)
+
+    parser_messages = subparsers.add_parser('messages', description='Compare inserting and looking up messages in a room with the message store and with the previous list')
+    parser_messages.add_argument('-n', '--sizes', required=False, default="1000,100000,1000000", type=str, help='comma separated numbers of messages already in the room')
+    parser_messages.add_argument('-k', '--count', required=False, default=200, type=int, help='number of operations of each kind to time')
+    parser_messages.set_defaults(func=messages)
+
+    parser_likes = subparsers.add_parser('likes', description='Compare liking messages and publishing like counts with incremental counts and with the previous list of likes')
+    parser_likes.add_argument('-l', '--likes', required=False, default=1000, type=int, help='number of likes on every message')
+    parser_likes.add_argument('-k', '--count', required=False, default=1000, type=int, help='number of operations of each kind to time')
+    parser_likes.set_defaults(func=likes)
+
+    parser_lookups = subparsers.add_parser('lookups', description='Compare finding rooms, participants and hidden clients with hash indexes and with the previous lists')
+    parser_lookups.add_argument('-r', '--rooms', required=False, default=10000, type=int, help='number of chatrooms')
+    parser_lookups.add_argument('-u', '--users', required=False, default=1000, type=int, help='number of participants in the room that is looked up')
+    parser_lookups.add_argument('-c', '--clients', required=False, default=10000, type=int, help='number of hidden clients of unreachable servers')
+    parser_lookups.add_argument('-k', '--count', required=False, default=10000, type=int, help='number of operations of each kind to time')
+    parser_lookups.set_defaults(func=lookups)
+
+    parser_deltas = subparsers.add_parser('deltas', description='Compare the size and cost of polls returning the newest messages, the same polls with a version tag and polls returning the changes since a cursor')
+    parser_deltas.add_argument('-m', '--messages', required=False, default=1000, type=int, help='number of messages already in the room')
+    parser_deltas.add_argument('-u', '--users', required=False, default=50, type=int, help='number of participants in the room')
+    parser_deltas.add_argument('-w', '--windows', required=False, default="10,100", type=str, help='comma separated numbers of newest messages a poll asks for')
+    parser_deltas.add_argument('-c', '--changes', required=False, default="0,1,10", type=str, help='comma separated numbers of writes between polls, half new messages and half likes')
+    parser_deltas.add_argument('-k', '--count', required=False, default=2000, type=int, help='number of polls to time for each case')
+    parser_deltas.set_defaults(func=deltas)
+
+    parser_history = subparsers.add_parser('history', description='Compare fetching the whole history of a room in one response and in pages')
+    parser_history.add_argument('-n', '--messages', required=False, default=100000, type=int, help='number of messages in the room')
+    parser_history.add_argument('-p', '--page', required=False, default=server.HISTORY_PAGE, type=int, help='messages per page')
+    parser_history.set_defaults(func=history)
+
+    return parser.parse_args(argv)
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def report(name, samples):
+    if len(samples) == 0:
+        print(F"{name}: no samples")
+        return
+    print(F"{name}: n={len(samples)} mean={sum(samples) / len(samples) * 1000:.2f}ms "
+          F"p50={percentile(samples, 50) * 1000:.2f}ms p90={percentile(samples, 90) * 1000:.2f}ms p99={percentile(samples, 99) * 1000:.2f}ms")
+
+def connect(address, name, room):
+    # connects to a server and joins room, waiting for the server to finish starting up
+    host, port = address.split(":", 1)
+    conn = rpc.connect(host, port)
+    while conn.root.exposed_join(name, room, datetime.now()) == -2:
+        sleep(0.5)
+    return conn
+
+def latency(args):
+    conn = connect(args.address, "bench_latency", args.room)
+
+    samples = []
+    failed = 0
+    for i in range(args.count):
+        start = perf_counter()
+        if conn.root.exposed_newMessage("bench_latency", args.room, F"latency {i}", datetime.now()):
+            samples.append(perf_counter() - start)
+        else:
+            failed += 1
+
+    conn.root.exposed_leave("bench_latency", args.room, datetime.now())
+    conn.close()
+    report("commit latency", samples)
+    print(F"failed writes: {failed}")
+
+def throughput(args):
+    addresses = args.address.split(",")
+    resultsLock = Lock()
+    samples = []
+    failures = []
+
+    def writer(i):
+        name = F"bench_writer{i}"
+        room = args.room if args.rooms <= 1 else F"{args.room}{i % args.rooms}"
+        conn = connect(addresses[i % len(addresses)], name, room)
+        end = perf_counter() + args.duration
+        count = 0
+        while perf_counter() < end:
+            start = perf_counter()
+            if conn.root.exposed_newMessage(name, room, F"throughput {count}", datetime.now()):
+                with resultsLock:
+                    samples.append(perf_counter() - start)
+            else:
+                with resultsLock:
+                    failures.append(count)
+            count += 1
+        conn.root.exposed_leave(name, room, datetime.now())
+        conn.close()
+
+    threads = [Thread(target=writer, args=[i]) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(F"throughput: {len(samples) / args.duration:.1f} writes/s with {args.threads} writers")
+    report("commit latency", samples)
+    print(F"failed writes: {len(failures)}")
+    for address in addresses:
+        host, port = address.split(":", 1)
+        conn = rpc.connect(host, port)
+        submitted, workers, rejected, depths, maxDepths = conn.root.exposed_getPeerStats()
+        conn.close()
+        print(F"{address}: {submitted} calls to other servers on {workers} threads, {rejected} rejected, deepest queues {maxDepths}")
+
+def visibility(args):
+    writer = connect(args.writer, "bench_writer", args.room)
+    reader = connect(args.reader, "bench_reader", args.room)
+
+    samples = []
+    for i in range(args.count):
+        message = F"visibility {i}"
+        start = perf_counter()
+        if not writer.root.exposed_newMessage("bench_writer", args.room, message, datetime.now()):
+            continue
+        while perf_counter() - start < 10:
+            latest = reader.root.exposed_getMessages("bench_reader", args.room, 1)
+            if latest and latest[-1][2] == message:
+                samples.append(perf_counter() - start)
+                break
+            sleep(0.001)
+
+    for name, conn in [("bench_writer", writer), ("bench_reader", reader)]:
+        conn.root.exposed_leave(name, args.room, datetime.now())
+        conn.close()
+    report("visible on reader after", samples)
+    print(F"not visible within 10s: {args.count - len(samples)}")
+
+class AsyncClient():
+    # client for the asyncio front end, sends one request at a time
+
+    async def open(self, address):
+        host, port = address.split(":", 1)
+        self.reader, self.writer = await asyncio.open_connection(host, int(port))
+        self.requestId = 0
+        return self
+
+    async def call(self, operation, *args):
+        self.requestId += 1
+        self.writer.write(AsyncFrontEnd.encode([self.requestId, operation, list(args)]))
+        response = await AsyncFrontEnd.read(self.reader)
+        if response == None:
+            raise ConnectionError("connection closed")
+        if len(response) > 2:
+            raise Exception(response[2])
+        return response[1]
+
+    def close(self):
+        self.writer.close()
+
+def frontend(args):
+    # the same operations through both front ends: sequential requests on one connection, then many connected clients polling
+    name = "bench_frontend"
+
+    def capacity(label, polls, opened, failed, openTime):
+        print(F"{label}: {opened} of {args.connections} clients connected in {openTime:.2f}s ({failed} failed), "
+              F"{len(polls) / args.duration:.0f} polls/s of {opened / args.interval:.0f} wanted")
+        report("  poll latency", polls)
+
+    # rpyc
+    conn = connect(args.address, name, args.room)
+    for kind, call in [("getMessages", lambda i: conn.root.exposed_getMessages(name, args.room, 10)),
+                       ("newMessage", lambda i: conn.root.exposed_newMessage(name, args.room, F"frontend {i}", datetime.now()))]:
+        samples = []
+        for i in range(args.count):
+            start = perf_counter()
+            call(i)
+            samples.append(perf_counter() - start)
+        report(F"rpyc {kind}", samples)
+
+    start = perf_counter()
+    clients = []
+    failed = 0
+    host, port = args.address.split(":", 1)
+    for _ in range(args.connections):
+        try:
+            clients.append(rpc.connect(host, port))
+        except Exception:
+            failed += 1
+    openTime = perf_counter() - start
+    polls = []
+    pollsLock = Lock()
+
+    def poller(owned):
+        # polls its share of the clients, each one every interval
+        end = perf_counter() + args.duration
+        due = [perf_counter() + random.random() * args.interval for _ in owned]
+        while perf_counter() < end:
+            i = min(range(len(owned)), key = lambda i: due[i])
+            sleep(max(due[i] - perf_counter(), 0))
+            start = perf_counter()
+            try:
+                owned[i].root.exposed_getMessages(name, args.room, 10)
+            except Exception:
+                continue
+            with pollsLock:
+                polls.append(perf_counter() - start)
+            due[i] = max(due[i] + args.interval, perf_counter())
+
+    threads = [Thread(target=poller, args=[clients[i::args.threads]]) for i in range(min(args.threads, len(clients)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for client in clients:
+        client.close()
+    capacity("rpyc", polls, len(clients), failed, openTime)
+    conn.root.exposed_leave(name, args.room, datetime.now())
+    conn.close()
+
+    # asyncio
+    async def run():
+        client = await AsyncClient().open(args.async_address)
+        while await client.call("join", name, args.room, datetime.now()) == -2:
+            await asyncio.sleep(0.5)
+        for kind, call in [("getMessages", lambda i: client.call("getMessages", name, args.room, 10)),
+                           ("newMessage", lambda i: client.call("newMessage", name, args.room, F"frontend {i}", datetime.now()))]:
+            samples = []
+            for i in range(args.count):
+                start = perf_counter()
+                await call(i)
+                samples.append(perf_counter() - start)
+            report(F"asyncio {kind}", samples)
+
+        start = perf_counter()
+        opened = await asyncio.gather(*[AsyncClient().open(args.async_address) for _ in range(args.connections)], return_exceptions = True)
+        openTime = perf_counter() - start
+        clients = [c for c in opened if type(c) == AsyncClient]
+        polls = []
+
+        async def poller(c):
+            end = perf_counter() + args.duration
+            await asyncio.sleep(random.random() * args.interval)
+            while perf_counter() < end:
+                start = perf_counter()
+                try:
+                    await c.call("getMessages", name, args.room, 10)
+                except Exception:
+                    return
+                polls.append(perf_counter() - start)
+                await asyncio.sleep(max(args.interval - (perf_counter() - start), 0))
+
+        await asyncio.gather(*[poller(c) for c in clients])
+        for c in clients:
+            c.close()
+        capacity("asyncio", polls, len(clients), len(opened) - len(clients), openTime)
+        await client.call("leave", name, args.room, datetime.now())
+        client.close()
+
+    asyncio.run(run())
+
+def scaling(args):
+    for count in [int(count) for count in args.servers.split(",")]:
+        with tempfile.TemporaryDirectory() as directory:
+            processes = cluster.startCluster(count, args.port, directory, args.server_args.split())
+            try:
+                cluster.waitForCluster(count, args.port, processes)
+                print(F"{count} servers:")
+                addresses = ",".join(F"{cluster.HOST}:{args.port + i}" for i in range(count))
+                throughput(argparse.Namespace(address=addresses, threads=args.threads, duration=args.duration, room=args.room, rooms=args.rooms))
+            finally:
+                cluster.stopCluster(processes)
+
+def pooling(args):
+    # the latency benchmark on a fresh cluster with and without pooled connections between the servers
+    for label, poolSize in [("pooled", args.pool_size), ("connection per RPC", 0)]:
+        with tempfile.TemporaryDirectory() as directory:
+            processes = cluster.startCluster(args.servers, args.port, directory, ["--pool-size", str(poolSize)] + args.server_args.split())
+            try:
+                cluster.waitForCluster(args.servers, args.port, processes)
+                print(F"{label} (--pool-size {poolSize}):")
+                latency(argparse.Namespace(address=F"{cluster.HOST}:{args.port}", count=args.count, room=args.room))
+            finally:
+                cluster.stopCluster(processes)
+
+POLL_INTERVAL = 1 / 6 # seconds between polls of a client.py whose room had not changed, before waitForUpdate
+JOINS = 8 # clients of one worker joining at once, so a thousand joins do not all wait on consensus together
+
+def processStats(pid):
+    # (cpu seconds, threads) of a process
+    with open(F"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), int(fields[17])
+
+def updateWorker(mode, clients, ready, joined, start, stop, results):
+    # runs (name, room, address) clients on a thread each, as client.py does, counting their requests to the server
+    # and how long after it was written each client saw the newest message of its room
+    lock = Lock()
+    joining = Semaphore(JOINS)
+    requests = [0]
+    delays = []
+
+    def client(name, room, address):
+        with joining:
+            conn = connect(address, name, room)
+        updates = rpc.connect(*address.split(":", 1)) if mode == "wait" else None
+        ready.put(name)
+        while not joined.wait(1): # polling clients would hold up the joins of the rest, heartbeat until they finish
+            conn.root.exposed_getMessages(name, room, 10)
+        version, seen = None, False # seen is False until the first answer, the room may have no messages
+        tag, messages = "", ()
+        while not stop.is_set():
+            if mode == "wait":
+                update = updates.root.exposed_waitForUpdate(name, room, version, 10, server.UPDATE_TIMEOUT)
+                count = 1
+                if update == None:
+                    sleep(POLL_INTERVAL)
+                    continue
+                version, messages, _ = update
+            elif mode == "conditional":
+                answer = conn.root.exposed_getMessages(name, room, 10, tag)
+                conn.root.exposed_getChatters(room, tag)
+                count = 2
+                if answer == None:
+                    messages = ()
+                elif answer != server.UNCHANGED:
+                    tag, messages = answer
+            else:
+                messages = conn.root.exposed_getMessages(name, room, 10) or ()
+                conn.root.exposed_getChatters(room)
+                count = 2
+            now = time()
+            newest = messages[-1][2] if len(messages) > 0 else None
+            if start.is_set():
+                with lock:
+                    requests[0] += count
+                    if seen is not False and newest not in (seen, None) and newest.startswith("sent "):
+                        delays.append(now - float(newest.split()[1]))
+            seen = newest
+            if mode != "wait":
+                sleep(POLL_INTERVAL)
+
+    threads = [Thread(target=client, args=c, daemon=True) for c in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(server.UPDATE_TIMEOUT + 5)
+    results.put((requests[0], delays))
+
+def updates(args):
+    addresses = [F"{cluster.HOST}:{args.port + i}" for i in range(args.servers)]
+    clients = [(F"bench_idle{i}", F"room{i % args.rooms}", addresses[i % args.servers]) for i in range(args.clients)]
+    for mode in args.modes.split(","):
+        with tempfile.TemporaryDirectory() as directory:
+            processes = cluster.startCluster(args.servers, args.port, directory)
+            try:
+                cluster.waitForCluster(args.servers, args.port, processes)
+                ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+                joined, start, stop = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Event()
+                workers = [multiprocessing.Process(target=updateWorker, args=[mode, clients[i::args.workers], ready, joined, start, stop, results]) for i in range(args.workers)]
+                for w in workers:
+                    w.start()
+                for _ in clients:
+                    ready.get(timeout = 120)
+                rooms = [F"room{i}" for i in range(args.rooms)]
+                writer = connect(addresses[0], "bench_writer", rooms[0])
+                for room in rooms[1:]:
+                    writer.root.exposed_join("bench_writer", room, datetime.now())
+                joined.set()
+                sleep(1)
+
+                before = [processStats(p.pid) for p in processes]
+                start.set()
+                began = perf_counter()
+                end = began + args.duration
+                written, failed = 0, 0
+                while perf_counter() < end:
+                    for room in rooms:
+                        try:
+                            writer.root.exposed_newMessage("bench_writer", room, F"sent {time()}", datetime.now())
+                            written += 1
+                        except TimeoutError: # the servers are too busy answering polls to commit it in time
+                            failed += 1
+                    sleep(min(args.interval, max(end - perf_counter(), 0)))
+                after = [processStats(p.pid) for p in processes]
+                stop.set()
+                elapsed = perf_counter() - began # longer than the duration if a write timed out
+                requests, delays = 0, []
+                for _ in workers:
+                    count, seen = results.get()
+                    requests += count
+                    delays += seen
+                for w in workers:
+                    w.join()
+                writer.close()
+
+                cpu = sum(a[0] - b[0] for a, b in zip(after, before))
+                print(F"{mode}: {args.clients} clients, {requests / elapsed:.0f} requests/s, "
+                      F"server cpu {cpu / elapsed * 100:.1f}% ({cpu / elapsed / args.servers * 100:.1f}% per server), "
+                      F"server threads {[a[1] for a in after]}, {written} messages written, {failed} timed out")
+                report("  message seen after", delays)
+            finally:
+                cluster.stopCluster(processes)
+
+def codec(args):
+    writes = [("newMessage", (F"user{i % 50}", F"room{i % 10}", F"message number {i}", datetime.now()), {"messageid": F"1_{i}"}) for i in range(args.count)]
+
+    # previous format, built with an f-string, split on '|' and rebuilt with eval
+    start = perf_counter()
+    strings = [F"1|{i + 1}|{func}|{wargs}|{json.dumps(kwargs)}" for i, (func, wargs, kwargs) in enumerate(writes)]
+    encodeTime = perf_counter() - start
+    start = perf_counter()
+    for cmd in strings:
+        receivingServer, event_stamp, func, wargs, kwargs = cmd.split("|")
+        wargs = eval(wargs, {"datetime": dt})
+        kwargs = json.loads(kwargs)
+    decodeTime = perf_counter() - start
+    print(F"string: encode {encodeTime / args.count * 1e6:.2f}us decode {decodeTime / args.count * 1e6:.2f}us "
+          F"size {sum(len(cmd) for cmd in strings) / args.count:.1f} bytes")
+
+    start = perf_counter()
+    records = [Command(1, i + 1, func, wargs, kwargs).record for i, (func, wargs, kwargs) in enumerate(writes)]
+    encodeTime = perf_counter() - start
+    start = perf_counter()
+    for record in records:
+        Command.decode(record)
+    decodeTime = perf_counter() - start
+    print(F"binary: encode {encodeTime / args.count * 1e6:.2f}us decode {decodeTime / args.count * 1e6:.2f}us "
+          F"size {sum(len(record) for record in records) / args.count:.1f} bytes")
+
+    # a message containing the delimiter cannot be split back into its fields
+    piped = ("u", "r", "a | b", datetime.now())
+    fields = F"1|1|newMessage|{piped}|{{}}".split("|")
+    print(F"string: message containing '|' splits into {len(fields)} fields instead of 5")
+    print(F"binary: message containing '|' decodes to {Command.decode(Command(1, 1, 'newMessage', piped, {}).record).args[2]!r}")
+
+def log(args):
+    with tempfile.TemporaryDirectory() as directory:
+        commandLog = CommandLog(os.path.join(directory, "bench_log"))
+        servers = len(SERVER_ADDRESSES.keys())
+        vector = [0 for _ in range(servers)]
+        start = perf_counter()
+        for i in range(args.count):
+            origin = i % servers
+            vector[origin] += 1
+            commandLog.append(Command(origin, vector[origin], "newMessage", (F"user{i % 50}", "bench", F"message number {i}", datetime.now()), {"messageid": F"{origin}_{i}"}).record)
+        print(F"append: {(perf_counter() - start) / args.count * 1e6:.2f}us per command")
+
+        start = perf_counter()
+        CommandLog(os.path.join(directory, "bench_log"))
+        print(F"load index of {args.count} commands: {(perf_counter() - start) * 1000:.2f}ms")
+
+        def scan(otherVector):
+            # previous approach, read and filter every record in the log
+            return [record for record in commandLog.records() if otherVector[Command.peek(record)[0]] < Command.peek(record)[1]]
+
+        cases = [("up to date", vector),
+                 (F"{args.behind} behind", [max(stamp - args.behind, 0) for stamp in vector]),
+                 (F"{args.behind * 100} behind", [max(stamp - args.behind * 100, 0) for stamp in vector])]
+        for name, otherVector in cases:
+            start = perf_counter()
+            records = scan(otherVector)
+            scanTime = perf_counter() - start
+            start = perf_counter()
+            assert commandLog.since(otherVector) == records
+            indexTime = perf_counter() - start
+            print(F"{name} ({len(records)} records): scan {scanTime * 1000:.2f}ms index {indexTime * 1000:.2f}ms")
+
+def offlineServer(index, directory):
+    # a Server with only the state needed to apply commands, it does not connect to other servers or start any threads
+    os.makedirs(directory, exist_ok=True)
+    srv = Server.__new__(Server)
+    srv.index = index
+    srv.chatrooms = {}
+    srv.reorder = ReorderBuffer()
+    srv.vector_stamp = [0 for _ in SERVER_ADDRESSES.keys()]
+    srv.digests = [0 for _ in SERVER_ADDRESSES.keys()]
+    srv.stampLock = Lock()
+    srv.clients_on_other_servers = [[] for _ in SERVER_ADDRESSES.keys()]
+    srv.hidden_clients = [set() for _ in SERVER_ADDRESSES.keys()]
+    srv.my_clients = []
+    srv.presence = PresenceManager(lambda clients: None, timeout = 0)
+    srv.shards = len(SERVER_ADDRESSES.keys())
+    srv.shardCounts = [0 for _ in range(srv.shards)]
+    srv.pendingProposals = [{} for _ in range(srv.shards)]
+    srv.log = CommandLog(os.path.join(directory, F"server{index}_log"))
+    srv.snapshotPath = os.path.join(directory, F"server{index}_snapshot.pickle")
+    srv.snapshotVector = [0 for _ in SERVER_ADDRESSES.keys()]
+    srv.snapshotLock = Lock()
+    return srv
+
+def recovery(args):
+    server.LOCK = Lock()
+    servers = len(SERVER_ADDRESSES.keys())
+    vector = [0 for _ in range(servers)]
+    lastMessage = {}
+
+    def command(i):
+        # a user joins each room from its own server, then sends messages and likes
+        # server 0 does not send any so that the benchmark servers (all server 0) never share commands
+        room = i % args.rooms
+        origin = room % (servers - 1) + 1
+        vector[origin] += 1
+        if i < args.rooms:
+            return Command(origin, vector[origin], "join", (F"user{room}", F"room{room}", datetime.now()), {})
+        elif i % 10 == 0 and room in lastMessage:
+            return Command(origin, vector[origin], "likeMessage", (F"user{room}", F"room{room}", lastMessage[room], datetime.now()), {})
+        lastMessage[room] = F"{room}_{i}"
+        return Command(origin, vector[origin], "newMessage", (F"user{room}", F"room{room}", F"message number {i}", datetime.now()), {"messageid": F"{room}_{i}"})
+
+    def timed(step, *stepArgs):
+        # runs step in a forked process and returns (seconds taken, result of step)
+        # the fork starts from a clean process, without the garbage and threads left by earlier steps
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+
+        def run():
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                start = perf_counter()
+                result = step(*stepArgs)
+                results.put((perf_counter() - start, result))
+
+        process = context.Process(target=run)
+        process.start()
+        result = results.get()
+        process.join()
+        return result
+
+    def restart():
+        offlineServer(0, "restart").restoreState()
+
+    def snapshot():
+        srv = offlineServer(0, "restart")
+        srv.restoreState()
+        srv.takeSnapshot()
+        return srv.snapshotVector
+
+    def catchUp(directory, snapshot, records):
+        srv = offlineServer(0, directory)
+        if snapshot:
+            srv.installSnapshot(snapshot)
+        for record in records:
+            srv.processCmd(record)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            os.makedirs("restart")
+            commandLog = CommandLog(os.path.join("restart", "server0_log"))
+            for i in range(args.count):
+                commandLog.append(command(i).record)
+            print(F"log of {args.count} commands: {commandLog.size / 1e6:.1f}MB")
+
+            elapsed, _ = timed(restart)
+            print(F"restart from log: {elapsed:.2f}s")
+
+            _, snapshotVector = timed(snapshot)
+            commandLog = CommandLog(os.path.join("restart", "server0_log"))
+            for i in range(args.count, args.count + args.suffix):
+                commandLog.append(command(i).record)
+
+            elapsed, _ = timed(restart)
+            print(F"restart from snapshot and {args.suffix} logged commands: {elapsed:.2f}s")
+
+            # catch up a new server, through every logged command and through the snapshot
+            records = [record for record in commandLog.records()]
+            elapsed, _ = timed(catchUp, "log", None, records)
+            print(F"catch up from log: {elapsed:.2f}s, {sum(len(record) for record in records) / 1e6:.1f}MB sent")
+
+            with open(os.path.join("restart", "server0_snapshot.pickle"), 'rb') as f:
+                state = f.read()
+            records = commandLog.since(snapshotVector)
+            elapsed, _ = timed(catchUp, "snapshot", state, records)
+            print(F"catch up from snapshot: {elapsed:.2f}s, {(len(state) + sum(len(record) for record in records)) / 1e6:.1f}MB sent")
+        finally:
+            os.chdir(cwd)
+
+def durability(args):
+    records = [Command(0, i + 1, "newMessage", (F"user{i % 50}", "bench", F"message number {i}", datetime.now()), {"messageid": F"0_{i}"}).record for i in range(args.count)]
+    batches = [records[i:i + args.batch] for i in range(0, len(records), args.batch)]
+
+    def run(name, write):
+        # each writer logs every args.threads batch, as concurrent rounds would
+        threads = [Thread(target=lambda i: [write(batch) for batch in batches[i::args.threads]], args=[i]) for i in range(args.threads)]
+        start = perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = perf_counter() - start
+        print(F"{name}: {args.count / elapsed:.0f} commands/s, {elapsed / args.count * 1e6:.1f}us per command")
+
+    with tempfile.TemporaryDirectory() as directory:
+        fileLock = Lock()
+
+        def openPerCommand(batch):
+            # previous approach, opening the log for every command without fsyncing
+            with fileLock:
+                for record in batch:
+                    with open(os.path.join(directory, "previous_log.bin"), "ab") as myfile:
+                        myfile.write(record)
+        run("open per command (previous, no fsync)", openPerCommand)
+
+        with open(os.path.join(directory, "fsync_log.bin"), "ab") as fsyncFile:
+            def fsyncPerCommand(batch):
+                with fileLock:
+                    for record in batch:
+                        fsyncFile.write(record)
+                        fsyncFile.flush()
+                        os.fsync(fsyncFile.fileno())
+            run("fsync per command", fsyncPerCommand)
+
+        for mode in ["none", "batch", "interval"]:
+            commandLog = CommandLog(os.path.join(directory, F"{mode}_log"), durability = mode, fsyncInterval = args.fsync_interval)
+
+            def logBatch(batch):
+                for record in batch:
+                    commandLog.append(record)
+                commandLog.commit()
+                commandLog.waitDurable()
+            run(F"durability {mode}", logBatch)
+
+def reorder(args):
+    server.LOCK = Lock()
+
+    def backlog(count, shuffle = True):
+        # commands from server 1 in a random order, as after a partition heals
+        # messages are spread across rooms so that the time is not dominated by inserting them into long chatrooms
+        commands = []
+        for i in range(count):
+            room = F"room{i % args.rooms}"
+            if i < args.rooms:
+                commands.append(Command(1, i + 1, "join", ("user", room, datetime.now()), {}))
+            else:
+                commands.append(Command(1, i + 1, "newMessage", ("user", room, F"message number {i}", datetime.now()), {"messageid": F"1_{i}"}))
+        if shuffle:
+            random.Random(count).shuffle(commands)
+        return commands
+
+    def previous(srv, pending, command):
+        # previous approach, a list of buffered commands walked recursively after every command that runs
+        if command.stamp <= srv.vector_stamp[command.origin]:
+            return None
+        if command.stamp != srv.vector_stamp[command.origin] + 1:
+            pending[command.origin].append(command)
+            return None
+        returnVal = srv.runCmd(command)
+        stillPending = []
+        for message in pending[command.origin]:
+            pending[command.origin].remove(message)
+            if not previous(srv, pending, message):
+                stillPending.append(message)
+        pending[command.origin] = stillPending
+        return returnVal
+
+    def run(name, count, apply, shuffle = True):
+        # every approach is given the same commands in the same order
+        commands = backlog(count, shuffle)
+        with tempfile.TemporaryDirectory() as directory:
+            srv = offlineServer(0, directory)
+            srv.log.durability = "none"
+            start = perf_counter()
+            try:
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    apply(srv, commands)
+                result = F"{perf_counter() - start:.2f}s"
+                if srv.vector_stamp[1] != count:
+                    # the time to apply part of the backlog is not comparable with the time to apply all of it
+                    result = F"unavailable, stopped after {result} with {count - srv.vector_stamp[1]} commands never applied"
+            except Exception as e:
+                result = F"failed after {perf_counter() - start:.2f}s with {type(e).__name__}: {e}"
+            print(F"{name} ({count} commands): {result}, {srv.vector_stamp[1]} applied")
+
+    def withPrevious(srv, commands):
+        pending = {key : [] for key in SERVER_ADDRESSES.keys()}
+        for command in commands:
+            previous(srv, pending, command)
+
+    def withReorderBuffer(srv, commands):
+        for command in commands:
+            srv.processCmd(command)
+
+    run("previous", args.previous, withPrevious)
+    run("reorder buffer", args.previous, withReorderBuffer)
+    run("in order, nothing buffered", args.count, withReorderBuffer, shuffle = False)
+    run("reorder buffer", args.count, withReorderBuffer)
+
+def contention(args):
+    server.LOCK = Lock()
+    servers = len(SERVER_ADDRESSES.keys())
+
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        srv = offlineServer(0, directory)
+        srv.log.durability = "none"
+        server.SERVER = srv
+        stamp = 0
+        for i in range(args.count):
+            # a user in every room, then messages in every room, all logged so that anti-entropy has to read them back
+            stamp += 1
+            if i < args.rooms:
+                srv.processCmd(Command(1, stamp, "join", (F"user{i}", F"room{i}", datetime.now()), {}))
+            else:
+                srv.processCmd(Command(1, stamp, "newMessage", (F"user{i % args.rooms}", F"room{i % args.rooms}", F"message number {i}", datetime.now()), {"messageid": F"1_{i}"}))
+        srv.log.commit()
+
+        def run(name, read):
+            stop = perf_counter() + args.duration
+            samples = [[] for _ in range(args.threads)]
+            background = {"writes" : 0, "anti-entropy" : 0}
+
+            def poll(i):
+                # clients poll every room except room 0, which is being written to
+                room = i % (args.rooms - 1) + 1
+                while perf_counter() < stop:
+                    start = perf_counter()
+                    read(F"user{room}", F"room{room}")
+                    samples[i].append(perf_counter() - start)
+                    sleep(args.interval)
+
+            def write():
+                nonlocal stamp
+                while perf_counter() < stop:
+                    with server.LOCK:
+                        stamp += 1
+                        srv.processCmd(Command(1, stamp, "newMessage", ("user0", "room0", F"message number {stamp}", datetime.now()), {"messageid": F"1_{stamp}"}))
+                        srv.log.commit()
+                    background["writes"] += 1
+                    sleep(0.001)
+
+            def antiEntropy():
+                # a peer that is missing every command, as after it was wiped
+                while perf_counter() < stop:
+                    with server.LOCK:
+                        srv.serverDataGive([0 for _ in range(servers)])
+                    background["anti-entropy"] += 1
+                    sleep(0.1)
+
+            threads = [Thread(target=poll, args=[i]) for i in range(args.threads)] + [Thread(target=write), Thread(target=antiEntropy)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            with redirect_stdout(sys.__stdout__):
+                reads = [sample for thread in samples for sample in thread]
+                print(F"{name}: {len(reads) / args.duration:.0f} reads/s, {background['writes']} writes, {background['anti-entropy']} anti-entropy rounds")
+                report("  read latency", reads)
+                print(F"  slowest read: {max(reads) * 1000:.2f}ms")
+
+        def rebuild(room):
+            # previous approach, rebuilding the messages and counting their likes on every read
+            return [(id, user, message, sum(1 for _, value in likes.values() if value)) for id, user, message, likes, _, _ in room.messages.tail(10)]
+
+        def globalLock(user, room):
+            with server.LOCK:
+                rebuild(srv.getRoom(room))
+
+        def roomLock(user, room):
+            room = srv.getRoom(room)
+            with room.lock.read():
+                rebuild(room)
+
+        run("global LOCK", globalLock)
+        run("room lock", roomLock)
+        run("room view, no lock", lambda user, room: server.Connection.exposed_getMessages(None, user, room, 10))
+
+def fanout(args):
+    # every proposer sends a call to each server and waits for a majority, like a consensus round
+    # the last server is slow, as if it was overloaded or behind a lossy link
+    servers = sorted(SERVER_ADDRESSES.keys())
+    delays = {key : args.latency / 1000 for key in servers}
+    delays[servers[-1]] = args.slow / 1000
+
+    def call(serverIndex, quorum):
+        sleep(delays[serverIndex])
+        quorum.record(serverIndex, 1)
+
+    def run(name, submit):
+        stop = perf_counter() + args.duration
+        samples = []
+        rounds = [0 for _ in range(args.threads)]
+        peak = threading.active_count()
+        running = True
+
+        def propose(i):
+            while perf_counter() < stop:
+                rounds[i] += 1
+                start = perf_counter()
+                quorum = QuorumCollector(default = 0)
+                for key in servers:
+                    submit(key, call, key, quorum)
+                if quorum.wait(lambda results: True if server.isMajority(sum(results)) else None):
+                    samples.append(perf_counter() - start)
+
+        def monitor():
+            nonlocal peak
+            while running:
+                peak = max(peak, threading.active_count())
+                sleep(0.01)
+
+        base = threading.active_count()
+        watcher = Thread(target=monitor)
+        watcher.start()
+        threads = [Thread(target=propose, args=[i]) for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        sleep(args.slow / 1000) # let the calls to the slow server finish
+        running = False
+        watcher.join()
+        print(F"{name}: {len(samples) / args.duration:.0f} rounds/s, {sum(rounds) * len(servers)} calls, most threads running at once {peak - base - 1}")
+        report("  round latency", samples)
+
+    started = 0
+    def threadPerCall(key, func, *callArgs):
+        nonlocal started
+        started += 1
+        Thread(target=func, args=callArgs).start()
+
+    run("thread per call", threadPerCall)
+    print(F"  threads started: {started}")
+
+    executor = PeerExecutor(args.workers)
+    def executorSubmit(key, func, *callArgs):
+        if not executor.submit(key, func, *callArgs):
+            callArgs[1].record(key, 0) # counted as failed, like a server that cannot be reached
+
+    run("peer executor", executorSubmit)
+    submitted, workers, rejected, depths, maxDepths = executor.stats()
+    print(F"  threads started: {workers}, calls rejected: {rejected}, deepest queues: {maxDepths}")
+
+def presence(args):
+    keys = [(F"room{i}", F"user{i}") for i in range(args.rooms)]
+
+    def idle(name):
+        # thread count, and cpu used by the whole process while nothing else runs
+        sleep(1)
+        start, cpu = perf_counter(), process_time()
+        sleep(args.duration)
+        used = process_time() - cpu
+        print(F"{name}: {threading.active_count()} threads, {used / (perf_counter() - start) * 100:.1f}% of a cpu while idle")
+
+    # previous approach, each room scans its participants every second on its own thread
+    class PurgedRoom():
+        def __init__(self, user):
+            self.participants = [user]
+            self.participantHeartbeats = {user : time()}
+            Thread(target=self.purge, daemon=True).start()
+
+        def purge(self):
+            while running:
+                sleep(1)
+                now = time()
+                for user in list(self.participants):
+                    if self.participantHeartbeats[user] and now - self.participantHeartbeats[user] > args.timeout:
+                        self.participants.remove(user)
+
+    running = True
+    rooms = {room : PurgedRoom(user) for room, user in keys}
+    idle("purge thread per room")
+    start = perf_counter()
+    for i in range(args.count):
+        room, user = keys[i % len(keys)]
+        rooms[room].participantHeartbeats[user] = time()
+    print(F"  heartbeat: {(perf_counter() - start) / args.count * 1e6:.2f}us")
+    running = False
+    sleep(1.5) # let the purge threads finish
+    rooms = None
+
+    chatrooms = [Chatroom(room) for room, _ in keys]
+    wheel = PresenceManager(lambda clients: None, timeout = args.duration + 60) # no client times out while measuring
+    for room, user in keys:
+        wheel.track(room, user)
+    idle("presence timer wheel")
+    start = perf_counter()
+    for i in range(args.count):
+        room, user = keys[i % len(keys)]
+        wheel.heartbeat(room, user)
+    print(F"  heartbeat: {(perf_counter() - start) / args.count * 1e6:.2f}us")
+
+    # every client stops polling at once
+    expired = []
+    def onExpire(clients):
+        expired.append((perf_counter(), len(clients)))
+
+    wheel = PresenceManager(onExpire, timeout = args.timeout)
+    for room, user in keys:
+        wheel.track(room, user)
+    stop = perf_counter()
+    while len(wheel) > 0 and perf_counter() - stop < args.timeout + 10:
+        sleep(0.01)
+    if len(expired) > 0:
+        print(F"  {sum(count for _, count in expired)} clients expired {expired[-1][0] - stop:.2f}s after their last heartbeat, in {len(expired)} batches")
+
+def messages(args):
+    base = datetime(2024, 1, 1)
+
+    def entry(i, timestamp):
+        return [F"1_{i}", F"user{i % 50}", F"message number {i}", [], timestamp]
+
+    # previous approach, a list scanned for the insert position and for every like
+    def listInsert(messages, data):
+        for i in range(len(messages)):
+            if messages[i][4] > data[4]:
+                messages.insert(i, data)
+                return
+        messages.append(data)
+
+    def listGet(messages, id):
+        for message in messages:
+            if message[0] == id:
+                return message
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        entries = [entry(i, base + dt.timedelta(milliseconds=i)) for i in range(size)]
+        newest = [entry(size + i, base + dt.timedelta(milliseconds=size + i)) for i in range(args.count)]
+        older = [entry(size * 2 + i, base + dt.timedelta(milliseconds=random.randrange(size))) for i in range(args.count)] # arrived late
+        lookups = [F"1_{random.randrange(size)}" for _ in range(args.count)]
+        print(F"{size} messages:")
+
+        start = perf_counter()
+        store = MessageStore()
+        for data in entries:
+            store.insert(data)
+        print(F"  message store: building by insert {(perf_counter() - start) / size * 1e6:.2f}us per message")
+
+        for name, insert, get, messages in [("list", listInsert, listGet, list(entries)),
+                                            ("message store", lambda store, data: store.insert(data), lambda store, id: store.get(id), MessageStore(entries))]:
+            times = []
+            for batch in [newest, older]:
+                start = perf_counter()
+                for data in batch:
+                    insert(messages, data)
+                times.append((perf_counter() - start) / len(batch))
+            start = perf_counter()
+            for id in lookups:
+                get(messages, id)
+            times.append((perf_counter() - start) / len(lookups))
+            print(F"  {name}: insert newest {times[0] * 1e6:.2f}us, insert late {times[1] * 1e6:.2f}us, lookup by id {times[2] * 1e6:.2f}us")
+
+def likes(args):
+    # a room whose published view is full of messages that each have many likes
+    base = datetime(2024, 1, 1)
+    size = server.ROOM_VIEW_SIZE
+
+    # previous approach, a list of (user, timestamp, value) scanned for the user and counted on every publish
+    def listLike(msg, user, timestamp, value = True):
+        for i in range(len(msg[3])):
+            cUser, cTimestamp, cVal = msg[3][i]
+            if user == cUser:
+                if cVal == value or cTimestamp < timestamp:
+                    msg[3][i] = (user, timestamp, value)
+                return
+        msg[3].append((user, timestamp, value))
+
+    def listPublish(messages):
+        return tuple((id, user, message, sum(1 for _, _, value in likes if value == True)) for id, user, message, likes, _ in messages[-size:])
+
+    messages = [[F"1_{i}", "author", F"message number {i}", [(F"user{u}", base, True) for u in range(args.likes)], base + dt.timedelta(seconds=i)] for i in range(size)]
+    room = Chatroom("bench")
+    for i in range(size):
+        room.newMessage("author", F"message number {i}", base + dt.timedelta(seconds=i), F"1_{i}")
+        for u in range(args.likes):
+            room.likeMessage(F"user{u}", F"1_{i}", base)
+
+    for name, like, publish in [("list", lambda i, user, timestamp, value: listLike(messages[i % size], user, timestamp, value), lambda: listPublish(messages)),
+                                ("incremental", lambda i, user, timestamp, value: room.likeMessage(user, F"1_{i % size}", timestamp, value), room.publish)]:
+        times = []
+        for user in ["user0", F"user{args.likes - 1}", "newcomer"]: # first and last in the list, and one that has not liked anything
+            start = perf_counter()
+            for i in range(args.count):
+                like(i, user, base + dt.timedelta(seconds=i + 1), i % 2 == 1) # alternates unlike and like
+            times.append((perf_counter() - start) / args.count)
+        start = perf_counter()
+        for _ in range(args.count):
+            publish()
+        publishTime = (perf_counter() - start) / args.count
+        print(F"{name}: like by first liker {times[0] * 1e6:.2f}us, by last liker {times[1] * 1e6:.2f}us, by a new user {times[2] * 1e6:.2f}us, "
+              F"publishing {size} messages {publishTime * 1e6:.2f}us")
+
+    counts = [msg[3] for msg in messages]
+    same = all(view[3] == sum(1 for _, _, value in likes if value) for view, likes in zip(room.view.messages, counts))
+    print(F"counts match the previous approach: {same}")
+
+def lookups(args):
+    servers = len(SERVER_ADDRESSES.keys())
+    names = [F"room{i}" for i in range(args.rooms)]
+    users = [F"user{i}" for i in range(args.users)]
+    hidden = [(F"hidden{i}", names[i % args.rooms]) for i in range(args.clients)]
+
+    # previous approach, rooms in a list scanned by name, sorted participant lists and lists of hidden clients
+    # every change to a room copied its participants into the published view, as the list rooms do here
+    class ListRoom():
+        def __init__(self, name):
+            self.name = name
+            self.participants = []
+            self.view = ()
+
+    listRooms = [ListRoom(name) for name in names]
+    listHidden = [hidden[i::servers] for i in range(servers)]
+
+    def listGetRoom(roomName):
+        for room in listRooms:
+            if room.name == roomName:
+                return room
+
+    def listAddChatter(room, username):
+        room.participants.append(username)
+        room.participants = sorted(room.participants)
+        room.view = tuple(room.participants)
+
+    def listRemoveChatter(room, username):
+        if username in room.participants:
+            room.participants.remove(username)
+            room.view = tuple(room.participants)
+
+    def listPublish(room):
+        room.view = tuple(room.participants)
+
+    def listIsHiddenUser(user, roomName):
+        for srv in listHidden:
+            for tuser, troomName in srv:
+                if user == tuser and roomName == troomName:
+                    return True
+        return False
+
+    srv = Server.__new__(Server)
+    srv.chatrooms = {name: Chatroom(name) for name in names}
+    srv.hidden_clients = [set(hidden[i::servers]) for i in range(servers)]
+
+    # the room looked up is the last one created, the worst case for the list
+    target = names[-1]
+    for user in users:
+        listAddChatter(listGetRoom(target), user)
+        srv.getRoom(target).add_chatter(user)
+    members = [random.choice(users) for _ in range(args.count)]
+    strangers = [F"stranger{i}" for i in range(args.count)]
+
+    def timed(operation, values):
+        start = perf_counter()
+        for value in values:
+            operation(value)
+        return (perf_counter() - start) / len(values) * 1e6
+
+    for name, getRoom, addChatter, removeChatter, publish, isHiddenUser in [("list", listGetRoom, listAddChatter, listRemoveChatter, listPublish, listIsHiddenUser),
+                                                                             ("hash index", srv.getRoom, Chatroom.add_chatter, Chatroom.remove_chatter, Chatroom.publish, srv.isHiddenUser)]:
+        room = getRoom(target)
+        roomTime = timed(getRoom, [target] * args.count)
+        memberTime = timed(lambda user: user in room.participants, members)
+        joinTime = timed(lambda user: addChatter(room, user), strangers)
+        leaveTime = timed(lambda user: removeChatter(room, user), strangers)
+        publishTime = timed(lambda _: publish(room), members) # after a message, the participants have not changed
+        hiddenTime = timed(lambda user: isHiddenUser(user, target), members) # not hidden, so every list is scanned
+        print(F"{name}: find room {roomTime:.2f}us, participant check {memberTime:.2f}us, join {joinTime:.2f}us, leave {leaveTime:.2f}us, "
+              F"publish {publishTime:.2f}us, hidden client check {hiddenTime:.2f}us")
+
+def deltas(args):
+    # one room polled by a client that keeps up with it, every answer is built and encoded as rpyc sends it
+    base = datetime(2024, 1, 1)
+    room = Chatroom("bench")
+    srv = Server.__new__(Server)
+    srv.chatrooms = {"bench": room}
+    srv.presence = PresenceManager(lambda clients: None)
+    users = [F"user{i}" for i in range(args.users)]
+    for user in users:
+        room.add_chatter(user)
+    written = [0, 0] # messages and likes
+
+    def write(i):
+        n, k = written
+        if i % 2 == 0:
+            room.newMessage(users[n % len(users)], F"message number {n}", base + dt.timedelta(seconds=n), F"1_{n}")
+            written[0] += 1
+        else: # likes one of the newest messages
+            room.likeMessage(users[k % len(users)], F"1_{n - 1 - k % min(n, 20)}", base + dt.timedelta(seconds=k))
+            written[1] += 1
+
+    for i in range(args.messages):
+        write(0)
+
+    for window in [int(w) for w in args.windows.split(",")]:
+        for changes in [int(c) for c in args.changes.split(",")]:
+            cursor = srv.getChanges(users[0], "bench", None, window)[0]
+            tag = ""
+            sizes = {"messages": 0, "conditional": 0, "changes": 0}
+            times = {"messages": 0, "conditional": 0, "changes": 0}
+            for _ in range(args.count):
+                for i in range(changes):
+                    write(i)
+                start = perf_counter()
+                data = brine.dump((srv.getMessages(users[0], "bench", window), srv.getChatters("bench")))
+                times["messages"] += perf_counter() - start
+                sizes["messages"] += len(data)
+                start = perf_counter()
+                answer = (srv.getMessages(users[0], "bench", window, tag), srv.getChatters("bench", tag))
+                data = brine.dump(answer)
+                times["conditional"] += perf_counter() - start
+                sizes["conditional"] += len(data)
+                if answer[0] != server.UNCHANGED:
+                    tag = answer[0][0]
+                start = perf_counter()
+                answer = srv.getChanges(users[0], "bench", cursor, window)
+                data = brine.dump(answer)
+                times["changes"] += perf_counter() - start
+                sizes["changes"] += len(data)
+                cursor = answer[0]
+            print(F"window {window}, {changes} writes between polls: "
+                  F"newest messages {sizes['messages'] / args.count:.0f} bytes {times['messages'] / args.count * 1e6:.2f}us, "
+                  F"with version tag {sizes['conditional'] / args.count:.0f} bytes {times['conditional'] / args.count * 1e6:.2f}us, "
+                  F"changes since cursor {sizes['changes'] / args.count:.0f} bytes {times['changes'] / args.count * 1e6:.2f}us")
+
+def history(args):
+    # every answer is built and encoded as rpyc sends it, the room's lock is held while each one is built
+    base = datetime(2024, 1, 1)
+    room = Chatroom("bench")
+    room.add_chatter("reader")
+    for i in range(args.messages):
+        room.newMessage("reader", F"message number {i}", base + dt.timedelta(seconds=i), F"1_{i}")
+
+    def whole():
+        return [brine.dump(room.get_messages("reader", -1))]
+
+    def paged():
+        pages, before = [], None
+        while True:
+            page = room.get_history(before, None, args.page)
+            pages.append(brine.dump(page))
+            if len(page) < args.page:
+                return pages
+            before = page[0][0]
+
+    def firstPage():
+        return [brine.dump(room.get_history(None, None, args.page))]
+
+    for name, fetch, first in [("whole history", whole, whole), ("pages", paged, firstPage)]:
+        start = perf_counter()
+        answers = fetch()
+        elapsed = perf_counter() - start
+        start = perf_counter()
+        first()
+        firstTime = perf_counter() - start
+        tracemalloc.start()
+        first()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(F"{name}: {len(answers)} responses in {elapsed * 1000:.1f}ms, largest {max(len(a) for a in answers) / 1e3:.1f}KB, "
+              F"first response built in {firstTime * 1000:.2f}ms using at most {peak / 1e6:.2f}MB")
+
+def main(argv):
+    args = get_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
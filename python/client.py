@@ -1,4 +1,4 @@
-import sys, argparse, os
+import sys, argparse, os, json
 from datetime import datetime
 from threading import Thread, Lock
 from time import sleep
@@ -11,6 +11,20 @@ SERVER_ADDRESSES = {
     3 : "172.30.100.104:12000",
     4 : "172.30.100.105:12000"
 }
+UPDATE_TIMEOUT = 5 # seconds the server may hold a request for updates to the room before answering unchanged
+HISTORY_PAGE = 20 # older messages fetched by each "p"
+
+def loadServerAddresses(config = None, servers = None):
+    # replaces the default servers with a comma separated list of address:port or a json file holding a list of them
+    if servers:
+        addresses = servers.split(",")
+    elif config:
+        with open(config) as f:
+            addresses = json.load(f)
+    else:
+        return
+    SERVER_ADDRESSES.clear()
+    SERVER_ADDRESSES.update({key : address for key, address in enumerate(addresses)})
 
 def with_lock(func):
     def inner(*args, **kwargs):
@@ -29,8 +43,12 @@ class Client():
         self.lastContent = None
         self.lastChatters = None
         self.displayedMessages = None
-        self.fetchAll = False
         self.conn = None
+        self.updates = None # second connection to the server, blocked waiting for changes to the room
+        self.cursor = None # position in the room's changes that the kept messages and participants are up to date with
+        self.messages = [] # newest messages of the room, kept up to date from its changes
+        self.messageCount = 0 # messages in the room, including the ones that are not kept
+        self.chatters = set()
         self.serverid = None
         self.terminateLock = Lock()
         self.terminated = False
@@ -53,6 +71,7 @@ class Client():
             address, port = SERVER_ADDRESSES[int(arg) - 1].split(":", 1)
 
         self.conn = rpc.connect(address, port)
+        self.updates = rpc.connect(address, port)
         self.serverid = str(arg)
         os.system('clear')
         print(F"connecting to {self.serverid}")
@@ -69,6 +88,7 @@ class Client():
         if self.conn:
             self.conn.root.exposed_leave(self.name, self.room, datetime.now())
             self.conn = None
+        self.updates = None # closed by update_loop once its wait returns
         self.room = None
         #os.system('clear')
         
@@ -95,6 +115,7 @@ class Client():
                 return False
             else:
                 self.room = room
+                self.cursor = None
                 return True
         else:
             print("Error joining room")
@@ -115,11 +136,26 @@ class Client():
     def get_chatters(self, room):
         return self.conn.root.exposed_getChatters(room)
 
-    def get_messages(self):
-        if self.fetchAll:
-            self.fetchAll = False
-            return self.conn.root.exposed_getMessages(self.name, self.room, -1)
-        return self.conn.root.exposed_getMessages(self.name, self.room)
+    def get_messages(self, number = 10):
+        return self.conn.root.exposed_getMessages(self.name, self.room, number)
+
+    def get_history(self, before):
+        # the page of messages just before the message with id before, the newest page if it is None
+        return self.conn.root.exposed_getHistory(self.name, self.room, before, None, HISTORY_PAGE)
+
+    @with_lock
+    def show_history(self):
+        # every "p" fetches the page of messages before the oldest one shown and draws it above them
+        # until the room changes and update_loop draws its newest messages again
+        if self.conn and self.room:
+            shown = tuple(self.displayedMessages or ())
+            page = self.get_history(shown[0][0] if len(shown) > 0 else None)
+            if page == None:
+                print("Error fetching past messages")
+            elif len(page) == 0:
+                print("No older messages")
+            else:
+                self.display(tuple(page) + shown, tuple(sorted(self.chatters)))
     
     @with_lock
     def leave(self):
@@ -191,8 +227,7 @@ class Client():
                         print(F"Unknown command: {cmd[0]}")
                 else: # commands with no arguments
                     if cmd[0] == "p": #print past messages
-                        self.fetchAll = True
-                        self.lastContent = None
+                        self.show_history()
                     elif cmd[0] == "v": #quit
                         self.reachableServers()
                     elif cmd[0] == "q": #quit
@@ -203,6 +238,45 @@ class Client():
             except FileNotFoundError as e:
                 print(F'Exception "{e}" raised while processing "{raw}"')
 
+    def display(self, newContent, newChatters):
+        os.system('clear')
+        count = 1
+        print(F"SERVER: {self.serverid}")
+        print(F"Group: {self.room} \nParticipants:{newChatters}")
+        for id, sender, msg, likes in newContent:
+            if likes != 0:
+                print(F"{count}. {sender}: {msg}\t({likes} Likes)")
+            else:
+                print(F"{count}. {sender}: {msg}")
+            count += 1
+
+        self.lastContent = newContent[-10:]
+        self.displayedMessages = newContent
+        self.lastChatters = str(newChatters)
+
+    def apply_changes(self, changes, number = 10):
+        # applies changes from the server to the kept messages and participants, keeping the newest (number) messages
+        for change in changes:
+            if change[0] == "message":
+                _, before, message = change
+                ids = [id for id, _, _, _ in self.messages]
+                if before in ids:
+                    self.messages.insert(ids.index(before) + 1, message)
+                elif before == None and len(self.messages) == self.messageCount: # first message of the room, and every message is kept
+                    self.messages.insert(0, message)
+                # otherwise it is older than every kept message
+                self.messageCount += 1
+            elif change[0] == "likes":
+                _, messageid, likes = change
+                for i, (id, sender, msg, _) in enumerate(self.messages):
+                    if id == messageid:
+                        self.messages[i] = (id, sender, msg, likes)
+            elif change[0] == "joined":
+                self.chatters.add(change[1])
+            elif change[0] == "left":
+                self.chatters.discard(change[1])
+        del self.messages[:-number]
+
     def update_loop(self, restart = False):
         global LOCK
         rate = 3
@@ -212,44 +286,35 @@ class Client():
         else:    
             print("Chat program started...")
         print("connect to server using 'c <address>:<port>'")
-        print("suggested: c <1-5>")
+        print(F"suggested: c <1-{len(SERVER_ADDRESSES)}>")
         try:
             while True:
-                sleepTime = 1
-                if not self.conn or not self.room:
-                    sleep(sleepTime/rate)
+                updates, room = self.updates, self.room
+                if not updates or not room:
+                    sleep(1/rate)
                     continue
-                
-                with LOCK:
-
-                    newContent = self.get_messages()
-
-                    if newContent == None: newContent = []
-
-                    newChatters = self.get_chatters(self.room)
 
+                # waits on its own connection until the room changes, so commands are not held up behind it
+                update = updates.root.exposed_waitForChanges(self.name, room, self.cursor, 10, UPDATE_TIMEOUT)
+                if updates is not self.updates:
+                    updates.close() # connected to another server while waiting
+                    continue
+                if update == None: # not in the room yet or any more
+                    sleep(1/rate)
+                    continue
 
-                    if newContent == self.lastContent and str(newChatters) == str(self.lastChatters):
-                        sleepTime = 0.5
-                    
+                with LOCK:
+                    if room != self.room:
+                        continue
+                    cursor, changes, messages, chatters, count = update
+                    if changes == None: # the server no longer has the changes since the cursor and sent the room instead
+                        self.messages, self.chatters, self.messageCount = list(messages), set(chatters), count
                     else:
-                        # if there are changes...
-                        os.system('clear')
-                        count = 1
-                        print(F"SERVER: {self.serverid}")
-                        print(F"Group: {self.room} \nParticipants:{newChatters}")
-                        for id, sender, msg, likes in newContent:
-                            if likes != 0:
-                                print(F"{count}. {sender}: {msg}\t({likes} Likes)")
-                            else:
-                                print(F"{count}. {sender}: {msg}")
-                            count += 1
-
-                        self.lastContent = newContent[-10:]
-                        self.displayedMessages = newContent
-                        self.lastChatters = str(newChatters)
-
-                sleep(sleepTime/rate)
+                        self.apply_changes(changes)
+                    self.cursor = cursor
+                    newContent, newChatters = tuple(self.messages), tuple(sorted(self.chatters))
+                    if newContent != self.lastContent or str(newChatters) != str(self.lastChatters):
+                        self.display(newContent, newChatters)
         except EOFError:
             print("Error connecting to server please connect to another server")
             print("---Press Enter to continue---")
@@ -264,10 +329,13 @@ def get_args(argv):
     parser = argparse.ArgumentParser(description="chat client")
     parser.add_argument('-p', '--port', required=False, default=12000, type=int)
     parser.add_argument('-a', '--address', required=False, default="localhost", type=str)
+    parser.add_argument('-c', '--config', required=False, default=None, type=str, help='json file with the list of servers (address:port), ids start at 1')
+    parser.add_argument('-s', '--servers', required=False, default=None, type=str, help='comma separated list of servers (address:port), overrides --config')
     return parser.parse_args()
 
 if __name__ == '__main__':
-    #args = get_args(sys.argv[1:])
+    args = get_args(sys.argv[1:])
+    loadServerAddresses(args.config, args.servers)
     global LOCK
     LOCK = Lock()
     
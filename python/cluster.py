@@ -0,0 +1,96 @@
+import sys, argparse, os, json, shutil, subprocess, signal
+from time import sleep, time
+import rpyc as rpc
+
+# Runs a cluster of chat servers on this machine without docker, e.g.
+#     python3 cluster.py -n 7 --shards 0
+# every server listens on 127.0.0.1 on its own port and keeps its log and snapshots in its own directory,
+# options that are not listed below are passed on to every server
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+HOST = "127.0.0.1"
+PORT = 12000 # port of the first server, the others use the ports after it
+DIRECTORY = "cluster"
+CONFIG_FILE = "servers.json"
+START_TIMEOUT = 30 # seconds to wait for every server to accept connections
+
+def get_args(argv):
+    parser = argparse.ArgumentParser(description="local chat server cluster", allow_abbrev=False)
+    parser.add_argument('-n', '--count', required=False, default=5, type=int, help='number of servers')
+    parser.add_argument('-p', '--port', required=False, default=PORT, type=int, help='port of the first server, the others use the ports after it')
+    parser.add_argument('--directory', required=False, default=DIRECTORY, type=str, help='directory for the server list and a data directory for each server')
+    parser.add_argument('--async-port', required=False, default=0, type=int, help='port of the first server\'s asyncio front end, the others use the ports after it, 0 disables it')
+    parser.add_argument('--clean', required=False, action='store_true', help='remove the logs and snapshots left by a previous run')
+    return parser.parse_known_args(argv)
+
+def writeConfig(count, port = PORT, directory = DIRECTORY):
+    # writes the list of servers for server.py and the clients --config and returns its path
+    addresses = [F"{HOST}:{port + i}" for i in range(count)]
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, CONFIG_FILE)
+    with open(path, "w") as f:
+        json.dump(addresses, f, indent=4)
+    return path
+
+def startCluster(count, port = PORT, directory = DIRECTORY, serverArgs = [], clean = False, asyncPort = 0):
+    # starts count servers, the output of server n is written to server<n>.out in its data directory
+    directory = os.path.abspath(directory)
+    config = writeConfig(count, port, directory)
+    processes = []
+    for i in range(1, count + 1):
+        dataDirectory = os.path.join(directory, F"server{i}")
+        if clean:
+            shutil.rmtree(dataDirectory, ignore_errors=True)
+        os.makedirs(dataDirectory, exist_ok=True)
+        options = ["--async-port", str(asyncPort + i - 1)] if asyncPort else []
+        with open(os.path.join(dataDirectory, F"server{i}.out"), "a") as output:
+            processes.append(subprocess.Popen([sys.executable, "-u", SERVER_SCRIPT, "-id", str(i), "-c", config] + options + serverArgs,
+                                              cwd=dataDirectory, stdout=output, stderr=subprocess.STDOUT))
+    return processes
+
+def waitForCluster(count, port = PORT, processes = [], timeout = START_TIMEOUT):
+    # returns once every server accepts connections, servers only listen after recovering their state
+    end = time() + timeout
+    for i in range(count):
+        while True:
+            try:
+                rpc.connect(HOST, port + i).close()
+                break
+            except OSError:
+                if time() > end or any(process.poll() != None for process in processes):
+                    raise RuntimeError(F"server {i + 1} did not start")
+                sleep(0.1)
+
+def stopCluster(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+def main(argv):
+    args, serverArgs = get_args(argv)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0)) # stop the servers when the launcher is killed too
+    processes = startCluster(args.count, args.port, args.directory, serverArgs, args.clean, args.async_port)
+    try:
+        waitForCluster(args.count, args.port, processes)
+        print(F"{args.count} servers running on {HOST}:{args.port}-{args.port + args.count - 1}, "
+              F"clients can connect with --config {os.path.join(args.directory, CONFIG_FILE)}")
+        if args.async_port:
+            print(F"asyncio front ends on {HOST}:{args.async_port}-{args.async_port + args.count - 1}")
+        print("press Ctrl-C to stop")
+        running = set(range(args.count))
+        while True:
+            for i in sorted(running):
+                if processes[i].poll() != None:
+                    print(F"server {i + 1} exited with code {processes[i].returncode}")
+                    running.discard(i)
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        print(e)
+    finally:
+        stopCluster(processes)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,10 +1,16 @@
-import sys, argparse, os, json
+import sys, argparse, os, json, asyncio
 import rpyc as rpc
-from threading import Thread, Lock
+from threading import Thread, Lock, Semaphore, Condition, Event
 from time import sleep, time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from rpyc.utils.server import ThreadedServer
 import datetime
 import pickle
+import struct, zlib
+from array import array
+from collections import deque, namedtuple
+from bisect import bisect_left, bisect_right
 
 DEBUG_MESSAGES = []
 
@@ -17,6 +23,34 @@ SERVER_ADDRESSES = {
 }
 
 TIMEOUT = 1
+POOL_SIZE = 8 # maximum number of open connections to each other server, 0 connects per call
+BATCH_WINDOW = 0.005 # seconds to wait for more writes before proposing a batch
+BATCH_SIZE = 32 # maximum number of writes proposed in a single round
+RETRY_BACKOFF = 0.05 # seconds a shard waits before its next round after a round that was not decided, doubled after every such round
+RETRY_BACKOFF_LIMIT = 5 # longest seconds a shard waits between rounds that are not decided
+COMMIT_TIMEOUT = 10 # longest seconds a write waits to be applied before the client is answered with a failure, kept under rpyc's 30 second request timeout
+PIPELINE_WINDOW = 8 # maximum number of proposals the leader has in flight at once
+PEER_WORKERS = 8 # threads making calls to each other server, further calls wait in that server's queue
+PEER_QUEUE_SIZE = 64 # calls waiting for each server before more are rejected and counted as failed
+SHARDS = 1 # rooms are hash partitioned into this many shards, each with its own leader, 0 uses one shard per server, one shard commits more writes since stamps span every shard
+SNAPSHOT_INTERVAL = 10000 # commands applied between snapshots of the chatrooms, 0 disables snapshots
+DURABILITY = "batch" # when logged commands are fsynced: "none", after every "batch" of commands, or every FSYNC_INTERVAL ms ("interval")
+FSYNC_INTERVAL = 10 # milliseconds between fsyncs of the log when DURABILITY is "interval"
+STREAM_TIMEOUT = 5 # seconds a request for the commit stream waits for new commands before returning empty
+ANTI_ENTROPY_INTERVAL = 5 # seconds between anti-entropy rounds with each server, commands normally arrive through the commit stream
+REORDER_LIMIT = 100000 # how far past the last applied command from a server commands are buffered, later ones are fetched again by anti-entropy
+ASYNC_PORT = 0 # port of the asyncio front end for clients, 0 only serves clients through rpyc
+ASYNC_WORKERS = 64 # threads running the writes of asyncio clients while they wait for consensus
+PRESENCE_TIMEOUT = 10 # seconds a client of this server may go without polling or writing before it is removed from its room, 0 never removes clients
+PRESENCE_TICK = 1 # seconds between checks for clients that have timed out
+PRESENCE_SLOTS = 64 # slots in the presence timer wheel, one per tick
+UPDATE_TIMEOUT = 5 # longest seconds a client's waitForUpdate blocks before returning the room unchanged, kept under half the presence timeout
+LOG_TAIL_SIZE = 1024 # most recent records from each server kept in memory to answer peers that are nearly up to date
+MESSAGE_CHUNK_SIZE = 1000 # messages per chunk of a room's message store, chunks are split when they reach twice this
+ROOM_VIEW_SIZE = 100 # most recent messages of a room kept in its published view, reads of older messages take the room's lock
+HISTORY_PAGE = 50 # messages in a page of getHistory when the client does not ask for a size
+HISTORY_PAGE_LIMIT = 1000 # most messages in one page of getHistory, larger pages are cut to this
+ROOM_CHANGE_LOG = 1000 # most recent changes to a room kept for getChanges, clients further behind are sent the room's state
 
 
 
@@ -42,6 +76,946 @@ class ResultCode():
         return F"{self.value}:{self.RESULT_CODE[self.value]}"
 
 
+class ServerConnectionPool():
+    """
+    keeps connections to other servers open so that they can be reused between RPCs
+    """
+
+    def __init__(self, size = POOL_SIZE, healthCheckAge = TIMEOUT):
+        self.size = size
+        self.healthCheckAge = healthCheckAge # idle connections older than this are pinged before reuse
+        self.lock = Lock()
+        self.idle = {key : [] for key in SERVER_ADDRESSES.keys()}
+        self.slots = {key : Semaphore(size) for key in SERVER_ADDRESSES.keys()}
+
+    @contextmanager
+    def connect(self, serverIndex):
+        # yields a connection to serverIndex, the connection is discarded if the caller raises
+        if self.size <= 0:
+            conn = self._open(serverIndex)
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+
+        if not self.slots[serverIndex].acquire(timeout = TIMEOUT):
+            raise ConnectionError(F"too many open connections to server {serverIndex}")
+
+        conn = None
+        try:
+            conn = self._checkout(serverIndex)
+            yield conn
+        except BaseException:
+            if conn:
+                self._discard(conn)
+            raise
+        else:
+            self._checkin(serverIndex, conn)
+        finally:
+            self.slots[serverIndex].release()
+
+    def _open(self, serverIndex):
+        address, port = SERVER_ADDRESSES[serverIndex].split(":", 1)
+        return rpc.connect(address, port, service=Connection)
+
+    def _checkout(self, serverIndex):
+        while True:
+            with self.lock:
+                if len(self.idle[serverIndex]) == 0:
+                    break
+                conn, lastUsed = self.idle[serverIndex].pop()
+
+            if conn.closed:
+                continue
+
+            if time() - lastUsed > self.healthCheckAge:
+                try:
+                    conn.ping(timeout = TIMEOUT)
+                except Exception:
+                    self._discard(conn)
+                    continue
+
+            return conn
+
+        return self._open(serverIndex) # no healthy idle connection, reconnect
+
+    def _checkin(self, serverIndex, conn):
+        if conn.closed:
+            return
+        with self.lock:
+            if len(self.idle[serverIndex]) < self.size:
+                self.idle[serverIndex].append((conn, time()))
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self, serverIndex = None):
+        # closes idle connections to serverIndex, or to all servers if no index is given
+        keys = SERVER_ADDRESSES.keys() if serverIndex == None else [serverIndex]
+        for key in keys:
+            with self.lock:
+                idle = self.idle[key]
+                self.idle[key] = []
+            for conn, _ in idle:
+                self._discard(conn)
+
+
+class Command():
+    """
+    a replicated write, encoded once as a length prefixed binary record
+    the same record is written to the log, sent to other servers and decoded to apply it
+    """
+
+    OPCODES = {"join" : 1, "leave" : 2, "newMessage" : 3, "likeMessage" : 4, "unlikeMessage" : 5, "noop" : 6}
+    FUNCTIONS = {opcode : name for name, opcode in OPCODES.items()}
+
+    HEADER = struct.Struct("!IHQB") # length of the rest of the record, origin server, event stamp, opcode
+    COUNT = struct.Struct("!B") # number of args or kwargs
+    FIELD = struct.Struct("!BI") # value type, value length
+    CRC = struct.Struct("!I") # crc32 of everything before it
+    INT = struct.Struct("!q")
+
+    TYPE_NONE, TYPE_STR, TYPE_INT, TYPE_BOOL, TYPE_DATETIME = range(5)
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, origin, stamp, funcName, args, kwargs, record = None):
+        self.origin = origin
+        self.stamp = stamp
+        self.funcName = funcName
+        self.args = tuple(args)
+        self.kwargs = kwargs
+        self.record = record if record != None else self.encode()
+
+    def __repr__(self) -> str:
+        return F"{self.origin}|{self.stamp}|{self.funcName}|{self.args}|{self.kwargs}"
+
+    def encode(self):
+        parts = [self.COUNT.pack(len(self.args))]
+        for value in self.args:
+            parts.append(self.encodeValue(value))
+        parts.append(self.COUNT.pack(len(self.kwargs)))
+        for name, value in self.kwargs.items():
+            parts.append(self.encodeValue(name))
+            parts.append(self.encodeValue(value))
+        body = b"".join(parts)
+
+        length = self.HEADER.size - 4 + len(body) + self.CRC.size
+        record = self.HEADER.pack(length, self.origin, self.stamp, self.OPCODES[self.funcName]) + body
+        return record + self.CRC.pack(zlib.crc32(record))
+
+    @classmethod
+    def encodeValue(cls, value):
+        if value is None: # == would be a remote call for a client's datetime
+            return cls.FIELD.pack(cls.TYPE_NONE, 0)
+        elif type(value) == str:
+            data = value.encode("utf-8")
+            return cls.FIELD.pack(cls.TYPE_STR, len(data)) + data
+        elif type(value) == bool:
+            return cls.FIELD.pack(cls.TYPE_BOOL, 1) + (b"\x01" if value else b"\x00")
+        elif type(value) == int:
+            return cls.FIELD.pack(cls.TYPE_INT, cls.INT.size) + cls.INT.pack(value)
+        else:
+            # timestamps from clients arrive as references to the client's datetime
+            if type(value) != datetime.datetime:
+                value = datetime.datetime.fromisoformat(str(value))
+            micros = (value - cls.EPOCH) // datetime.timedelta(microseconds=1)
+            return cls.FIELD.pack(cls.TYPE_DATETIME, cls.INT.size) + cls.INT.pack(micros)
+
+    @classmethod
+    def decode(cls, record):
+        length, origin, stamp, opcode = cls.HEADER.unpack_from(record)
+        if length + 4 != len(record) or zlib.crc32(record[:-cls.CRC.size]) != cls.CRC.unpack_from(record, len(record) - cls.CRC.size)[0]:
+            raise ValueError("corrupt command record")
+
+        offset = cls.HEADER.size
+        args = []
+        count = cls.COUNT.unpack_from(record, offset)[0]
+        offset += cls.COUNT.size
+        for _ in range(count):
+            value, offset = cls.decodeValue(record, offset)
+            args.append(value)
+
+        kwargs = {}
+        count = cls.COUNT.unpack_from(record, offset)[0]
+        offset += cls.COUNT.size
+        for _ in range(count):
+            name, offset = cls.decodeValue(record, offset)
+            kwargs[name], offset = cls.decodeValue(record, offset)
+
+        return cls(origin, stamp, cls.FUNCTIONS[opcode], args, kwargs, record = bytes(record))
+
+    @classmethod
+    def decodeValue(cls, record, offset):
+        valueType, length = cls.FIELD.unpack_from(record, offset)
+        offset += cls.FIELD.size
+        data = record[offset:offset + length]
+        offset += length
+
+        if valueType == cls.TYPE_NONE:
+            return None, offset
+        elif valueType == cls.TYPE_STR:
+            return bytes(data).decode("utf-8"), offset
+        elif valueType == cls.TYPE_BOOL:
+            return data[0] == 1, offset
+        elif valueType == cls.TYPE_INT:
+            return cls.INT.unpack(data)[0], offset
+        elif valueType == cls.TYPE_DATETIME:
+            return cls.EPOCH + datetime.timedelta(microseconds=cls.INT.unpack(data)[0]), offset
+        raise ValueError(F"unknown value type {valueType}")
+
+    @classmethod
+    def peek(cls, record):
+        # (origin, stamp) of a record without decoding the rest of it
+        _, origin, stamp, _ = cls.HEADER.unpack_from(record)
+        return origin, stamp
+
+    @classmethod
+    def room(cls, record):
+        # name of the chatroom a record writes to (the second argument of every write) without decoding the rest of it
+        offset = cls.HEADER.size + cls.COUNT.size
+        _, length = cls.FIELD.unpack_from(record, offset)
+        return cls.decodeValue(record, offset + cls.FIELD.size + length)[0]
+
+    @classmethod
+    def readRecords(cls, myfile):
+        # yields every record in a binary log, stopping at a record that was only partly written
+        while True:
+            prefix = myfile.read(4)
+            if len(prefix) < 4:
+                return
+            length = struct.unpack("!I", prefix)[0]
+            rest = myfile.read(length)
+            if len(rest) < length:
+                return
+            yield prefix + rest
+
+class CommandLog():
+    """
+    append only log of applied Command records, indexed by origin server and event stamp
+    the log is split into segments, a new segment is started at each snapshot so that the segments
+    behind it can be removed. each segment has an offset file next to it so that peers can be sent
+    the records they are missing without reading the whole log
+    the newest segment is kept open, appended records are written out by commit and fsynced according to durability
+    """
+
+    ENTRY = struct.Struct("!HQQ") # origin server, event stamp, position of the record in the log
+
+    def __init__(self, prefix, tailSize = LOG_TAIL_SIZE, durability = DURABILITY, fsyncInterval = FSYNC_INTERVAL):
+        self.prefix = prefix
+        self.START = struct.Struct("!" + "Q" * len(SERVER_ADDRESSES.keys())) # stamp of the last record from each server before the segment
+        self.durability = durability
+        self.fsyncInterval = fsyncInterval
+        self.lock = Lock()
+        self.syncLock = Lock() # held while fsyncing, taken before lock
+        self.durable = Condition(self.lock) # notified when synced advances
+        self.appended = Condition(self.lock) # notified when a record is appended
+        self.logFile = None # open handles of the newest segment and its offset file
+        self.indexFile = None
+        self.synced = 0 # position up to which the log has been fsynced
+        self.size = 0 # position after the last complete record, positions continue across segments
+        self.segments = [] # position of the first record in each segment, oldest first
+        self.starts = {} # stamp of the last record from each server before each segment
+        self.compacted = [0 for _ in SERVER_ADDRESSES.keys()] # stamp of the last record from each server that has been removed
+        self.offsets = {key : array("Q") for key in SERVER_ADDRESSES.keys()} # position of every record after compacted
+        self.tail = {key : deque(maxlen = tailSize) for key in SERVER_ADDRESSES.keys()} # (position, record) of the latest records
+        self.load()
+
+    def segmentPath(self, base, extension = "bin"):
+        return F"{self.prefix}_{base:012d}.{extension}"
+
+    def last(self, origin):
+        # stamp of the last record from origin in the log
+        return self.compacted[origin] + len(self.offsets[origin])
+
+    def load(self):
+        # rebuilds the index from the offset files, indexing any records they are missing from the log
+        directory, name = os.path.split(self.prefix)
+        bases = sorted(int(file[len(name) + 1:-4]) for file in os.listdir(directory or ".")
+                       if file.startswith(name + "_") and file.endswith(".bin") and file[len(name) + 1:-4].isdigit())
+
+        if len(bases) == 0:
+            self.rotate(self.compacted)
+        else:
+            for n in range(len(bases)):
+                self.loadSegment(bases[n], first = n == 0, last = n == len(bases) - 1)
+            self.segments = bases
+            self.logFile = open(self.segmentPath(bases[-1]), "ab")
+            self.indexFile = open(self.segmentPath(bases[-1], "idx"), "ab")
+            self.synced = self.size
+
+        if self.durability == "interval":
+            sync_thread = Thread(target=self.sync_loop, daemon=True)
+            sync_thread.start()
+
+    def loadSegment(self, base, first, last):
+        path = self.segmentPath(base)
+        logSize = os.path.getsize(path)
+        entries = b""
+        if os.path.isfile(self.segmentPath(base, "idx")):
+            with open(self.segmentPath(base, "idx"), "rb") as f:
+                entries = f.read()
+
+        if len(entries) >= self.START.size:
+            start = list(self.START.unpack_from(entries))
+            entries = entries[self.START.size:]
+        else:
+            start = [self.last(key) for key in SERVER_ADDRESSES.keys()] # later segments start where the one before ended
+            entries = b""
+        if first:
+            self.compacted = list(start)
+        self.starts[base] = start
+        self.size = base
+
+        with open(path, "rb") as log:
+            indexed = []
+            for i in range(len(entries) // self.ENTRY.size):
+                origin, stamp, position = self.ENTRY.unpack_from(entries, i * self.ENTRY.size)
+                if (len(indexed) > 0 and position <= indexed[-1][2]) or position < base or position - base >= logSize:
+                    break # the offset file was written ahead of a log write that never completed
+                indexed.append((origin, stamp, position))
+
+            while len(indexed) > 0: # the end of the segment is the end of the last complete indexed record
+                log.seek(indexed[-1][2] - base)
+                prefix = log.read(4)
+                if len(prefix) == 4 and indexed[-1][2] - base + 4 + struct.unpack("!I", prefix)[0] <= logSize:
+                    self.size = indexed[-1][2] + 4 + struct.unpack("!I", prefix)[0]
+                    break
+                indexed.pop()
+
+            for origin, stamp, position in indexed:
+                self.index(origin, stamp, position)
+            entries = entries[:len(indexed) * self.ENTRY.size]
+
+            # index records that were logged after the last offset file write
+            log.seek(self.size - base)
+            for record in Command.readRecords(log):
+                origin, stamp = Command.peek(record)
+                self.index(origin, stamp, self.size)
+                entries += self.ENTRY.pack(origin, stamp, self.size)
+                self.size += len(record)
+
+        if last and self.size - base < logSize: # drop a record that was only partly written before a crash
+            with open(path, "r+b") as log:
+                log.truncate(self.size - base)
+        with open(self.segmentPath(base, "idx"), "wb") as f:
+            f.write(self.START.pack(*start) + entries)
+
+    def index(self, origin, stamp, position):
+        if len(self.offsets[origin]) == 0 and stamp > self.compacted[origin] + 1:
+            self.compacted[origin] = stamp - 1 # the records before it were removed without an offset file to say so
+        self.offsets[origin].append(position)
+
+    def append(self, record):
+        origin, stamp = Command.peek(record)
+        with self.lock:
+            position = self.size
+            self.logFile.write(record)
+            self.indexFile.write(self.ENTRY.pack(origin, stamp, position))
+            self.index(origin, stamp, position)
+            self.tail[origin].append((position, record))
+            self.size += len(record)
+            self.appended.notify_all()
+
+    def rotate(self, vector):
+        # starts a new segment, vector must be the stamp of the last record from each server in the log
+        with self.syncLock, self.lock:
+            if self.logFile:
+                self.flush()
+                os.fsync(self.logFile.fileno())
+                self.logFile.close()
+                self.indexFile.close()
+                self.synced = self.size
+                self.durable.notify_all()
+
+            base = self.size
+            self.logFile = open(self.segmentPath(base), "wb")
+            self.indexFile = open(self.segmentPath(base, "idx"), "wb")
+            self.indexFile.write(self.START.pack(*vector))
+            self.indexFile.flush()
+            self.segments.append(base)
+            self.starts[base] = list(vector)
+
+    def flush(self):
+        # writes buffered records out to the operating system, must be called while holding lock
+        self.logFile.flush()
+        self.indexFile.flush()
+
+    def commit(self):
+        # called after a batch of records has been appended, returns once they are as durable as the durability mode requires
+        if self.durability == "batch":
+            self.sync()
+        else:
+            with self.lock:
+                self.flush()
+
+    def sync(self):
+        # fsyncs every record appended so far, the offset file is not fsynced as it is rebuilt from the log after a crash
+        with self.syncLock:
+            with self.lock:
+                self.flush()
+                position = self.size
+                logFile = self.logFile
+            if position > self.synced:
+                os.fsync(logFile.fileno())
+            with self.lock:
+                self.synced = max(self.synced, position)
+                self.durable.notify_all()
+
+    def sync_loop(self):
+        while True:
+            sleep(self.fsyncInterval / 1000)
+            try:
+                self.sync()
+            except Exception as e:
+                print(F"Error syncing log: {e}")
+
+    def waitDurable(self):
+        # blocks until every record appended so far has been fsynced, unless durability is "none"
+        if self.durability == "none":
+            return
+        with self.lock:
+            position = self.size
+            self.durable.wait_for(lambda: self.synced >= position)
+
+    def compact(self, keep):
+        # removes all but the newest keep segments
+        with self.lock:
+            if len(self.segments) <= keep:
+                return
+            removed = self.segments[:-keep]
+            self.segments = self.segments[-keep:]
+            start = self.starts[self.segments[0]]
+            for key in SERVER_ADDRESSES.keys():
+                self.offsets[key] = self.offsets[key][start[key] - self.compacted[key]:]
+            self.compacted = list(start)
+            for base in removed:
+                del self.starts[base]
+
+        for base in removed:
+            os.remove(self.segmentPath(base))
+            os.remove(self.segmentPath(base, "idx"))
+
+    def reset(self, vector):
+        # removes every segment and starts an empty log after vector, used when a snapshot from another server is installed
+        with self.syncLock, self.lock:
+            self.logFile.close()
+            self.indexFile.close()
+            self.logFile = None
+            self.indexFile = None
+            # remove before starting the new segment, which has the same name as the newest one if it is empty
+            for base in self.segments:
+                os.remove(self.segmentPath(base))
+                os.remove(self.segmentPath(base, "idx"))
+            self.segments = []
+            self.starts = {}
+            self.compacted = list(vector)
+            for key in SERVER_ADDRESSES.keys():
+                self.offsets[key] = array("Q")
+                self.tail[key].clear()
+            self.synced = self.size
+        self.rotate(vector)
+
+    def records(self, vector = None):
+        # yields every record in the log with a stamp after vector, in the order they were applied
+        with self.lock:
+            self.flush()
+            segments = list(self.segments)
+        for n in range(len(segments)):
+            base = segments[n]
+            if vector != None and n + 1 < len(segments) and all(start <= stamp for start, stamp in zip(self.starts[segments[n + 1]], vector)):
+                continue # every record in the segment is at or before vector
+            with open(self.segmentPath(base), "rb") as log:
+                for record in Command.readRecords(log):
+                    origin, stamp = Command.peek(record)
+                    if vector == None or stamp > vector[origin]:
+                        yield record
+
+    def since(self, vector):
+        # every record with a stamp after vector[origin], in the order they were applied
+        # None if some of those records have been removed from the log
+        with self.lock:
+            counts = {}
+            for origin in SERVER_ADDRESSES.keys():
+                counts[origin] = self.last(origin) - vector[origin]
+                if counts[origin] > 0 and vector[origin] < self.compacted[origin]:
+                    return None # the peer needs a snapshot
+            selected = self.select(counts)
+        return self.read(*selected)
+
+    def follow(self, position, vector, timeout):
+        # (records, position) of the records logged at or after position, or after vector if position is None
+        # the returned position is where the next record will be logged
+        # waits up to timeout for a record to be logged if there are none, records is None if some of them have been removed
+        with self.lock:
+            if position == None:
+                counts = {}
+                for origin in SERVER_ADDRESSES.keys():
+                    counts[origin] = self.last(origin) - vector[origin]
+                    if counts[origin] > 0 and vector[origin] < self.compacted[origin]:
+                        return None, self.size
+            else:
+                self.appended.wait_for(lambda: self.size > position, timeout)
+                if position < self.segments[0]:
+                    return None, self.size
+                counts = {origin : len(offsets) - bisect_left(offsets, position) for origin, offsets in self.offsets.items()}
+            selected = self.select(counts)
+            end = self.size
+        return self.read(*selected), end
+
+    def select(self, counts):
+        # splits the last counts[origin] records from each origin into those in the tail and those to read from disk
+        # must be called while holding lock
+        self.flush()
+        found = [] # (position, record)
+        missing = [] # positions that have to be read from disk
+        for origin, count in counts.items():
+            if count <= 0:
+                continue
+            tail = self.tail[origin]
+            if count <= len(tail):
+                found.extend(tail[i] for i in range(len(tail) - count, len(tail)))
+            else:
+                missing.extend(self.offsets[origin][len(self.offsets[origin]) - count:])
+        return found, missing, list(self.segments)
+
+    def read(self, found, missing, segments):
+        # adds the records at the missing positions to found, returns all of them in the order they were applied
+        if len(missing) > 0:
+            missing.sort()
+            logs = {}
+            try:
+                for position in missing:
+                    base = segments[bisect_right(segments, position) - 1]
+                    if base not in logs:
+                        logs[base] = open(self.segmentPath(base), "rb")
+                    logs[base].seek(position - base)
+                    prefix = logs[base].read(4)
+                    found.append((position, prefix + logs[base].read(struct.unpack("!I", prefix)[0])))
+            except FileNotFoundError: # the segment was removed by a snapshot since the index was read
+                return None
+            finally:
+                for log in logs.values():
+                    log.close()
+
+        found.sort(key = lambda item: item[0])
+        return [record for _, record in found]
+
+class PendingWrite():
+    # a write waiting in a CommitBatcher to be decided
+
+    def __init__(self, funcName, args, kwargs):
+        self.funcName = funcName
+        self.args = args
+        self.kwargs = kwargs
+        self.stamp = None # event stamp, assigned when the write is proposed
+        self.result = None
+        self.done = False
+
+class CommitBatcher():
+    """
+    collects writes made to this server to rooms in one shard and proposes them together in a single consensus round
+    each shard has its own batcher, so rounds to the leaders of different shards are in flight at the same time
+    """
+
+    def __init__(self, server, shard, window = BATCH_WINDOW, size = BATCH_SIZE):
+        global LOCK
+        self.server = server
+        self.shard = shard
+        self.window = window
+        self.size = max(size, 1)
+        self.pending = []
+        self.proposed = {} # event stamp -> PendingWrite that has been proposed but not yet applied here
+        # the stamps of a round have to be used before later writes from this server can be applied anywhere
+        # a round's stamps are only given to noops once it is known not to have been decided, and always in the same shard,
+        # a round that may still be decided is proposed again unchanged, so that no stamp is decided with two different commands
+        self.unused = [] # stamps of rounds known not to have been decided, proposed again as noops
+        self.resend = [] # records of rounds whose outcome is unknown
+        self.backoff = 0 # seconds to wait before the next round, grows while rounds are not decided
+        # writers already hold LOCK, waiting on it releases the lock so other writers can join the batch
+        self.condition = Condition(LOCK)
+
+        flush_thread = Thread(target=self.flush_loop, daemon=True)
+        flush_thread.start()
+
+    def submit(self, funcName, args, kwargs, wait = True, timeout = COMMIT_TIMEOUT):
+        # must be called while holding LOCK, blocks until the write has been applied or has failed unless wait is False
+        # returns None if the write is not applied within timeout, a write that was already proposed may still be applied later
+        write = PendingWrite(funcName, args, kwargs)
+        self.pending.append(write)
+        self.condition.notify_all()
+        if not wait:
+            return None
+        if not self.condition.wait_for(lambda: write.done, timeout = timeout):
+            print(F"Write {funcName}{args} was not applied within {timeout}s")
+            if write in self.pending:
+                self.pending.remove(write) # never proposed, so it will not be applied
+            return None
+        return write.result
+
+    def complete(self, stamp, result):
+        # called with the result of applying the write with stamp, must be called while holding LOCK
+        # a decided write may only be applied once writes with earlier stamps in other shards have been applied,
+        # so a shard whose rounds are slow delays the writes of this server to every shard, up to COMMIT_TIMEOUT
+        write = self.proposed.pop(stamp, None)
+        if write:
+            write.result = result
+            write.done = True
+            self.condition.notify_all()
+
+    def flush_loop(self):
+        global LOCK
+        with self.condition:
+            while True:
+                self.condition.wait_for(lambda: len(self.pending) > 0 or len(self.unused) > 0 or len(self.resend) > 0)
+                self.condition.wait_for(lambda: False, timeout = self.backoff) # releases LOCK while waiting
+                self.condition.wait_for(lambda: len(self.pending) >= self.size, timeout = self.window)
+
+                # stamps that have since been applied, through a later round or anti-entropy, need no round
+                applied = self.server.vector_stamp[self.server.index]
+                resend = [record for record in self.resend if Command.HEADER.unpack_from(record)[2] > applied]
+                noops = [stamp for stamp in self.unused if stamp > applied]
+                self.resend, self.unused = [], []
+                batch = self.pending[:self.size]
+                self.pending = self.pending[self.size:]
+                for write, stamp in zip(batch, self.server.reserveStamps(len(batch))):
+                    write.stamp = stamp
+                    self.proposed[stamp] = write
+                if len(resend) + len(noops) + len(batch) == 0:
+                    continue
+                records = resend + self.server.batchRecords(batch, noops, self.shard)
+
+                # LOCK is only needed to apply decided commands, release it while the round is in flight
+                LOCK.release()
+                try:
+                    decided = self.server.proposeBatch(records, self.shard)
+                    self.server.log.waitDurable() # only acknowledge writes once they are as durable as configured
+                except Exception as e:
+                    print(F"Error proposing batch: {e}")
+                    decided = None # it may have been decided before the error
+                finally:
+                    LOCK.acquire()
+
+                self.backoff = 0 if decided else min(max(self.backoff * 2, RETRY_BACKOFF), RETRY_BACKOFF_LIMIT)
+                if decided == False:
+                    self.unused.extend(noops + [write.stamp for write in batch])
+                    self.resend.extend(resend) # the rounds they were first proposed in may still be decided
+                    for write in batch:
+                        self.complete(write.stamp, None)
+                elif decided == None:
+                    self.resend.extend(records) # the writes are answered once applied, or when the client stops waiting
+                self.condition.notify_all()
+
+
+class ProposalPipeline():
+    """
+    assigns request numbers to proposals on the leader and commits them in request number order,
+    while allowing up to window proposals to be in flight to the other servers at once
+    """
+
+    def __init__(self, window = PIPELINE_WINDOW):
+        self.window = max(window, 1)
+        self.slots = Semaphore(self.window)
+        self.condition = Condition()
+        self.nextRequestNum = 1
+        self.inFlight = [] # request numbers that have not yet committed or aborted, in order
+        self.sizes = {} # request number -> number of commands of each proposal in flight
+        # followers find missing commands from the count of commands they applied, so the numbers of a proposal that
+        # aborted are handed out again, once the proposals in flight after it have finished, from one past usedEnd
+        self.usedEnd = 1 # one past the last request number of a committed proposal
+        self.resync = False
+
+    def begin(self, size, appliedCount, timeout = TIMEOUT):
+        # reserves request numbers for a proposal of size commands and returns the first one, None if the window stays full
+        # appliedCount() is the number of commands applied in the shard
+        if not self.slots.acquire(timeout = timeout):
+            return None
+
+        with self.condition:
+            # after a resync, wait for the proposals in flight so that every number they hold has been used or given up
+            if not self.condition.wait_for(lambda: not self.resync or len(self.inFlight) == 0, timeout):
+                self.slots.release()
+                return None
+            if self.resync:
+                self.nextRequestNum = self.usedEnd
+                self.resync = False
+            # never reuse numbers of commands that were applied outside of this pipeline (eg. through anti-entropy)
+            self.nextRequestNum = max(self.nextRequestNum, appliedCount() + 1)
+            requestNum = self.nextRequestNum
+            self.nextRequestNum += size
+            self.inFlight.append(requestNum)
+            self.sizes[requestNum] = size
+        return requestNum
+
+    def waitForTurn(self, requestNum, timeout = TIMEOUT):
+        # blocks until every proposal with a lower request number has committed or aborted
+        # returns False if that takes longer than timeout, the proposal must then be aborted
+        with self.condition:
+            return self.condition.wait_for(lambda: self.inFlight[0] == requestNum, timeout)
+
+    def finish(self, requestNum, used = None):
+        # called once a proposal has committed or aborted, used is the number of its request numbers it used if it committed
+        # and None if it aborted, the numbers it did not use are handed out again
+        with self.condition:
+            self.inFlight.remove(requestNum)
+            size = self.sizes.pop(requestNum)
+            if used != None:
+                self.usedEnd = max(self.usedEnd, requestNum + used)
+            self.resync = self.resync or used != size
+            self.condition.notify_all()
+        self.slots.release()
+
+
+class QuorumCollector():
+    """
+    collects the responses of a request sent to every server and wakes the waiting thread
+    as soon as enough responses have arrived to decide the outcome
+    """
+
+    def __init__(self, default = -1, size = None):
+        self.condition = Condition()
+        self.results = [default for _ in range(len(SERVER_ADDRESSES.keys()) if size == None else size)]
+        self.responses = 0
+
+    def record(self, serverIndex, result):
+        with self.condition:
+            self.results[serverIndex] = result
+            self.responses += 1
+            self.condition.notify_all()
+
+    def wait(self, decide, timeout = TIMEOUT):
+        # blocks until decide(results) returns something other than None, every server has responded or the timeout expires
+        # returns the last value of decide(results)
+        outcome = None
+
+        def ready():
+            nonlocal outcome
+            outcome = decide(self.results)
+            return outcome != None or self.responses >= len(self.results)
+
+        with self.condition:
+            self.condition.wait_for(ready, timeout)
+        return outcome
+
+class PeerExecutor():
+    """
+    runs calls to other servers on a bounded set of threads per server instead of starting a thread per call
+    each server has its own queue so a slow server only holds up calls to itself, a call to a server whose
+    queue is full is rejected straight away and the caller counts it as failed, as if the server was unreachable
+    """
+
+    def __init__(self, workers = PEER_WORKERS, queueSize = PEER_QUEUE_SIZE):
+        self.workers = max(workers, 1)
+        self.queueSize = queueSize
+        self.lock = Lock()
+        self.queues = {key : deque() for key in SERVER_ADDRESSES.keys()}
+        self.ready = {key : Condition(self.lock) for key in SERVER_ADDRESSES.keys()} # notified when a call is queued
+        self.started = {key : 0 for key in SERVER_ADDRESSES.keys()} # worker threads, started as they are needed
+        self.idle = {key : 0 for key in SERVER_ADDRESSES.keys()} # workers waiting for a call
+        self.maxDepth = {key : 0 for key in SERVER_ADDRESSES.keys()}
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, serverIndex, func, *args, **kwargs):
+        # queues func(*args, **kwargs) to run on one of serverIndex's workers, returns False if the queue is full
+        with self.lock:
+            queue = self.queues[serverIndex]
+            if len(queue) >= self.queueSize:
+                self.rejected += 1
+                return False
+            queue.append((func, args, kwargs))
+            self.submitted += 1
+            self.maxDepth[serverIndex] = max(self.maxDepth[serverIndex], len(queue))
+            if len(queue) > self.idle[serverIndex] and self.started[serverIndex] < self.workers:
+                self.started[serverIndex] += 1
+                Thread(target=self.worker, args=[serverIndex], daemon=True).start()
+            else:
+                self.ready[serverIndex].notify()
+        return True
+
+    def worker(self, serverIndex):
+        queue = self.queues[serverIndex]
+        while True:
+            with self.lock:
+                self.idle[serverIndex] += 1
+                while len(queue) == 0:
+                    self.ready[serverIndex].wait()
+                self.idle[serverIndex] -= 1
+                func, args, kwargs = queue.popleft()
+
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                print(F"Error in call to server {serverIndex}: {e}")
+
+    def stats(self):
+        # (calls submitted, worker threads started, calls rejected, current queue depth and deepest queue of each server)
+        with self.lock:
+            threads = sum(self.started.values())
+            depths = tuple(len(self.queues[key]) for key in sorted(self.queues.keys()))
+            maxDepths = tuple(self.maxDepth[key] for key in sorted(self.maxDepth.keys()))
+            return (self.submitted, threads, self.rejected, depths, maxDepths)
+
+class PresenceManager():
+    """
+    removes clients of this server that stop polling or writing, using one hashed timer wheel for every room
+    a heartbeat only records the client's new deadline. each tick the wheel checks the clients placed in one slot,
+    moving those heard from since to the slot of their new deadline, so a heartbeat is O(1) and a tick only looks at
+    the clients that may have expired. clients that have expired are handed to onExpire together
+    """
+
+    def __init__(self, onExpire, timeout = PRESENCE_TIMEOUT, tick = PRESENCE_TICK, slots = PRESENCE_SLOTS):
+        self.onExpire = onExpire
+        self.timeout = timeout
+        self.tick = tick
+        self.ticks = max(int(-(-timeout // tick)), 1) # ticks from a heartbeat to the deadline, rounded up
+        self.lock = Lock()
+        self.deadlines = {} # (roomName, user) -> tick after which the client has expired
+        self.wheel = [set() for _ in range(max(slots, 1))]
+        self.current = self.now()
+
+        if timeout > 0:
+            expire_thread = Thread(target=self.expire_loop, daemon=True)
+            expire_thread.start()
+
+    def now(self):
+        return int(time() / self.tick)
+
+    def track(self, roomName, user):
+        # starts timing out a client that joined roomName through this server
+        if self.timeout <= 0:
+            return
+        key = (roomName, user)
+        deadline = self.now() + self.ticks
+        with self.lock:
+            if key not in self.deadlines:
+                self.wheel[deadline % len(self.wheel)].add(key)
+            self.deadlines[key] = deadline
+
+    def heartbeat(self, roomName, user):
+        key = (roomName, user)
+        with self.lock:
+            if key in self.deadlines: # clients that are not tracked, such as those of other servers, are ignored
+                self.deadlines[key] = self.now() + self.ticks
+
+    def forget(self, roomName, user):
+        # called when the client leaves, its entry in the wheel is dropped when its slot is next checked
+        with self.lock:
+            self.deadlines.pop((roomName, user), None)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def advance(self, now):
+        # checks every slot up to tick now, returns the clients that have expired
+        expired = []
+        with self.lock:
+            while self.current < now:
+                self.current += 1
+                index = self.current % len(self.wheel)
+                slot = self.wheel[index]
+                self.wheel[index] = set()
+                for key in slot:
+                    deadline = self.deadlines.get(key)
+                    if deadline == None: # left or moved to another slot that has already seen it
+                        continue
+                    if deadline <= self.current:
+                        del self.deadlines[key]
+                        expired.append(key)
+                    else:
+                        self.wheel[deadline % len(self.wheel)].add(key)
+        return expired
+
+    def expire_loop(self):
+        while True:
+            sleep(self.tick)
+            expired = self.advance(self.now())
+            if len(expired) > 0:
+                try:
+                    self.onExpire(expired)
+                except Exception as e:
+                    print(F"Error removing inactive clients: {e}")
+
+class ReorderBuffer():
+    """
+    holds commands that arrived before the commands preceding them from the same server,
+    keyed by origin and event stamp so that the next command to run is found directly
+    """
+
+    def __init__(self, limit = REORDER_LIMIT):
+        self.limit = limit
+        self.pending = {key : {} for key in SERVER_ADDRESSES.keys()} # origin -> {stamp : Command}
+
+    def add(self, command, applied):
+        # buffers command until the commands between applied and it have run
+        # returns False if it is already buffered or more than limit commands ahead
+        pending = self.pending[command.origin]
+        if command.stamp in pending or command.stamp - applied > self.limit:
+            return False
+        pending[command.stamp] = command
+        return True
+
+    def pop(self, origin, stamp):
+        # removes and returns the command from origin with stamp, None if it has not arrived
+        return self.pending[origin].pop(stamp, None)
+
+    def discard(self, origin, applied):
+        # drops the commands from origin at or before applied, eg. when a snapshot including them is installed
+        pending = self.pending[origin]
+        for stamp in [stamp for stamp in pending.keys() if stamp <= applied]:
+            del pending[stamp]
+
+    def __len__(self):
+        return sum(len(pending) for pending in self.pending.values())
+
+class RWLock():
+    """
+    lets any number of readers hold the lock at once, or a single writer
+    waiting writers block new readers so that a room being polled constantly can still be written to
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.readers = 0
+        self.writing = False
+        self.waitingWriters = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writing and self.waitingWriters == 0)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.waitingWriters += 1
+            self.condition.wait_for(lambda: not self.writing and self.readers == 0)
+            self.waitingWriters -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+def isMajority(count):
+    return count > len(SERVER_ADDRESSES.keys()) / 2
+
+
 ### Decorator function ###
 def write_function(func):
     # Handles all of the additional code that should be run for each write to the server
@@ -53,34 +1027,24 @@ def write_function(func):
         receivingServer = int(kwargs.pop('receivingServer', self.index))
         fromOwnLog = kwargs.pop('fromOwnLog', False)
         decided = kwargs.pop('decided', False)
+        wait = kwargs.pop('wait', True)
 
         if not decided and receivingServer == self.index:
-            cmdString = F"{receivingServer}|{self.vector_stamp[receivingServer] + 1}|{func.__name__}|{args}|{json.dumps(kwargs)}"
-            print(F"Proposing: {cmdString}")
-            returnVal = self.proposeCmd(cmdString, int(receivingServer))
-
-            if type(returnVal) == ResultCode:
-                if returnVal.value >= 100:
-                    if self.adjustLeaderToMajority():
-                        returnVal = self.proposeCmd(cmdString, int(receivingServer), secondPass=True)
-
-            if type(returnVal) == ResultCode:
-                return None
-            return returnVal
+            # queue the write so that it can be proposed together with any other concurrent writes to the same shard
+            self.presence.heartbeat(args[1], args[0])
+            return self.batchers[self.shardOf(args[1])].submit(func.__name__, args, kwargs, wait)
         
         elif decided:
-            self.vector_stamp[receivingServer] += 1
+            record = kwargs.pop('record')
+            with self.stampLock:
+                self.vector_stamp[receivingServer] += 1
+                self.digests[receivingServer] = zlib.crc32(record, self.digests[receivingServer])
+            self.shardCounts[self.shardOf(args[1])] += 1 # every write function takes the room as its second argument
             if not fromOwnLog: # save command to disk
                 event_stamp = self.vector_stamp[receivingServer]
-                cmdString = F"{receivingServer}|{event_stamp}|{func.__name__}|{args}|{json.dumps(kwargs)}"
-                with open(F"server{self.index}_log.txt", "a") as myfile:
-                    myfile.write(cmdString + '\n')
-
-                print(F"Write function Called: {receivingServer}|{event_stamp}|{func.__name__}|{args}|{json.dumps(kwargs)}")
+                self.log.append(record)
 
-                if receivingServer == self.index : # share cmd to all other servers
-                    t = Thread(target = self.serverShareCmd, args = [cmdString], daemon=True)
-                    t.start()
+                print(F"Write function Called: {receivingServer}|{event_stamp}|{func.__name__}|{args}|{kwargs}")
 
             return func(self, *args, **kwargs)
         
@@ -89,180 +1053,430 @@ def write_function(func):
 
     return inner
 
+# immutable state of a chatroom published after every write, read without taking any lock
+# messages are the last ROOM_VIEW_SIZE (id, user, message, likeCount) of count messages in total, participants is a frozenset
+RoomView = namedtuple("RoomView", ["version", "messages", "count", "participants"])
+UNCHANGED = "unchanged" # answer to a read given the version tag of the room as it still is
+
+class MessageStore():
+    """
+    the messages of a chatroom as [id, user, message, likes, timestamp, likeCount] entries in timestamp order
+    likes maps each user that liked or unliked the message to the (timestamp, value) of their latest change
+    entries are split into chunks of up to twice chunkSize, with the timestamps of each chunk and the newest
+    timestamp of every chunk kept alongside, so an insert bisects to its place and only shifts the entries of one chunk
+    entries are also kept by message id for likes, messages with the same timestamp stay in the order they arrived
+    """
+
+    def __init__(self, entries = (), chunkSize = MESSAGE_CHUNK_SIZE):
+        self.chunkSize = max(chunkSize, 1)
+        entries = sorted(entries, key = lambda entry: entry[4]) # stable, so a list that is already in order is unchanged
+        self.chunks = [entries[i:i + self.chunkSize] for i in range(0, len(entries), self.chunkSize)]
+        self.keys = [[entry[4] for entry in chunk] for chunk in self.chunks] # timestamps of the entries in each chunk
+        self.maxes = [keys[-1] for keys in self.keys] # newest timestamp in each chunk
+        self.ids = {}
+        for entry in entries:
+            self.ids.setdefault(entry[0], entry)
+        self.size = len(entries)
+
+    def insert(self, entry):
+        # adds entry after every message with the same or an earlier timestamp, returns the id of the message before it or None
+        timestamp = entry[4]
+        before = None
+        if self.size == 0:
+            self.chunks, self.keys, self.maxes = [[entry]], [[timestamp]], [timestamp]
+        else:
+            i = min(bisect_right(self.maxes, timestamp), len(self.maxes) - 1) # newer than every message goes at the end of the last chunk
+            chunk, keys = self.chunks[i], self.keys[i]
+            j = bisect_right(keys, timestamp)
+            if j > 0:
+                before = chunk[j - 1][0]
+            elif i > 0:
+                before = self.chunks[i - 1][-1][0]
+            chunk.insert(j, entry)
+            keys.insert(j, timestamp)
+            self.maxes[i] = keys[-1]
+            if len(chunk) >= self.chunkSize * 2:
+                self.chunks[i:i + 1] = [chunk[:self.chunkSize], chunk[self.chunkSize:]]
+                self.keys[i:i + 1] = [keys[:self.chunkSize], keys[self.chunkSize:]]
+                self.maxes[i:i + 1] = [keys[self.chunkSize - 1], keys[-1]]
+        self.ids.setdefault(entry[0], entry)
+        self.size += 1
+        return before
+
+    def get(self, id):
+        return self.ids.get(id)
+
+    def copyChunks(self):
+        # shallow copies of the chunks, later inserts do not change them but changes to the entries in them show
+        return [list(chunk) for chunk in self.chunks]
+
+    def copyEntry(self, id):
+        # replaces the entry of the message with id with a copy of it and returns the copy, for changes that copies
+        # of the chunks must not see, None if there is no such message
+        location = self.locate(id)
+        if location == None:
+            return None
+        i, j = location
+        entry = self.chunks[i][j]
+        copy = entry[:3] + [dict(entry[3])] + entry[4:]
+        self.chunks[i][j] = copy
+        self.ids[id] = copy
+        return copy
+
+    def tail(self, count):
+        # the newest count entries, oldest first
+        entries = []
+        for chunk in reversed(self.chunks):
+            if len(entries) >= count:
+                break
+            entries[:0] = chunk[-(count - len(entries)):]
+        return entries
+
+    def locate(self, id):
+        # (chunk, index) of the message with id, None if there is none
+        entry = self.ids.get(id)
+        if entry == None:
+            return None
+        timestamp = entry[4]
+        for i in range(bisect_left(self.maxes, timestamp), len(self.chunks)): # messages with the same timestamp may span chunks
+            keys = self.keys[i]
+            for j in range(bisect_left(keys, timestamp), len(keys)):
+                if self.chunks[i][j] is entry:
+                    return (i, j)
+                if keys[j] != timestamp:
+                    return None
+        return None
+
+    def before(self, id, count):
+        # up to count entries just before the message with id, oldest first, the newest count if id is None
+        # None if there is no message with id
+        if id == None:
+            return self.tail(count)
+        position = self.locate(id)
+        if position == None:
+            return None
+        i, j = position
+        entries = self.chunks[i][max(j - count, 0):j]
+        while len(entries) < count and i > 0:
+            i -= 1
+            entries[:0] = self.chunks[i][-(count - len(entries)):]
+        return entries
+
+    def after(self, id, count):
+        # up to count entries just after the message with id, oldest first, the oldest count if id is None
+        # None if there is no message with id
+        i, j = 0, 0
+        if id != None:
+            position = self.locate(id)
+            if position == None:
+                return None
+            i, j = position[0], position[1] + 1
+        entries = []
+        while len(entries) < count and i < len(self.chunks):
+            entries += self.chunks[i][j:j + count - len(entries)]
+            i, j = i + 1, 0
+        return entries
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
 class Chatroom():
     
     def __init__(self, name):
-        self.participants = []
-        self.participantHeartbeats = {}
-        self.messages = []
+        self.participants = set()
+        self.messages = MessageStore()
         self.name = name
-        
-
-        purge_thread = Thread(target=self.purge, daemon=True) 
-        purge_thread.start()
-
-    def purge(self):
-        # Removes inactive users from chatroom as determined by last heartbeat
-        timeout = 1
-        while True:
-            sleep(timeout)
-            now = time()
-            for user in self.participants:
-                if self.participantHeartbeats[user] and self.participantHeartbeats[user] - now > timeout:
-                    self.remove_chatter(user)
+        self.lock = RWLock() # writes to the room and reads of messages that are not in its view
+        self.view = RoomView(0, (), 0, frozenset())
+        self.chatterList = (self.view.participants, ()) # participants of a view and the sorted tuple of them, built when first listed
+        self.watchers = set() # callbacks run once when the next view is published
+        self.watchLock = Lock() # guards watchers and snapshots
+        self.epoch = os.urandom(4).hex() # cursors given out by another server, or before a restart, are not read as this room's
+        self.changes = (1, []) # version of the first change kept and the changes that published each later version, oldest first
+        self.snapshots = 0 # snapshots being written that hold this room's messages, likes copy a message before changing it while there are any
+
+    def publish(self, change = None, participantsChanged = False):
+        # replaces the view of the room, must be called while holding the write lock
+        # the participants are only copied when they have changed, other writes reuse the previous view's
+        # change describes the write to clients reading changes, None if it cannot be described and clients must be sent the room's state
+        messages = tuple((id, user, message, likeCount) for id, user, message, _, _, likeCount in self.messages.tail(ROOM_VIEW_SIZE))
+        participants = frozenset(self.participants) if participantsChanged else self.view.participants
+        version = self.view.version + 1
+        first, changes = self.changes
+        if change == None:
+            self.changes = (version + 1, [])
+        elif len(changes) >= ROOM_CHANGE_LOG * 2: # replaced rather than trimmed in place, readers may be slicing it
+            self.changes = (version - ROOM_CHANGE_LOG + 1, changes[len(changes) - ROOM_CHANGE_LOG + 1:] + [change])
+        else:
+            changes.append(change) # appended before the view is replaced, so every change up to a view's version is there when it is read
+        self.view = RoomView(version, messages, len(self.messages), participants)
+        with self.watchLock:
+            watchers, self.watchers = self.watchers, set()
+        for callback in watchers:
+            callback()
+
+    def watch(self, version, callback):
+        # runs callback once the room has published a view other than version, straight away if it already has
+        # callback is run while the room's write lock is held so it must not block
+        with self.watchLock:
+            if self.view.version == version:
+                self.watchers.add(callback)
+                return
+        callback()
+
+    def unwatch(self, callback):
+        with self.watchLock:
+            self.watchers.discard(callback)
 
     def add_chatter(self, username):
-        self.participants.append((username))
-        self.participantHeartbeats[username] = time()
-        self.participants = sorted(self.participants)
+        with self.lock.write():
+            self.participants.add(username)
+            self.publish(("joined", username), participantsChanged = True)
         return True
 
     def remove_chatter(self, username):
-        self.participantHeartbeats[username] = None
-        if username in self.participants:
-            self.participants.remove(username)
-            return True
+        with self.lock.write():
+            if username in self.participants:
+                self.participants.discard(username)
+                self.publish(("left", username), participantsChanged = True)
+                return True
         return False
 
-    def newMessage(self, user, message, timestamp, messageid):
-        timestamp = datetime.datetime.strptime(str(timestamp), '%Y-%m-%d %H:%M:%S.%f')
-
-        data = [messageid, user, message, [], timestamp]
-        done = False
-        # insert in order
-        for i in range(len(self.messages)): 
-            if self.messages[i][4] > timestamp:
-                self.messages.insert(i, data)
-                done = True
-                break
+    def get_chatters(self):
+        # sorted tuple of the participants, only sorted again after they have changed
+        participants, chatters = self.chatterList
+        view = self.view
+        if participants is not view.participants:
+            chatters = tuple(sorted(view.participants))
+            self.chatterList = (view.participants, chatters)
+        return chatters
 
-        if done == False:
-            self.messages.append(data)
+    def newMessage(self, user, message, timestamp, messageid):
+        timestamp = datetime.datetime.fromisoformat(str(timestamp)) # str() drops the fraction when microseconds are 0
 
-    def heartbeat(self, user):
-        # used for keeping track of last time a user polled chatroom 
-        self.participantHeartbeats[user] = time()
+        data = [messageid, user, message, {}, timestamp, 0]
+        with self.lock.write():
+            before = self.messages.insert(data) # in timestamp order
+            self.publish(("message", before, (messageid, user, message, 0)))
 
     def get_messages(self, user, number):
-
-        self.heartbeat(user)
-
-        if number == -1: # return all messages
-            val = []
-            for id, user, message, likes, _ in self.messages:
-                likeCount = self.sumLikes(likes)
-                val.append((id, user, message, likeCount))
-            return val
-
-        if len(self.messages) <= number: #asking for more messages than exist, return all existing messages
-            val = []
-            for id, user, message, likes, _ in self.messages:
-                likeCount = self.sumLikes(likes)
-                val.append((id, user, message, likeCount))
-            return val
-
-        val = [] # return (number) most recent messages
-        for id, user, message, likes, _ in self.messages[-number:]:
-            likeCount = self.sumLikes(likes)
-            val.append((id, user, message, likeCount))
-        return val
+        # returns a tuple of (id, user, message, likeCount) for the (number) most recent messages, or all of them if number is -1
+        view = self.view
+        if number != -1 and number <= len(view.messages):
+            return view.messages[-number:]
+        if view.count == len(view.messages): # asking for more messages than exist, return all existing messages
+            return view.messages
+
+        with self.lock.read(): # older messages are only kept in self.messages
+            return tuple((id, user, message, likeCount) for id, user, message, _, _, likeCount in (self.messages if number == -1 else self.messages.tail(number)))
+
+    def inView(self, number):
+        # whether get_messages(number) is answered from the published view without taking the lock
+        view = self.view
+        return (number != -1 and number <= len(view.messages)) or view.count == len(view.messages)
+
+    def get_history(self, before, after, limit):
+        # a page of up to limit (id, user, message, likeCount), oldest first, just before the message with id before,
+        # or just after the message with id after, the newest page if neither is given
+        # None if that message is not in the room
+        with self.lock.read():
+            if after != None:
+                entries = self.messages.after(after, limit)
+            else:
+                entries = self.messages.before(before, limit)
+            if entries == None:
+                return None
+            return tuple((id, user, message, likeCount) for id, user, message, _, _, likeCount in entries)
+
+    def get_changes(self, cursor, number):
+        # returns (cursor, changes, None, None, None) with the changes published since cursor, oldest first, each one of
+        # ("message", id of the message before it or None, (id, user, message, likeCount)), ("likes", id, likeCount),
+        # ("joined", user) or ("left", user)
+        # if cursor is None or the changes since it are no longer kept, returns (cursor, None, messages, chatters, count)
+        # with the (number) most recent messages instead
+        view = self.view # read before the changes, they always reach at least this version
+        first, changes = self.changes
+        version = self.cursorVersion(cursor)
+        if version != None and first - 1 <= version <= view.version:
+            return ((self.epoch, view.version), tuple(changes[version + 1 - first : view.version + 1 - first]), None, None, None)
+
+        with self.lock.read(): # no write can publish while the state is read
+            view = self.view
+            if number != -1 and number <= len(view.messages):
+                messages = view.messages[-number:]
+            else:
+                messages = tuple((id, user, message, likeCount) for id, user, message, _, _, likeCount in (self.messages if number == -1 else self.messages.tail(number)))
+            return ((self.epoch, view.version), None, messages, self.get_chatters(), view.count)
+
+    def changesKept(self, cursor):
+        # whether get_changes(cursor) is answered from the published changes without taking the lock
+        first, _ = self.changes
+        version = self.cursorVersion(cursor)
+        return version != None and first - 1 <= version <= self.view.version
+
+    def versionTag(self):
+        # tag of the room's current version for conditional reads, tags from another server or before a restart never match
+        return F"{self.epoch}:{self.view.version}"
+
+    def cursorVersion(self, cursor):
+        # version of the room a cursor from get_changes was given at, None if it was not given by this room
+        if cursor == None:
+            return None
+        epoch, version = cursor
+        return version if epoch == self.epoch else None
 
     def likeMessage(self, user, messageid, timestamp, value = True):
-        msg = self.getMessageByID(messageid)
-        for i in range(len(msg[3])):
-            cUser, cTimestamp, cVal = msg[3][i]
-
-            if user == cUser:
-                if cVal == value: # overwritting existing like with newer timestamp
-                    msg[3][i] = (user, timestamp, value)
+        with self.lock.write():
+            msg = self.messages.copyEntry(messageid) if self.snapshots > 0 else self.getMessageByID(messageid)
+            likes = msg[3]
+            if user in likes:
+                cTimestamp, cVal = likes[user]
+                if timestamp <= cTimestamp: # an older like or unlike is ignored, so the result does not depend on the order they are applied in
                     return False
 
-                elif cVal != value: # prior removed like
-                    if cTimestamp < timestamp: # new like is more recent than removal
-                        msg[3][i] = (user, timestamp, value)
-                        return True
-                    else:
-                        return False
+                likes[user] = (timestamp, value) # the newer like or unlike replaces the existing one
+                if cVal == value: # the like count does not change
+                    return False
+                msg[5] += 1 if value else -1
+                self.publish(("likes", messageid, msg[5]))
+                return True
 
-        msg[3].append((user, timestamp, value))
-        return True
+            likes[user] = (timestamp, value)
+            if value: # an unlike from a user who had not liked the message does not change the count
+                msg[5] += 1
+                self.publish(("likes", messageid, msg[5]))
+            return True
 
     def unlikeMessage(self, user, messageid, timestamp):
         # exact same as likeMessage code, just store a different value
         self.likeMessage(user, messageid, timestamp, value = False)
 
-    def sumLikes(self, likes):
-        sum = 0
-        for _, _, value in likes:
-            if value == True:
-                sum += 1
-        return sum
+    @classmethod
+    def upgradeEntry(cls, entry):
+        # messages in snapshots taken before likes were kept by user hold a list of (user, timestamp, value) and no count
+        if type(entry[3]) == list:
+            entry[3] = {user : (timestamp, value) for user, timestamp, value in entry[3]}
+            entry.append(sum(1 for _, value in entry[3].values() if value))
+        return entry
     
     def getMessageByID(self, id):
-        for message in self.messages:
-            if message[0] == id:
-                return message
+        return self.messages.get(id)
 
 class Server():
     """
     manages all chatroooms, and forwarding RPCs to chatrooms when appropriate
     """
 
-    def __init__(self, index):
+    def __init__(self, index, poolSize = POOL_SIZE, batchWindow = BATCH_WINDOW, batchSize = BATCH_SIZE, pipelineWindow = PIPELINE_WINDOW, snapshotInterval = SNAPSHOT_INTERVAL, durability = DURABILITY, fsyncInterval = FSYNC_INTERVAL, shards = SHARDS, peerWorkers = PEER_WORKERS, presenceTimeout = PRESENCE_TIMEOUT):
         self.index = index
+        self.shards = shards if shards > 0 else len(SERVER_ADDRESSES.keys())
+        self.connections = ServerConnectionPool(poolSize)
+        self.peers = PeerExecutor(peerWorkers) # runs the calls that are fanned out to every server
+        self.presence = PresenceManager(self.expireClients, presenceTimeout) # clients of this server that have stopped polling leave their rooms
+        self.nextStamp = 0 # event stamp of the next write proposed by this server
+        self.batchers = [CommitBatcher(self, shard, batchWindow, batchSize) for shard in range(self.shards)]
+        self.log = CommandLog(F"server{self.index}_log", durability = durability, fsyncInterval = fsyncInterval)
+        self.convertTextLog(F"server{self.index}_log.txt")
+        self.pipelines = [ProposalPipeline(pipelineWindow) for _ in range(self.shards)]
+        self.snapshotPath = F"server{self.index}_snapshot.pickle"
+        self.snapshotInterval = snapshotInterval
+        self.snapshotVector = [0 for _ in range(len(SERVER_ADDRESSES.keys()))] # vector_stamp of the snapshot on disk
+        self.snapshotLock = Lock()
         self.clear_terminal = False
         self.display_status = False
-        self.chatrooms = []
-        self.messagesToProcess = {}
+        self.chatrooms = {} # room name -> Chatroom, in the order the rooms were created
+        self.reorder = ReorderBuffer()
         self.vector_stamp = [0 for _ in range(len(SERVER_ADDRESSES.keys()))]
+        self.digests = [0 for _ in range(len(SERVER_ADDRESSES.keys()))] # crc32 of the commands applied from each server, in stamp order
+        self.stampLock = Lock() # held while vector_stamp and digests are changed together, so that a digest is never read between them
         self.clients_on_other_servers = [[] for _ in range(len(SERVER_ADDRESSES.keys()))]
-        self.hidden_clients = [[] for _ in range(len(SERVER_ADDRESSES.keys()))]
+        self.hidden_clients = [set() for _ in range(len(SERVER_ADDRESSES.keys()))] # (user, roomName) of clients of each unreachable server
         self.my_clients = []
-        self.current_leader = 0
-        self.pendingProposals = {}
-        self.pendingNewLeader = None
-        self.proposalLock = Lock()
-
-        for key in SERVER_ADDRESSES.keys():
-            self.messagesToProcess[key] = []
-
-        if os.path.isfile(F"server{self.index}_log.txt"):
+        servers = sorted(SERVER_ADDRESSES.keys())
+        self.leaders = [servers[shard % len(servers)] for shard in range(self.shards)] # leadership starts spread across every server
+        self.shardCounts = [0 for _ in range(self.shards)] # commands applied in each shard, proposals in a shard are numbered after them
+        self.pendingProposals = [{} for _ in range(self.shards)]
+        self.pendingNewLeader = [None for _ in range(self.shards)]
+        self.proposalLocks = [Lock() for _ in range(self.shards)]
+        self.followers = {} # position in the commit stream of each shard acknowledged by each server following this one
+        self.catchingUp = set() # servers that missing commands are being fetched from
+
+        if self.log.size > 0 or os.path.isfile(self.snapshotPath):
             t = Thread(target=self.recoverFromCrash)
             t.start()
+        else:
+            self.startSnapshots()
 
         for key in SERVER_ADDRESSES.keys():
+            if key == self.index:
+                continue
             t = Thread(target=self.anti_entropy, args=[key])
             t.start()
             
 
         receive_thread = Thread(target=self.update_loop, daemon=True) 
         receive_thread.start()
+
+        for shard in range(self.shards):
+            replication_thread = Thread(target=self.replication_loop, args=[shard], daemon=True)
+            replication_thread.start()
+
+    def convertTextLog(self, path):
+        # rewrites a pipe delimited log written by earlier versions as binary records, so it is recovered from as before
+        # the text log is kept as <path>.converted, a server whose binary log already has records refuses to convert it
+        if not os.path.isfile(path):
+            return
+        if self.log.size > 0:
+            raise RuntimeError(F"both {path} and a binary log exist, remove {path} if the binary log already holds its commands")
+
+        records = []
+        with open(path, "r") as myfile:
+            for number, line in enumerate(myfile, 1):
+                line = line.replace("\n", "")
+                if line == "":
+                    continue
+                try:
+                    receivingServer, event_stamp, func, args, kwargs = line.split("|")
+                    args = eval(args, {"datetime" : datetime, "__builtins__" : {}}) # written as repr() of the args, timestamps as datetime.datetime(...)
+                    records.append(Command(int(receivingServer), int(event_stamp), func, args, json.loads(kwargs)).record)
+                except Exception as e:
+                    raise RuntimeError(F"cannot convert line {number} of {path}, fix or remove it before starting: {e}")
+
+        for record in records:
+            self.log.append(record)
+        self.log.sync()
+        os.replace(path, path + ".converted")
+        print(F"Converted {len(records)} commands from {path} to the binary log")
+
+    def shardOf(self, roomName):
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(str(roomName).encode("utf-8")) % self.shards
         
 
     def recoverFromCrash(self):
         sleep(0.1)
         
-        self.adjustLeaderToMajority()
+        for shard in range(self.shards):
+            self.adjustLeaderToMajority(shard)
 
         try:
-            # rerun all commands in log file
-            if os.path.isfile(F"server{self.index}_log.txt"):
-                with open(F"server{self.index}_log.txt", "r") as myfile:
-                    msgs = myfile.readlines()
-
-                for msg in msgs:
-                    self.processCmdString(msg.replace('\n', ''), fromOwnLog=True)
-                    
+            # load the latest snapshot and rerun the commands logged after it
+            self.restoreState()
+            self.startSnapshots()
 
-            
-            self.serverDataGet(self.current_leader)
+            for leader in set(self.leaders):
+                self.serverDataGet(leader)
 
             
 
             # restore all hidden clients
             if os.path.isfile(F"Server_{self.index}_hidden_clients.pickle"):
                 with open(F"Server_{self.index}_hidden_clients.pickle", 'rb') as f:
-                    self.hidden_clients = pickle.load(f)
+                    self.hidden_clients = [set(clients) for clients in pickle.load(f)] # saved as lists by earlier versions
 
             # run a leave event for all clients that were connected at time of crash so other servers know they are not partitioned/coming back
             if os.path.isfile(F"Server_{self.index}_clients.pickle"):
@@ -279,7 +1493,7 @@ class Server():
 
             sleep(1)
             print("cahtroom participants...")
-            for cr in self.chatrooms:
+            for cr in self.chatrooms.values():
                 print(cr.participants)
 
             print("Recovered from crash, vector_stamp:", self.vector_stamp)
@@ -288,151 +1502,365 @@ class Server():
             # in the event of a failure allow the server to continue running rather than an immediate crash
             print(F"Error occured while recovering from crash:", e)
 
-    def serverDataGet(self, otherServerIndex, requireLock = True):
-        global LOCK
-        # get all unknown information from another server
-        if otherServerIndex != self.index:
-            address, port = SERVER_ADDRESSES[otherServerIndex].split(":", 1)
-            conn = rpc.connect(address, port)
-
-            newMessages, otherPendingProposals = conn.root.exposed_getServerData(self.vector_stamp)
-            otherPendingProposals = dict(json.loads(otherPendingProposals))
-            for key, value in otherPendingProposals.items():
-                otherPendingProposals[key] = [datetime.datetime.strptime(str(otherPendingProposals[key][0]), '%Y-%m-%d %H:%M:%S.%f')] + otherPendingProposals[key][1:]
+    def restoreState(self):
+        # loads the snapshot on disk and replays the commands logged after it
+        with LOCK:
+            if os.path.isfile(self.snapshotPath):
+                with open(self.snapshotPath, "rb") as f:
+                    self.snapshotVector = self.loadSnapshot(pickle.load(f))
+            for record in self.log.records(list(self.vector_stamp)):
+                self.processCmd(record, fromOwnLog=True)
+
+    def startSnapshots(self):
+        if self.snapshotInterval > 0:
+            t = Thread(target=self.snapshot_loop, daemon=True)
+            t.start()
 
-            if requireLock:
-                with LOCK:
-                    for message in newMessages:
-                        self.processCmdString(message)
-            else:
-                for message in newMessages:
-                        self.processCmdString(message)
+    def snapshot_loop(self):
+        # snapshots the chatrooms every snapshotInterval applied commands
+        while True:
+            sleep(1)
+            if sum(self.vector_stamp) - sum(self.snapshotVector) >= self.snapshotInterval:
+                try:
+                    self.takeSnapshot()
+                except Exception as e:
+                    print(F"Error taking snapshot: {e}")
 
-            for key, value in otherPendingProposals.items():
-                if key not in self.pendingProposals:
-                    self.pendingProposals[key] = value
+    def takeSnapshot(self):
+        # saves the chatrooms to disk and removes the log segments that are no longer needed to recover
+        # only references to the state are taken while holding LOCK, it is pickled and written after releasing it
+        with LOCK:
+            captured = self.captureState()
+            vector = list(self.vector_stamp)
+            self.log.rotate(vector) # commands after the snapshot go in a new segment
+
+        state = self.serializeState(captured)
+        with self.snapshotLock:
+            with open(self.snapshotPath + ".tmp", 'wb') as f:
+                f.write(state)
+            os.replace(self.snapshotPath + ".tmp", self.snapshotPath)
+            self.snapshotVector = vector
+
+        # keep the segment before the snapshot so that servers that are only a little behind are still sent commands
+        self.log.compact(keep = 2)
+        print(F"Snapshot taken at vector_stamp: {vector}, {len(state)} bytes")
+
+    def captureState(self):
+        # the replicated state without copying the messages, must be called while holding LOCK
+        # until the state is passed to serializeState, the rooms copy a message before changing its likes instead of changing it
+        rooms = []
+        for room in self.chatrooms.values():
+            with room.watchLock: # the count is also lowered by snapshots being written without LOCK
+                room.snapshots += 1
+            rooms.append((room, frozenset(room.participants), room.messages.copyChunks()))
+        return {"vector_stamp" : list(self.vector_stamp), "digests" : list(self.digests), "shard_counts" : list(self.shardCounts),
+                "clients_on_other_servers" : [list(clients) for clients in self.clients_on_other_servers], "chatrooms" : rooms}
+
+    def serializeState(self, state):
+        # pickles a state returned by captureState, can be called without holding LOCK
+        rooms = []
+        try:
+            for room, participants, chunks in state["chatrooms"]:
+                rooms.append((room.name, sorted(participants), [entry for chunk in chunks for entry in chunk]))
+            return pickle.dumps(dict(state, chatrooms = rooms))
+        finally:
+            for room, _, _ in state["chatrooms"]:
+                with room.watchLock:
+                    room.snapshots -= 1
+
+    def loadSnapshot(self, state):
+        # replaces the replicated state with one unpickled from serializeState, returns its vector_stamp
+        chatrooms = {}
+        for name, participants, messages in state["chatrooms"]:
+            room = self.getRoom(name) or Chatroom(name) # existing rooms are kept so readers holding them see the new state
+            with room.lock.write():
+                room.participants = set(participants)
+                room.messages = MessageStore([Chatroom.upgradeEntry(entry) for entry in messages])
+                room.publish(participantsChanged = True)
+            chatrooms[name] = room
+
+        self.chatrooms = chatrooms
+        self.clients_on_other_servers = state["clients_on_other_servers"]
+        with self.stampLock:
+            self.vector_stamp = state["vector_stamp"]
+            self.digests = state.get("digests", [0 for _ in range(len(SERVER_ADDRESSES.keys()))])
+        self.shardCounts = list(state.get("shard_counts", [0 for _ in range(self.shards)]))
+        for key in SERVER_ADDRESSES.keys(): # drop buffered commands that the snapshot already includes
+            self.reorder.discard(key, self.vector_stamp[key])
+        return list(self.vector_stamp)
+
+    def installSnapshot(self, data):
+        # replaces the state with a snapshot sent by another server and starts a new log after it
+        # must be called while holding LOCK
+        state = pickle.loads(data)
+        vector = list(state["vector_stamp"])
+        if vector == self.vector_stamp:
+            return True # nothing to install, the commands after it can still be applied
+        if any(vector[key] < self.vector_stamp[key] for key in SERVER_ADDRESSES.keys()):
+            print(F"Not installing snapshot at {vector}, it is missing commands that have been applied here {self.vector_stamp}")
+            return False
 
+        self.loadSnapshot(state)
+        with self.snapshotLock:
+            with open(self.snapshotPath + ".tmp", 'wb') as f:
+                f.write(data)
+            os.replace(self.snapshotPath + ".tmp", self.snapshotPath)
+            self.snapshotVector = vector
+        self.log.reset(vector)
+        print(F"Installed snapshot at vector_stamp: {vector}")
+        return True
 
-            conn.close() 
+    def serverDataGet(self, otherServerIndex, requireLock = True):
+        global LOCK
+        # get all unknown information from another server
+        if otherServerIndex != self.index:
+            with self.connections.connect(otherServerIndex) as conn:
+
+                response = conn.root.exposed_getServerData(self.digest())
+                if response == None: # already in sync
+                    return
+                newMessages, otherPendingProposals, snapshot = response
+                otherPendingProposals = json.loads(otherPendingProposals) # one dict for each shard
+                for proposals in otherPendingProposals:
+                    for key, value in proposals.items():
+                        proposals[key] = [datetime.datetime.fromisoformat(str(value[0]))] + value[1:]
+
+                if requireLock:
+                    with LOCK:
+                        if snapshot == None or self.installSnapshot(snapshot):
+                            for message in newMessages:
+                                self.processCmd(message)
+                            self.log.commit()
+                else:
+                    if snapshot == None or self.installSnapshot(snapshot):
+                        for message in newMessages:
+                            self.processCmd(message)
+                        self.log.commit()
+
+                for shard, proposals in enumerate(otherPendingProposals[:self.shards]):
+                    for key, value in proposals.items():
+                        if int(key) not in self.pendingProposals[shard]: # json turns the request numbers into strings
+                            self.pendingProposals[shard][int(key)] = value
                        
+    def digest(self):
+        # constant size summary of the commands applied here, equal on servers that have applied the same commands
+        with self.stampLock:
+            return (tuple(self.vector_stamp), zlib.crc32(struct.pack(F"!{len(self.digests)}I", *self.digests)))
+
+    def inSync(self, otherDigest):
+        # can be called without holding LOCK, the vector and digests are read together
+        vector, digest = self.digest()
+        if tuple(otherDigest[0]) != vector:
+            return False
+        if otherDigest[1] != digest:
+            # the servers hold different commands for the same stamps, this is a bug to fix where the commands were decided
+            # rather than something anti-entropy can repair, so it is reported every round until the servers are restored
+            print(F"WARNING: diverged from another server, both applied the commands up to vector_stamp {vector} but the digests differ")
+            return False
+        return True
+
     def serverDataGive(self, otherVector):
         # give all info to server that occurred after otherVector
-        filtered_msgs = []
-        if os.path.isfile(F"server{self.index}_log.txt"):
-            with open(F"server{self.index}_log.txt", "r") as myfile:
-                msgs = myfile.readlines()
-            
-            for msg in msgs:
-                receivingServer, event_stamp, func, args, kwargs = msg.replace("\n", "").split("|")
-                if otherVector[int(receivingServer)] < int(event_stamp):
-                    filtered_msgs.append(msg)
-
-        pendingProposals = self.pendingProposals
-        for key,value in pendingProposals.items(): # prepare data from sending
-            pendingProposals[key][0] = str(pendingProposals[key][0])
-
-        returnVal = (filtered_msgs, json.dumps(pendingProposals))
+        filtered_msgs = self.log.since(tuple(otherVector))
+        snapshot = None
+        if filtered_msgs == None:
+            # commands the other server is missing have been removed from the log, send the snapshot and the commands after it
+            with self.snapshotLock:
+                with open(self.snapshotPath, 'rb') as f:
+                    snapshot = f.read()
+                filtered_msgs = self.log.since(self.snapshotVector) or []
+
+        # copy rather than convert in place, proposals are received on the leader while this runs
+        pendingProposals = []
+        for proposals in self.pendingProposals: # prepare data from sending
+            pendingProposals.append({key : [str(value[0])] + value[1:] for key, value in list(proposals.items())})
+
+        return (tuple(filtered_msgs), json.dumps(pendingProposals), snapshot) # a tuple of bytes is sent by value rather than as a netref
+
+    def serverShareCmd(self, cmd, proposalID = None, existingConn = None, connServer = None, shard = 0):
+        # only the requesting server is sent the commands directly, every other server receives them through the commit stream
+        if type(cmd) == bytes:
+            cmd = (cmd,)
+
+        if existingConn and connServer != self.index:
+            # the requesting server is blocked on existingConn, share synchronously while it is still serving callbacks
+            try:
+                existingConn.root.exposed_processCmdBatch(cmd, proposalID = proposalID, shard = shard)
+            except Exception as e:
+                print(F"Error in serverShareCmd on {connServer}: {e}")
+
+    def streamCommands(self, follower, position, vector, timeout = STREAM_TIMEOUT, shard = 0):
+        # the commit stream of a shard, returns (records, position) of the commands to its rooms logged at or after position, waiting up to timeout for new ones
+        # position is the one returned by the follower's previous request, which acknowledges the commands sent with it
+        # a follower without a position starts after its vector, records is None if the follower needs a snapshot
+        if position != None:
+            self.followers[(follower, shard)] = position
+        end = time() + timeout
+        while True:
+            records, position = self.log.follow(position, vector, max(end - time(), 0))
+            if records == None:
+                return (None, position)
+            records = tuple(record for record in records if self.shardOf(Command.room(record)) == shard)
+            if len(records) > 0 or time() >= end: # keep waiting through records to other shards
+                return (records, position)
+
+    def replication_loop(self, shard):
+        # follows the commit stream of the leader of shard, resuming from the last position received after a disconnect
+        leader = None
+        position = None
+        while True:
+            if self.leaders[shard] == self.index:
+                leader = None
+                sleep(TIMEOUT)
+                continue
 
-        for key,value in pendingProposals.items(): # return data to previous state
-            pendingProposals[key][0] = datetime.datetime.strptime(str(pendingProposals[key][0]), '%Y-%m-%d %H:%M:%S.%f')
+            if self.leaders[shard] != leader: # positions are only meaningful in the log they came from
+                leader = self.leaders[shard]
+                position = None
 
-        return returnVal
+            try:
+                with self.connections.connect(leader) as conn:
+                    records, position = conn.root.exposed_streamCommands(self.index, position, tuple(self.vector_stamp), shard = shard)
 
-    def serverShareCmd(self, cmd, proposalID = None, existingConn = None, connServer = None):
-        for key, value in SERVER_ADDRESSES.items():
-            t = Thread(target = self._serverShareCmdHelper, args = [key, value, cmd, proposalID, existingConn, connServer])
-            t.start()
+                if records == None: # the commands have been removed from the leader's log
+                    self.serverDataGet(leader)
+                elif len(records) > 0:
+                    with LOCK:
+                        self.processCmdBatch(records)
 
-    def _serverShareCmdHelper(self, key, value, cmd, proposalID = None, existingConn = None, connServer = None):
-        try:
-            if key == self.index: return
-            if connServer and existingConn and existingConn == key:
-                print("_serverShareCmdHelper existingConn", connServer)
-                existingConn.root.exposed_processCmdString(cmd, proposalID = proposalID, withLock = False)
-            else:
-                address, port = value.split(":", 1)
-                conn = rpc.connect(address, port)
-                conn.root.exposed_processCmdString(cmd, proposalID = proposalID)
-                conn.close()
-        except Exception as e:
-            print(F"Error in serverShareCmd on {key}: {e}")
+            except Exception as e:
+                print(F"Error following commit stream of shard {shard} from {leader}: {e}")
+                sleep(TIMEOUT)
+
+    def reserveStamps(self, count):
+        # event stamps for count new writes, must be called while holding LOCK
+        # writes to different shards are proposed at the same time, so stamps are handed out before earlier ones are applied
+        stamp = max(self.nextStamp, self.vector_stamp[self.index] + 1)
+        self.nextStamp = stamp + count
+        return list(range(stamp, stamp + count))
+
+    def shardRoom(self, shard):
+        # a room name in shard, for noops that are not proposed together with a write to a room
+        i = 0
+        while self.shardOf(F"noop{i}") != shard:
+            i += 1
+        return F"noop{i}"
+
+    def batchRecords(self, batch, noops, shard):
+        # the records of a list of PendingWrites to rooms in shard, after noops for the stamps in noops
+        room = batch[0].args[1] if len(batch) > 0 else self.shardRoom(shard)
+        cmds = []
+        for stamp in noops:
+            cmds.append(Command(self.index, stamp, "noop", (None, room), {}).record)
+        for write in batch:
+            if 'messageid' in write.kwargs and write.kwargs['messageid'] == None:
+                # message ids are derived from the event stamp, which is only known once the batch is assembled
+                write.kwargs['messageid'] = F"{self.index}_{write.stamp - 1}"
+            command = Command(self.index, write.stamp, write.funcName, write.args, write.kwargs)
+            print(F"Proposing: {command}")
+            cmds.append(command.record)
+        return cmds
+
+    def proposeBatch(self, records, shard):
+        # proposes records to rooms in shard as one round, the result of each write is given to its batcher once it is applied
+        # returns True if the round was decided, False if it is known not to have been, and None if its outcome is unknown
+        cmds = tuple(records)
+        returnVal = self.proposeCmd(cmds, self.index, shard = shard)
+
+        if type(returnVal) == ResultCode:
+            if returnVal.value >= 100:
+                if self.adjustLeaderToMajority(shard):
+                    returnVal = self.proposeCmd(cmds, self.index, secondPass=True, shard = shard)
+
+        if type(returnVal) == tuple:
+            return True
+        if type(returnVal) == ResultCode and returnVal.value == 5:
+            return None
+        return False
 
-    def proposeCmd(self, cmd, receivingServer, conn = None, secondPass = False):
+    def proposeCmd(self, cmd, receivingServer, conn = None, secondPass = False, shard = 0):
+        # cmd is a tuple of encoded Commands to rooms in shard that are proposed and decided together
+        # must be called without holding LOCK, it is acquired to apply the commands once decided
+        # a follower returns ResultCode(5) if the leader it sent cmd to did not answer and may still decide it
+        global LOCK
         proposeAgain = False
-        with self.proposalLock:
+        unknown = False
 
-            if secondPass: # the requesting server has asked all other servers who the majority leader is and is asking again
+        if secondPass: # the requesting server has asked all other servers who the majority leader is and is asking again
+            with self.proposalLocks[shard]:
                 print("proposing again")
-                self.adjustLeaderToMajority()
-
-            if self.current_leader == self.index: # share to other servers
-                print(F"Sharing propose : {cmd}")
-                resultsLock = Lock()
-                results = [-1 for key in SERVER_ADDRESSES.keys()]
-                for key, value in SERVER_ADDRESSES.items():
-                    t = Thread(target = self.proposeCmdShare, args = [key, sum(self.vector_stamp) + 1, cmd, self.index, results, resultsLock, conn, receivingServer])
-                    t.start()
-
-                for i in range(10):
-                    accepted_servers = 0
-                    failed_servers = 0
-                    notLeaderresults = 0
-                    with resultsLock:
-                        for result in results:
-                            if type(result) == ResultCode and result.value == 0:
-                                accepted_servers += 1
-
-                            elif type(result) == ResultCode and result.value == 1: # server is no longer leader
-                                notLeaderresults += 1
-
-                            elif type(result) == ResultCode and result.value > 0:
-                                failed_servers += 1
+                self.adjustLeaderToMajority(shard)
 
-                        
-                    if accepted_servers > len(SERVER_ADDRESSES.keys()) / 2:
-                        print("proposal passes")
-                        self.serverShareCmd(cmd, proposalID=sum(self.vector_stamp) + 1, existingConn = conn, connServer=receivingServer)
-                        return self.processCmdString(cmd, proposalID=sum(self.vector_stamp) + 1)
-                    
-                    elif failed_servers > len(SERVER_ADDRESSES.keys()) / 2:
-                        print(F"propose failed: {results}")
-                        return None
-                    
-                    elif receivingServer == self.index and notLeaderresults > len(SERVER_ADDRESSES.keys()) / 2:
-                        print(F"propose failed: {results}")
-                        proposeAgain = True if secondPass == False else False # adjust to new leader and propose
+        if self.leaders[shard] == self.index: # share to other servers
+            requestNum = self.pipelines[shard].begin(len(cmd), lambda: self.shardCounts[shard])
+            if requestNum == None:
+                print(F"propose failed: too many proposals in flight")
+                return None if receivingServer == self.index else ResultCode(4)
 
-                    elif receivingServer != self.index and notLeaderresults > len(SERVER_ADDRESSES.keys()) / 2:
-                        print(F"propose failed: {results}")
-                        return ResultCode(1)
+            used = None # request numbers used by the proposal once it commits
+            try:
+                print(F"Sharing propose {requestNum} in shard {shard}: {len(cmd)} commands")
+                quorum = QuorumCollector()
+                for key in SERVER_ADDRESSES.keys():
+                    if not self.peers.submit(key, self.proposeCmdShare, key, requestNum, cmd, self.index, quorum, conn, receivingServer, shard):
+                        quorum.record(key, ResultCode(4))
+
+                outcome = quorum.wait(self.proposalOutcome)
+
+                if outcome == "accepted":
+                    print(F"proposal {requestNum} in shard {shard} passes")
+                    if not self.pipelines[shard].waitForTurn(requestNum): # commit in request number order
+                        print(F"proposal {requestNum} in shard {shard} aborted, earlier proposals did not finish in time")
+                        return None if receivingServer == self.index else ResultCode(4)
+                    with LOCK:
+                        # commands that were already applied, eg. proposed again after a round whose outcome was unknown, are not counted
+                        fresh = sum(1 for record in cmd if Command.HEADER.unpack_from(record)[2] > self.vector_stamp[Command.HEADER.unpack_from(record)[1]])
+                        returnVal = self.processCmdBatch(cmd, proposalID=requestNum, shard=shard) # apply before sharing so echoed commands are recognised as duplicates
+                    used = fresh
+                    self.serverShareCmd(cmd, proposalID=requestNum, existingConn = conn, connServer=receivingServer, shard=shard)
+                    return returnVal
 
-                    sleep(TIMEOUT / 10)
-                print(F"propose timed out, results: {results}")
-                if receivingServer == self.index:
+                elif outcome == "failed":
+                    print(F"propose failed: {quorum.results}")
                     return None
+
+                elif outcome == "notLeader" and receivingServer == self.index:
+                    print(F"propose failed: {quorum.results}")
+                    proposeAgain = True if secondPass == False else False # adjust to new leader and propose
+
+                elif outcome == "notLeader":
+                    print(F"propose failed: {quorum.results}")
+                    return ResultCode(1)
+
                 else:
-                    return ResultCode(4)
-                
+                    print(F"propose timed out, results: {quorum.results}")
+                    if receivingServer == self.index:
+                        return None
+                    else:
+                        return ResultCode(4)
+
+            finally:
+                self.pipelines[shard].finish(requestNum, used)
+
+            if proposeAgain:
+                return self.proposeCmd(cmd, receivingServer, conn, secondPass=True, shard=shard)
+            return None
 
-            elif receivingServer == self.index: # have leader share with other servers
+        with self.proposalLocks[shard]:
+
+            if receivingServer == self.index: # have leader share with other servers
                 
                 try:
-                    print(F"propose to leader {self.current_leader}: {cmd}".replace('\n', ''))
-                    resultsLock = Lock()
-                    results = [] # easiest way to pass variable by reference rather than value
-                    returnVal = None
-                    t = Thread(target = self._proposeCmdHelper, args = [cmd, receivingServer, results, resultsLock], kwargs={"secondPass":secondPass})
-                    t.start()
-                    for i in range(10):
-                        with resultsLock:
-                            if len(results) > 0:
-                                returnVal = results[0]
-                                break
-                        sleep(TIMEOUT/10)
-                    
-                    
-
-                    if len(results) == 0:
+                    print(F"propose to leader {self.leaders[shard]} of shard {shard}: {len(cmd)} commands")
+                    response = QuorumCollector(size = 1) # only waiting on the leader
+                    if not self.peers.submit(self.leaders[shard], self._proposeCmdHelper, cmd, receivingServer, response, secondPass=secondPass, shard=shard):
+                        raise Exception("too many calls queued")
+                    # the leader may wait up to TIMEOUT each for a pipeline slot, its quorum and earlier proposals to commit
+                    response.wait(lambda results: None, timeout = TIMEOUT * 3)
+                    returnVal = response.results[0]
+
+                    if returnVal == -1:
+                        unknown = True # the leader may have received cmd and still decide it
                         raise Exception("no response within timeout")
                     
                     elif type(returnVal) == ResultCode and returnVal.value == 1:
@@ -445,48 +1873,68 @@ class Server():
 
                     return returnVal
                 except Exception as e:
-                    print(F"failed to propose to leader {self.current_leader}: {e}, holding election")
-                    if self.becomeLeader():
+                    print(F"failed to propose to leader {self.leaders[shard]} of shard {shard}: {e}, holding election")
+                    if self.becomeLeader(shard):
                         proposeAgain = True if secondPass == False else False
                         
 
 
             
             else:
-                return ResultCode(100 + self.current_leader)
+                return ResultCode(100 + self.leaders[shard])
             
         if proposeAgain:
-            return self.proposeCmd(cmd, receivingServer, conn, secondPass=True)
+            returnVal = self.proposeCmd(cmd, receivingServer, conn, secondPass=True, shard=shard)
+            if unknown and type(returnVal) != tuple:
+                return ResultCode(5) # proposing again failed, but the first leader may still decide cmd
+            return returnVal
+        if unknown:
+            return ResultCode(5)
         
-    def _proposeCmdHelper(self, cmd, receivingServer, results, resultsLock, secondPass = False):
-        address, port = SERVER_ADDRESSES[self.current_leader].split(":", 1)
-        conn = rpc.connect(address, port, service=Connection)
-
+    def _proposeCmdHelper(self, cmd, receivingServer, response, secondPass = False, shard = 0):
         returnVal = -1
         try:
-            returnVal = conn.root.exposed_proposeCmd(cmd, receivingServer, secondPass=secondPass)
+            with self.connections.connect(self.leaders[shard]) as conn:
+                returnVal = conn.root.exposed_proposeCmd(cmd, receivingServer, secondPass=secondPass, shard=shard)
 
         finally:
-            with resultsLock:
-                if returnVal != -1:
-                    results.append(returnVal)
-            conn.close() 
+            response.record(0, returnVal) # -1 wakes the proposer immediately if the leader could not be reached
 
         return returnVal
+
+    def proposalOutcome(self, results):
+        # decides a proposal from the ResultCodes collected so far, None while undecided
+        accepted_servers = 0
+        failed_servers = 0
+        notLeaderresults = 0
+        for result in results:
+            if type(result) == ResultCode and result.value == 0:
+                accepted_servers += 1
+
+            elif type(result) == ResultCode and result.value == 1: # server is no longer leader
+                notLeaderresults += 1
+
+            elif type(result) == ResultCode and result.value > 0:
+                failed_servers += 1
+
+        if isMajority(accepted_servers):
+            return "accepted"
+        elif isMajority(failed_servers):
+            return "failed"
+        elif isMajority(notLeaderresults):
+            return "notLeader"
+        return None
         
-    def proposeCmdShare(self, targetServer, requestNum, cmd, requestingServer, results, resultsLock, ExistingConn, initiatingServer):
+    def proposeCmdShare(self, targetServer, requestNum, cmd, requestingServer, quorum, ExistingConn, initiatingServer, shard = 0):
         if targetServer != self.index:
-            address, port = SERVER_ADDRESSES[targetServer].split(":", 1)
-            print(F"address, port: {address, port}")
             try:
                 if targetServer != initiatingServer:
-                    conn = rpc.connect(address, port)
-                    returnVal = conn.root.exposed_recieiveProposal(requestNum, cmd, requestingServer)
-                    returnVal = ResultCode(returnVal) # store value in local copy so that connection can be closed
-                    conn.close()
+                    with self.connections.connect(targetServer) as conn:
+                        returnVal = conn.root.exposed_recieiveProposal(requestNum, cmd, requestingServer, shard = shard)
+                        returnVal = ResultCode(returnVal) # store value in local copy so that connection can be returned to the pool
                 else:
                     print("exisiting conn:", type(ExistingConn))
-                    returnVal = ExistingConn.root.exposed_recieiveProposal(requestNum, cmd, requestingServer, withLock=False)
+                    returnVal = ExistingConn.root.exposed_recieiveProposal(requestNum, cmd, requestingServer, shard = shard)
                     returnVal = ResultCode(returnVal)
                     print("exisiting conn done")
             except Exception as e:
@@ -495,70 +1943,81 @@ class Server():
             
 
         else:
-            returnVal = self.recieiveProposal(requestNum, cmd, requestingServer)
+            returnVal = self.recieiveProposal(requestNum, cmd, requestingServer, shard)
             returnVal = ResultCode(returnVal)
 
-        with resultsLock:
-            results[targetServer] = returnVal
+        quorum.record(targetServer, returnVal)
 
         return returnVal
 
-    def recieiveProposal(self, requestNum, cmd, requestingServer):
+    def recieiveProposal(self, requestNum, cmd, requestingServer, shard = 0):
         # returns a ResultCode enum
 
-        print(F"recived proposal: {cmd}")
-        if requestNum > sum(self.vector_stamp) + 1:
-            self.serverDataGet(requestingServer, requireLock=False)
+        print(F"recived proposal {requestNum} in shard {shard}: {len(cmd)} commands")
+        pendingProposals = self.pendingProposals[shard]
+        if requestNum > self.shardCounts[shard] + 1 and not any(num < requestNum for num in list(pendingProposals.keys())):
+            # missing commands that are not explained by earlier proposals still in flight
+            # fetched in the background, the leader of another shard may be waiting on this server's LOCK in turn
+            self.catchUp(requestingServer)
         
-        if requestingServer != self.current_leader:
+        if requestingServer != self.leaders[shard]:
             returnVal = 1 #ResultCode(1)
         
-        elif requestNum <= sum(self.vector_stamp):
+        elif requestNum <= self.shardCounts[shard]:
             returnVal = 2 #ResultCode(2)
 
-        elif requestNum in self.pendingProposals and (datetime.datetime.now() - self.pendingProposals[requestNum][0]).total_seconds() < 1:
+        elif requestNum in pendingProposals and pendingProposals[requestNum][1] != requestingServer and (datetime.datetime.now() - pendingProposals[requestNum][0]).total_seconds() < 1:
             returnVal = 3 #ResultCode(3)
 
         else:
-            self.pendingProposals[requestNum] = [datetime.datetime.now(), requestingServer]
+            pendingProposals[requestNum] = [datetime.datetime.now(), requestingServer]
             returnVal = 0 #ResultCode(0)
 
         return returnVal
 
-    def becomeLeader(self):
-        resultsLock = Lock()
-        results = [0 for key in SERVER_ADDRESSES.keys()]
+    def catchUp(self, serverIndex):
+        # runs serverDataGet from serverIndex in a thread, unless one is already running
+        if serverIndex in self.catchingUp:
+            return
+        self.catchingUp.add(serverIndex)
+
+        def run():
+            try:
+                self.serverDataGet(serverIndex)
+            except Exception as e:
+                print(F"Error catching up from {serverIndex}: {e}")
+            finally:
+                self.catchingUp.discard(serverIndex)
+
+        Thread(target=run, daemon=True).start()
+
+    def becomeLeader(self, shard):
+        # holds an election for the leadership of shard, only the shards whose leader is unreachable change leader
+        votes = QuorumCollector(default = 0)
         for i in SERVER_ADDRESSES.keys():
-            t = Thread(target = self._becomeLeaderHelperPropose, args = [i, results, resultsLock])
-            t.start()
+            if not self.peers.submit(i, self._becomeLeaderHelperPropose, i, votes, shard):
+                votes.record(i, 0)
         
-        for i in range(20):
-            with resultsLock:
-                if sum(results) > len(SERVER_ADDRESSES.keys()) / 2:
-                    print("election results (pass):", results)
-                    for i in SERVER_ADDRESSES.keys():
-                        t = Thread(target = self._becomeLeaderHelperElect, args = [i])
-                        t.start()
-                    return True
-            sleep(TIMEOUT/10)
-
-        print("election results (fail):", results)
+        if votes.wait(lambda results: True if isMajority(sum(results)) else None, timeout = TIMEOUT * 2):
+            print(F"election results for shard {shard} (pass):", votes.results)
+            for i in SERVER_ADDRESSES.keys():
+                self.peers.submit(i, self._becomeLeaderHelperElect, i, shard)
+            return True
+
+        print(F"election results for shard {shard} (fail):", votes.results)
         return False
 
-    def _becomeLeaderHelperPropose(self, serverIndex, results, resultsLock):
-        address, port = SERVER_ADDRESSES[serverIndex].split(":", 1)
+    def _becomeLeaderHelperPropose(self, serverIndex, votes, shard = 0):
         try:
             if serverIndex == self.index:
-                proposalAccepted = self.newLeaderProposal(None, self.index)
+                proposalAccepted = self.newLeaderProposal(None, self.index, shard)
             else:
-                conn = rpc.connect(address, port)
-                proposalAccepted = conn.root.exposed_newLeaderProposal(self.index)
-                conn.close()
+                with self.connections.connect(serverIndex) as conn:
+                    proposalAccepted = conn.root.exposed_newLeaderProposal(self.index, shard = shard)
             
             if proposalAccepted:
-                self.serverDataGet(serverIndex, requireLock = False)
-                with resultsLock:
-                    results[serverIndex] = 1
+                self.serverDataGet(serverIndex)
+                votes.record(serverIndex, 1)
                 return True
             else:
                 print("election rejected on server:", serverIndex)
@@ -566,131 +2025,145 @@ class Server():
 
         except Exception as e:
             print(F"proposal failed in server: {serverIndex}, with error: {e}")
+            votes.record(serverIndex, 0)
             return False
         
-    def _becomeLeaderHelperElect(self, serverIndex):
-        address, port = SERVER_ADDRESSES[serverIndex].split(":", 1)
-
+    def _becomeLeaderHelperElect(self, serverIndex, shard = 0):
         try:
             if serverIndex == self.index:
-                self.newLeaderElected(None, self.index)
+                self.newLeaderElected(None, self.index, shard)
             else:
-                conn = rpc.connect(address, port)
-                conn.root.exposed_newLederElected(self.index)
-                conn.close()
+                with self.connections.connect(serverIndex) as conn:
+                    conn.root.exposed_newLederElected(self.index, shard = shard)
 
         except Exception as e:
             print(F"elect failed in server: {serverIndex}, with error: {e}")
             return False
         
-    def newLeaderProposal(self, conn, newLeaderIndex):
-        print("newLeaderProposal:", newLeaderIndex)
+    def newLeaderProposal(self, conn, newLeaderIndex, shard = 0):
+        print(F"newLeaderProposal for shard {shard}:", newLeaderIndex)
         now = datetime.datetime.now()
-        if self.pendingNewLeader == None or (now - self.pendingNewLeader[0]).total_seconds() > TIMEOUT * 2 or self.pendingNewLeader[1] == newLeaderIndex:
-            self.pendingNewLeader = (now, newLeaderIndex)
+        pending = self.pendingNewLeader[shard]
+        if pending == None or (now - pending[0]).total_seconds() > TIMEOUT * 2 or pending[1] == newLeaderIndex:
+            self.pendingNewLeader[shard] = (now, newLeaderIndex)
             return True
         
         return False
     
-    def newLeaderElected(self, conn, newLeaderIndex):
-        print("new leader elected:", newLeaderIndex)
-        self.current_leader = newLeaderIndex
+    def newLeaderElected(self, conn, newLeaderIndex, shard = 0):
+        print(F"new leader elected for shard {shard}:", newLeaderIndex)
+        self.leaders[shard] = newLeaderIndex
 
-    def adjustLeaderToMajority(self):
-        print("adjustLeaderToMajority")
+    def adjustLeaderToMajority(self, shard):
+        print(F"adjustLeaderToMajority for shard {shard}")
         returnVal = False
-        resultsLock = Lock()
-        results = [-1 for key in SERVER_ADDRESSES.keys()]
+        leaders = QuorumCollector()
         for i in SERVER_ADDRESSES.keys():
-            t = Thread(target = self._adjustLeaderToMajorityHelper, args = [i, results, resultsLock])
-            t.start()
+            if not self.peers.submit(i, self._adjustLeaderToMajorityHelper, i, leaders, shard):
+                leaders.record(i, -1)
 
-        for _ in range(10):
-            with resultsLock:
-                for i in range(len(results)):
-                    sum = 0
-                    for j in range(i, len(results)):
-                        
-                        if results[i] == results[j] and results[i] != -1:
-                            sum += 1
-
-                    if sum > len(results) / 2: # the majority of servers think server:{i} is the leader
-                        self.current_leader = i
-                        print("adjustLeaderToMajority set new leader:", i)
-                        returnVal = True
-                        break
-            if returnVal:
-                break
-            else:
-                sleep(TIMEOUT/10)
+        leader = leaders.wait(self.majorityLeader)
+        if leader != None: # the majority of servers think server:{leader} is the leader
+            self.leaders[shard] = leader
+            print(F"adjustLeaderToMajority set new leader of shard {shard}:", leader)
+            returnVal = True
 
         if not returnVal:       
             print("adjustLeaderToMajority could not determine leader")
         print("adjustLeaderToMajority completed")
         return returnVal
 
-    def _adjustLeaderToMajorityHelper(self, serverIndex, results, resultsLock):
-        address, port = SERVER_ADDRESSES[serverIndex].split(":", 1)
+    def majorityLeader(self, results):
+        # the leader reported by the majority of servers, None if there is no majority yet
+        for leader in set(results):
+            if leader != -1 and isMajority(results.count(leader)):
+                return leader
+        return None
 
+    def _adjustLeaderToMajorityHelper(self, serverIndex, leaders, shard = 0):
         try:
-            conn = rpc.connect(address, port)
-            leader = conn.root.exposed_getLeader()
-            conn.close()
+            with self.connections.connect(serverIndex) as conn:
+                leader = conn.root.exposed_getLeader(shard)
 
-            with resultsLock:
-                results[serverIndex] = leader
+            leaders.record(serverIndex, leader)
             return leader
 
         except Exception as e:
             print(F"getLeader failed in server: {serverIndex}, with error: {e}")
+            leaders.record(serverIndex, -1)
             return -1
 
-    def processCmdString(self, cmd, fromOwnLog = False, depth = 0, proposalID = None):
-        print("processing cmd string", cmd)
-        # run an RPC that was stored to a string
-        receivingServer, event_stamp, func, args, kwargs = cmd.replace("\n", "").split("|")
-        #only run if it is the next command for a given server, otherwise save it for later
-        if int(event_stamp) == self.vector_stamp[int(receivingServer)] + 1:
+    def processCmd(self, cmd, fromOwnLog = False, proposalID = None, shard = 0):
+        # run a write stored as an encoded Command, cmd is either the record or an already decoded Command
+        command = cmd if type(cmd) == Command else Command.decode(cmd)
+        print("processing cmd", command)
+        receivingServer = command.origin
+        if command.stamp <= self.vector_stamp[receivingServer]:
+            return None # already applied, commands can arrive both from the leader and the commit stream
 
-            if proposalID:
-                self.pendingProposals.pop(proposalID)
+        #only run if it is the next command for a given server, otherwise save it for later
+        if command.stamp != self.vector_stamp[receivingServer] + 1:
+            self.reorder.add(command, self.vector_stamp[receivingServer])
+            return None
 
-            args = eval(args)
-            kwargs = json.loads(kwargs)
-            kwargs['decided'] = True
+        if proposalID:
+            self.pendingProposals[shard].pop(proposalID, None)
 
-            func = getattr(self, func)
-            
-            
+        try:
+            return self.runCmd(command, fromOwnLog)
+        finally:
+            # run the commands from the same server that were waiting for this one, one after another rather than recursively
+            command = self.reorder.pop(receivingServer, self.vector_stamp[receivingServer] + 1)
+            while command != None:
+                try:
+                    self.runCmd(command)
+                except Exception as e:
+                    print(F"Error running buffered command {command}: {e}")
+                command = self.reorder.pop(receivingServer, self.vector_stamp[receivingServer] + 1)
+
+    def runCmd(self, command, fromOwnLog = False):
+        # applies a decoded Command that is the next one from its origin
+        receivingServer = command.origin
+        args = command.args
+        kwargs = dict(command.kwargs)
+        kwargs['decided'] = True
+        kwargs['record'] = command.record
+
+        func = getattr(self, command.funcName)
+
+        if func == self.join:
+            _ = kwargs.pop('otherServer', None)
+            self.clients_on_other_servers[receivingServer].append((args[0], args[1]))
+            returnVal = func(*args, **kwargs, otherServer = receivingServer, receivingServer = receivingServer, fromOwnLog = fromOwnLog)
+
+        elif func == self.leave:
+            _ = kwargs.pop('otherServer', None)
+            if (args[0], args[1]) in self.clients_on_other_servers[receivingServer]:
+                self.clients_on_other_servers[receivingServer].remove((args[0], args[1]))
+            returnVal = func(*args, **kwargs, otherServer = receivingServer, receivingServer = receivingServer, fromOwnLog = fromOwnLog)
+        else:
+            returnVal = func(*args, **kwargs, receivingServer = receivingServer, fromOwnLog = fromOwnLog)
 
-            if func == self.join:
-                _ = kwargs.pop('otherServer', None)
-                self.clients_on_other_servers[int(receivingServer)].append((args[0], args[1]))
-                returnVal = func(*args, **kwargs, otherServer = int(receivingServer), receivingServer = receivingServer, fromOwnLog = fromOwnLog)
+        if receivingServer == self.index and not fromOwnLog: # answer the client that made the write
+            self.batchers[self.shardOf(args[1])].complete(command.stamp, returnVal)
 
-            elif func == self.leave:
-                _ = kwargs.pop('otherServer', None)
-                if (args[0], args[1]) in self.clients_on_other_servers[int(receivingServer)]:
-                    self.clients_on_other_servers[int(receivingServer)].remove((args[0], args[1]))
-                returnVal = func(*args, **kwargs, otherServer = int(receivingServer), receivingServer = receivingServer, fromOwnLog = fromOwnLog)
-            else:
-                returnVal = func(*args, **kwargs, receivingServer = receivingServer, fromOwnLog = fromOwnLog)
-
-            messagesToStillProcess = []
-            messagesToProcess = self.messagesToProcess
-            for message in messagesToProcess[int(receivingServer)]:
-                # try and run other commands waiting to be processed
-                self.messagesToProcess[int(receivingServer)].remove(message)
-                if not self.processCmdString(message, depth = depth+1):
-                    messagesToStillProcess.append(message)
+        return returnVal
 
-            self.messagesToProcess[int(receivingServer)] = messagesToStillProcess
+    def processCmdBatch(self, cmds, fromOwnLog = False, proposalID = None, shard = 0):
+        # run a batch of commands decided in a single round, returns the result of each command
+        # proposalID is the request number of the round in shard
+        returnVals = []
+        for cmd in cmds:
+            returnVals.append(self.processCmd(cmd, fromOwnLog = fromOwnLog, proposalID = proposalID, shard = shard))
+            proposalID = None # the proposal is removed when the first command is run
 
-            return returnVal
+        # commands from the commit stream do not carry their proposal, remove every proposal that has been applied
+        for shard, pendingProposals in enumerate(self.pendingProposals):
+            for requestNum in [num for num in pendingProposals.keys() if num <= self.shardCounts[shard]]:
+                pendingProposals.pop(requestNum, None)
 
-        else:
-            self.messagesToProcess[int(receivingServer)].append(cmd)
-            return None
+        self.log.commit() # one write and fsync for the whole batch
+        return tuple(returnVals)
 
     def anti_entropy(self, key):
         # get and process data from other servers
@@ -699,14 +2172,14 @@ class Server():
             try:
                 self.serverDataGet(key)
                 # re-add all users where were removed due to loss of connection
-                with LOCK:
-                    if len(self.hidden_clients[key]) != 0:
-                        print(f"adding clients from key {key}:", list(set(self.hidden_clients[key])))
-                        for user, roomName in list(set(self.hidden_clients[int(key)])):
+                if len(self.hidden_clients[key]) != 0:
+                    with LOCK:
+                        print(f"adding clients from key {key}:", list(self.hidden_clients[key]))
+                        for user, roomName in self.hidden_clients[int(key)]:
                             room = self.getRoom(roomName)
                             room.add_chatter(user)
                             
-                        self.hidden_clients[key] = []
+                        self.hidden_clients[key] = set()
                         with open(F"Server_{self.index}_hidden_clients.pickle", 'wb') as f:
                             pickle.dump(self.hidden_clients, f)
 
@@ -715,24 +2188,17 @@ class Server():
                 # remove users who are connected to unreachable servers, store in a list to re-add if server reconnects
                 with LOCK:
                     for user, roomName in self.clients_on_other_servers[int(key)]:
-                        self.hidden_clients[int(key)].append((user, roomName))
-                        self.hidden_clients[int(key)] = list(set(self.hidden_clients[int(key)])) # remove duplicates
+                        self.hidden_clients[int(key)].add((user, roomName))
                         with open(F"Server_{self.index}_hidden_clients.pickle", 'wb') as f: # save to disk in case of crash
                             pickle.dump(self.hidden_clients, f)
                         room = self.getRoom(roomName)
                         room.remove_chatter(user)
 
 
-            sleep(1)
+            sleep(ANTI_ENTROPY_INTERVAL)
 
     def getRoom(self, roomName):
-        if roomName == None: return None
-
-        for room in self.chatrooms:
-            if room.name == roomName:
-                return room
-
-        return None
+        return self.chatrooms.get(roomName)
 
     @write_function
     def join(self, user, roomName, timeStamp = None, otherServer = None):
@@ -746,13 +2212,14 @@ class Server():
             self.my_clients.append((user, roomName)) # keeps track of clients on disk in case of server crash
             with open(F"Server_{self.index}_clients.pickle", 'wb') as f:
                 pickle.dump(self.my_clients, f)
+            self.presence.track(roomName, user)
 
         room = self.getRoom(roomName)
         if room:
             return room.add_chatter(user)
         
         newRoom = Chatroom(roomName)
-        self.chatrooms.append(newRoom)
+        self.chatrooms[roomName] = newRoom
         
         return newRoom.add_chatter(user)
 
@@ -763,7 +2230,7 @@ class Server():
         
         for key in SERVER_ADDRESSES.keys(): # if leaving user is in hidden_users list remove them from the list
             if (user, roomName) in self.hidden_clients[int(key)]:
-                self.hidden_clients[int(key)].remove((user, roomName))
+                self.hidden_clients[int(key)].discard((user, roomName))
                 with open(F"Server_{self.index}_hidden_clients.pickle", 'wb') as f:
                     pickle.dump(self.hidden_clients, f)
 
@@ -778,85 +2245,158 @@ class Server():
                     print(F"REMOVING3:", user, roomName)
                     pickle.dump(self.my_clients, f)
             print(F"REMOVING4:", user, roomName)
+            self.presence.forget(roomName, user)
             returnVal = room.remove_chatter(user)
             print(F"REMOVAL:", returnVal)
             return room.remove_chatter(user)
 
         return False
 
+    def expireClients(self, clients):
+        # called by the presence manager with the (roomName, user) of clients of this server that stopped polling
+        # every client leaves through a replicated write so that they are removed on every server, proposed in batches
+        print(F"Removing inactive clients: {clients}")
+        with LOCK:
+            for roomName, user in clients:
+                self.leave(user, roomName, datetime.datetime.now(), wait = False)
+
     def availableRooms(self):
-        return [room.name for room in self.chatrooms]
+        return list(self.chatrooms) # copied in one step, rooms may be added while it is read
     
     def reachableServers(self):
         # returns a boolean vector defining reachability of each server
         # reachable defined as got a response within 1 second
-        resultVector = [False for key in SERVER_ADDRESSES.keys()]
-        lock = Lock()
+        resultVector = QuorumCollector(default = False)
         for key in SERVER_ADDRESSES.keys():
-            t = Thread(target = self.checkConnection, args = [key, resultVector, lock])
-            t.start()
+            if not self.peers.submit(key, self.checkConnection, key, resultVector):
+                resultVector.record(key, False)
 
-        sleep(1)
-        return resultVector
+        resultVector.wait(lambda results: None, timeout = 1) # returns early once every server has responded
+        return list(resultVector.results)
 
-    def checkConnection(self, serverid, resultVector = None, lock = None):
+    def checkConnection(self, serverid, resultVector = None):
         # check if the server is able to reach server: serverid
-        # if a resultVector is given then result is also stored in vector
+        # if a resultVector (QuorumCollector) is given then result is also recorded in it
         if serverid == self.index:
             returnval = True
         
         else:
 
-            address, port = SERVER_ADDRESSES[serverid].split(":", 1)
-            conn = rpc.connect(address, port)
-
             try:
-                conn.root.availableRooms()
+                with self.connections.connect(serverid) as conn:
+                    conn.root.availableRooms()
                 returnval = True
 
             except:
                 returnval = False
 
-            conn.close()
-
         if resultVector:
-            if lock:
-                with lock:
-                    resultVector[serverid] = returnval
-
-            else:
-                resultVector[serverid] = returnval
+            resultVector.record(serverid, returnval)
 
         return returnval
 
+    @write_function
+    def noop(self, user, roomName):
+        # uses up the stamp of a write that was not decided, so that later writes from the same server can be applied
+        return None
+
 # newMessage, getMessages, getChatters, likeMessage, and unlikeMessage simply pass arguments on to the appropriate chatroom
     @write_function
     def newMessage(self, user, roomName, message, timeStamp, messageid):
         room = self.getRoom(roomName)
-        if room and (user in room.participants or self.isHiddenUser(user, roomName)):
+        if room and (user in room.view.participants or self.isHiddenUser(user, roomName)):
             room.newMessage(user, message, timeStamp, messageid)
             return True
         else:
             return False
 
-    def getMessages(self, user, roomName, number = 10):
+    def getMessages(self, user, roomName, number = 10, version = None):
+        # given the version tag of an earlier read, returns UNCHANGED if the room has not changed since, otherwise (tag, messages)
+        # "" is never a tag, so it can be given for the first read
         room = self.getRoom(roomName)
-        if room and user in room.participants:
-            return room.get_messages(user, number)
+        if room and user in room.view.participants:
+            self.presence.heartbeat(roomName, user)
+            if version == None:
+                return room.get_messages(user, number)
+            tag = room.versionTag() # read first, a newer view only makes the next read answer again
+            if tag == version:
+                return UNCHANGED
+            return (tag, room.get_messages(user, number))
         else:
             return None
 
-    def getChatters(self, roomName):
+    def waitForUpdate(self, user, roomName, version, number = 10, timeout = UPDATE_TIMEOUT):
+        # long-poll for clients, blocks until the room publishes a view other than version or timeout passes
+        # returns (version, messages, chatters) of the room, None if the user is not in it
+        room = self.getRoom(roomName)
+        if room and user in room.view.participants:
+            changed = Event()
+            room.watch(version, changed.set)
+            changed.wait(self.updateTimeout(timeout))
+            room.unwatch(changed.set)
+        return self.roomUpdate(user, roomName, number)
+
+    def getHistory(self, user, roomName, before = None, after = None, limit = HISTORY_PAGE):
+        # one page of the room's messages, see Chatroom.get_history, a page shorter than limit is the last one that way
+        # None if the user is not in the room or the message the page starts from is not in it
+        room = self.getRoom(roomName)
+        if room and user in room.view.participants:
+            self.presence.heartbeat(roomName, user)
+            return room.get_history(before, after, max(min(limit, HISTORY_PAGE_LIMIT), 1))
+        else:
+            return None
+
+    def getChanges(self, user, roomName, cursor, number = 10):
+        # changes to the room since cursor, see Chatroom.get_changes, None if the user is not in it
+        room = self.getRoom(roomName)
+        if room and user in room.view.participants:
+            self.presence.heartbeat(roomName, user)
+            return room.get_changes(cursor, number)
+        else:
+            return None
+
+    def waitForChanges(self, user, roomName, cursor, number = 10, timeout = UPDATE_TIMEOUT):
+        # getChanges as a long-poll, blocks until there are changes since cursor or timeout passes
+        room = self.getRoom(roomName)
+        if room and user in room.view.participants:
+            changed = Event()
+            room.watch(room.cursorVersion(cursor), changed.set)
+            changed.wait(self.updateTimeout(timeout))
+            room.unwatch(changed.set)
+        return self.getChanges(user, roomName, cursor, number)
+
+    def roomUpdate(self, user, roomName, number = 10):
+        room = self.getRoom(roomName)
+        version = room.view.version if room else None # read first, a newer view makes the client's next wait return at once
+        messages = self.getMessages(user, roomName, number) # also a heartbeat for the waiting client
+        if messages == None:
+            return None
+        return (version, messages, room.get_chatters())
+
+    def updateTimeout(self, timeout):
+        # a client waiting for updates only heartbeats when its wait returns, so it never waits long enough to time out
+        timeout = min(timeout, UPDATE_TIMEOUT)
+        if self.presence.timeout > 0:
+            timeout = min(timeout, self.presence.timeout / 2)
+        return timeout
+
+    def getChatters(self, roomName, version = None):
+        # takes a version tag as getMessages does
         room = self.getRoom(roomName)
         if room:
-            return room.participants
+            if version == None:
+                return room.get_chatters()
+            tag = room.versionTag()
+            if tag == version:
+                return UNCHANGED
+            return (tag, room.get_chatters())
         else:
             return None
 
     @write_function
     def likeMessage(self, user, roomName, messageid, timeStamp):
         room = self.getRoom(roomName)
-        if room and (user in room.participants or self.isHiddenUser(user, roomName)):
+        if room and (user in room.view.participants or self.isHiddenUser(user, roomName)):
             return room.likeMessage(user, messageid, timeStamp)
         else:
             return False
@@ -864,7 +2404,7 @@ class Server():
     @write_function
     def unlikeMessage(self, user, roomName, messageid, timeStamp):
         room = self.getRoom(roomName)
-        if room and (user in room.participants or self.isHiddenUser(user, roomName)):
+        if room and (user in room.view.participants or self.isHiddenUser(user, roomName)):
             return room.unlikeMessage(user, messageid, timeStamp)
         else:
             return False
@@ -881,19 +2421,19 @@ class Server():
             if self.display_status:
                 print(F"Active rooms:")
                 count = 1
-                for room in self.chatrooms:
+                for room in list(self.chatrooms.values()):
                     print(F"Room {count}: {room.name}, {len(room.participants)} active users")
                     count += 1
+                if self.index in self.leaders:
+                    print(F"Leader of shards {[shard for shard in range(self.shards) if self.leaders[shard] == self.index]}")
+                    print(F"Commit stream: logged up to {self.log.size}, acknowledged by followers {self.followers}")
+                submitted, threads, rejected, depths, maxDepths = self.peers.stats()
+                print(F"Calls to other servers: {submitted} on {threads} threads ({submitted - threads} threads saved), {rejected} rejected, queued {depths}, deepest {maxDepths}")
             sleep(1/rate)
 
     def isHiddenUser(self, user, roomName):
         # is the user in roomName in the hidden_users list
-        for srv in self.hidden_clients:
-            for tuser, troomName in srv:
-                if user == tuser and roomName == troomName:
-                    return True
-            
-        return False
+        return any((user, roomName) in clients for clients in self.hidden_clients)
 
 class Connection(rpc.Service):
     """
@@ -907,37 +2447,57 @@ class Connection(rpc.Service):
     def on_disconnect(self, conn):
         if self.clientName and self.clientRoom:
             try:
-                SERVER.leave(self.clientName, self.clientRoom, datetime.datetime.now())
+                with LOCK:
+                    SERVER.leave(self.clientName, self.clientRoom, datetime.datetime.now())
             except Exception as e:
                 print(F'attempted to remove {self.clientName} from {self.clientRoom} but failed eith exception: {e}')
 
-    def exposed_getLeader(self):
-        return SERVER.current_leader
+    def exposed_getPeerStats(self):
+        global SERVER
+        return SERVER.peers.stats()
+
+    def exposed_getLeader(self, shard = 0):
+        return SERVER.leaders[shard]
 
     def exposed_getMessages(self, *args, **kwargs):
 
-        global SERVER, LOCK
-        with LOCK:
-            val = SERVER.getMessages(*args, **kwargs)
+        global SERVER
+        val = SERVER.getMessages(*args, **kwargs) # reads the published view of the room without taking a lock
 
         return val
 
 
     def exposed_getChatters(self, *args, **kwargs):
 
-        global SERVER, LOCK
-        with LOCK:
-            val = SERVER.getChatters(*args, **kwargs)
+        global SERVER
+        val = SERVER.getChatters(*args, **kwargs) # reads the published view of the room without taking a lock
 
         return val
 
+    def exposed_waitForUpdate(self, *args, **kwargs):
+        # blocks this connection until the room changes, clients wait on a connection of their own
+        global SERVER
+        return SERVER.waitForUpdate(*args, **kwargs)
+
+    def exposed_getHistory(self, *args, **kwargs):
+        global SERVER
+        return SERVER.getHistory(*args, **kwargs) # takes the room's read lock for one page
+
+    def exposed_getChanges(self, *args, **kwargs):
+        global SERVER
+        return SERVER.getChanges(*args, **kwargs) # reads the room's published changes without taking a lock
+
+    def exposed_waitForChanges(self, *args, **kwargs):
+        global SERVER
+        return SERVER.waitForChanges(*args, **kwargs)
+
 
 
     def exposed_newMessage(self, *args, **kwargs):
 
         global SERVER, LOCK
         with LOCK:
-            val = SERVER.newMessage(*args, messageid=F"{SERVER.index}_{SERVER.vector_stamp[SERVER.index]}", **kwargs)
+            val = SERVER.newMessage(*args, messageid=None, **kwargs) # id is assigned when the message is proposed
 
         return val
 
@@ -945,9 +2505,8 @@ class Connection(rpc.Service):
 
     def exposed_availableRooms(self, *args, **kwargs):
 
-        global SERVER, LOCK
-        with LOCK:
-            val = SERVER.availableRooms(*args, **kwargs)
+        global SERVER
+        val = SERVER.availableRooms(*args, **kwargs) # does not take a lock, rooms are only ever added
 
         return val
 
@@ -1016,25 +2575,44 @@ class Connection(rpc.Service):
         return val
 
 
-    def exposed_getServerData(self, *args, **kwargs):
+    def exposed_getServerData(self, digest):
 
         global SERVER
+        if SERVER.inSync(digest): # in sync servers are answered without taking LOCK or reading the log
+            return None
         with LOCK:
-            val = SERVER.serverDataGive(*args, **kwargs)
+            val = SERVER.serverDataGive(digest[0])
 
         return val
 
-    def exposed_processCmdString(self, *args, **kwargs):
+    def exposed_processCmd(self, *args, **kwargs):
         withLock = kwargs.pop("withLock", True)
         global SERVER
         if withLock:
             with LOCK:
-                val = SERVER.processCmdString(*args, **kwargs)
+                val = SERVER.processCmd(*args, **kwargs)
+                SERVER.log.commit()
         else:
-            val = SERVER.processCmdString(*args, **kwargs)
+            val = SERVER.processCmd(*args, **kwargs)
+            SERVER.log.commit()
 
         return val
     
+    def exposed_processCmdBatch(self, *args, **kwargs):
+        withLock = kwargs.pop("withLock", True)
+        global SERVER
+        if withLock:
+            with LOCK:
+                val = SERVER.processCmdBatch(*args, **kwargs)
+        else:
+            val = SERVER.processCmdBatch(*args, **kwargs)
+
+        return val
+
+    def exposed_streamCommands(self, *args, **kwargs):
+        global SERVER
+        return SERVER.streamCommands(*args, **kwargs) # does not need LOCK, only reads the log
+
     def exposed_reachableServers(self, *args, **kwargs):
         global SERVER
         return SERVER.reachableServers(*args, **kwargs)
@@ -1063,10 +2641,174 @@ class Connection(rpc.Service):
         return val
 
 
+class AsyncFrontEnd():
+    """
+    serves clients on one asyncio event loop instead of a thread per connection, using a length prefixed json protocol
+    a request is [id, operation, args] and is answered with [id, result] or [id, None, error], requests on one connection
+    may be pipelined and are answered as they finish. every connection is handled by its own Connection so operations
+    behave as they do over rpyc. reads are answered on the event loop from the rooms' published views, writes and
+    reads that take a room's lock run on a bounded pool of threads, and waitForUpdate and waitForChanges wait on the event
+    loop without holding a thread
+    """
+
+    FRAME = struct.Struct("!I") # length of the json that follows
+    READS = {"getMessages", "getChatters", "getHistory", "getChanges", "availableRooms", "getLeader"}
+    WRITES = {"join", "leave", "newMessage", "like", "unlike"}
+    WAITS = {"waitForUpdate", "waitForChanges"}
+    TIMESTAMPS = {"join" : 2, "leave" : 2, "newMessage" : 3, "like" : 3, "unlike" : 3} # position of the timestamp argument, sent as an ISO 8601 string
+
+    def __init__(self, port = ASYNC_PORT, workers = ASYNC_WORKERS):
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.connections = 0 # clients currently connected
+
+    def start(self):
+        Thread(target=asyncio.run, args=[self.serve()], daemon=True).start()
+
+    async def serve(self):
+        listener = await asyncio.start_server(self.handle, port = self.port, backlog = 1024)
+        print(F"asyncio front end listening on port {self.port}")
+        async with listener:
+            await listener.serve_forever()
+
+    @classmethod
+    def encode(cls, value):
+        data = json.dumps(value, default = str).encode("utf-8")
+        return cls.FRAME.pack(len(data)) + data
+
+    @classmethod
+    async def read(cls, reader):
+        # the next frame decoded, None once the other side has closed the connection
+        try:
+            header = await reader.readexactly(cls.FRAME.size)
+            return json.loads(await reader.readexactly(cls.FRAME.unpack(header)[0]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def call(self, service, operation, args):
+        try:
+            position = self.TIMESTAMPS.get(operation)
+            if position != None and len(args) > position and type(args[position]) == str:
+                # replicated as a datetime, as over rpyc, rather than as a string
+                args = args[:position] + [datetime.datetime.fromisoformat(args[position])] + args[position + 1:]
+            return [getattr(service, "exposed_" + operation)(*args)]
+        except Exception as e:
+            return [None, F"{operation} failed: {e}"]
+
+    def blocks(self, operation, args):
+        # whether a read may take a room's lock, these run on the executor so that the event loop never waits for a writer
+        if operation == "getHistory":
+            return True
+        try:
+            room = SERVER.getRoom(args[1]) if len(args) > 1 else None
+            if room == None:
+                return False
+            if operation == "getMessages":
+                return not room.inView(args[2] if len(args) > 2 else 10)
+            if operation == "waitForUpdate":
+                return not room.inView(args[3] if len(args) > 3 else 10)
+            if operation in ("getChanges", "waitForChanges"):
+                return not room.changesKept(args[2] if len(args) > 2 else None)
+            return False
+        except Exception:
+            return True # malformed arguments, the call reports the error
+
+    async def answer(self, writer, requestId, service, operation, args):
+        # answers on the event loop unless the call may block, writes always do
+        if operation in self.WRITES or self.blocks(operation, args):
+            response = await asyncio.get_running_loop().run_in_executor(self.executor, self.call, service, operation, args)
+        else:
+            response = self.call(service, operation, args)
+        self.respond(writer, requestId, response)
+
+    def respond(self, writer, requestId, response):
+        if not writer.is_closing(): # the client may have gone while a write was waiting for consensus
+            writer.write(self.encode([requestId] + response))
+
+    async def wait(self, writer, requestId, service, operation, args):
+        # waitForUpdate and waitForChanges, the room wakes the event loop when it publishes a newer view
+        user, roomName, version = args[:3]
+        number = args[3] if len(args) > 3 else 10
+        timeout = args[4] if len(args) > 4 else UPDATE_TIMEOUT
+        room = SERVER.getRoom(roomName)
+        if room and user in room.view.participants:
+            if operation == "waitForChanges":
+                version = room.cursorVersion(version)
+            loop = asyncio.get_running_loop()
+            changed = loop.create_future()
+            def notify():
+                loop.call_soon_threadsafe(lambda: changed.done() or changed.set_result(True))
+            room.watch(version, notify)
+            try:
+                await asyncio.wait_for(changed, SERVER.updateTimeout(timeout))
+            except asyncio.TimeoutError:
+                pass
+            room.unwatch(notify)
+        await self.answer(writer, requestId, service, operation, args[:3] + [number, 0]) # returns at once with no timeout
+
+    async def handle(self, reader, writer):
+        service = Connection() # keeps the client's name and room to leave it when the client disconnects
+        service.on_connect(None)
+        tasks = set() # writes, waits and reads that may block that have not been answered yet
+        self.connections += 1
+        try:
+            while True:
+                request = await self.read(reader)
+                if request == None:
+                    break
+                requestId, operation, args = request
+                if operation in self.READS and not self.blocks(operation, args):
+                    self.respond(writer, requestId, self.call(service, operation, args))
+                elif operation in self.READS or operation in self.WRITES or operation in self.WAITS:
+                    if operation not in self.WAITS:
+                        task = asyncio.ensure_future(self.answer(writer, requestId, service, operation, args))
+                    else:
+                        task = asyncio.ensure_future(self.wait(writer, requestId, service, operation, args))
+                    tasks.add(task) # referenced until done so it is not garbage collected
+                    task.add_done_callback(tasks.discard)
+                else:
+                    self.respond(writer, requestId, [None, F"unknown operation {operation}"])
+                await writer.drain()
+        except Exception as e:
+            print(F"asyncio client error: {e}")
+        finally:
+            self.connections -= 1
+            writer.close()
+            await asyncio.get_running_loop().run_in_executor(self.executor, service.on_disconnect, None)
+
+def loadServerAddresses(config = None, servers = None):
+    # replaces the default servers with a comma separated list of address:port or a json file holding a list of them
+    # server ids are the positions in the list starting at 1, every server and client must be given the same list
+    if servers:
+        addresses = servers.split(",")
+    elif config:
+        with open(config) as f:
+            addresses = json.load(f)
+    else:
+        return
+    SERVER_ADDRESSES.clear() # updated in place, other modules hold a reference to it
+    SERVER_ADDRESSES.update({key : address for key, address in enumerate(addresses)})
+
 def get_args(argv):
     parser = argparse.ArgumentParser(description="chat server")
     parser.add_argument('-id', '--id', required=False, default=1, type=int)
+    parser.add_argument('-c', '--config', required=False, default=None, type=str, help='json file with the list of servers (address:port), ids start at 1')
+    parser.add_argument('-s', '--servers', required=False, default=None, type=str, help='comma separated list of servers (address:port), overrides --config')
+    parser.add_argument('-pool', '--pool-size', required=False, default=POOL_SIZE, type=int, help='connections kept open to each other server, 0 connects per call')
+    parser.add_argument('-bw', '--batch-window', required=False, default=BATCH_WINDOW, type=float, help='seconds to wait for more writes before proposing a batch')
+    parser.add_argument('-bs', '--batch-size', required=False, default=BATCH_SIZE, type=int, help='maximum writes proposed in one round, 1 disables batching')
+    parser.add_argument('-pw', '--pipeline-window', required=False, default=PIPELINE_WINDOW, type=int, help='maximum proposals the leader has in flight at once, 1 proposes one round at a time')
+    parser.add_argument('-peers', '--peer-workers', required=False, default=PEER_WORKERS, type=int, help='threads making calls to each other server')
+    parser.add_argument('-sh', '--shards', required=False, default=SHARDS, type=int, help='shards the rooms are partitioned into, each with its own leader, 0 uses one per server, must be the same on every server')
+    parser.add_argument('-ap', '--async-port', required=False, default=ASYNC_PORT, type=int, help='port of the asyncio front end for clients, 0 disables it')
+    parser.add_argument('-pt', '--presence-timeout', required=False, default=PRESENCE_TIMEOUT, type=float, help='seconds a client may go without polling or writing before it leaves its room, 0 never removes clients')
+    parser.add_argument('-si', '--snapshot-interval', required=False, default=SNAPSHOT_INTERVAL, type=int, help='commands applied between snapshots, 0 disables snapshots')
+    parser.add_argument('-d', '--durability', required=False, default=DURABILITY, choices=["none", "batch", "interval"], help='fsync the log never, after every batch of commands, or every --fsync-interval ms')
+    parser.add_argument('-fi', '--fsync-interval', required=False, default=FSYNC_INTERVAL, type=int, help='milliseconds between fsyncs of the log with --durability interval')
     p = parser.parse_args()
+    loadServerAddresses(p.config, p.servers)
+    if p.id not in range(1, len(SERVER_ADDRESSES) + 1):
+        parser.error(F"id must be between 1 and {len(SERVER_ADDRESSES)}")
     p.id -= 1
     p.address = SERVER_ADDRESSES[p.id].split(":", 1)[0]
     p.port = SERVER_ADDRESSES[p.id].split(":", 1)[1]
@@ -1074,10 +2816,12 @@ def get_args(argv):
 
 if __name__ == '__main__':
     global SERVER, LOCK
-    LOCK = Lock()
+    LOCK = Lock() # guards the replication state (vector_stamp, log, pending commands), chatrooms also have their own RWLock
     print("Chat Server")
     args = get_args(sys.argv[1:])
-    SERVER = Server(args.id)
+    SERVER = Server(args.id, poolSize=args.pool_size, batchWindow=args.batch_window, batchSize=args.batch_size, pipelineWindow=args.pipeline_window, snapshotInterval=args.snapshot_interval, durability=args.durability, fsyncInterval=args.fsync_interval, shards=args.shards, peerWorkers=args.peer_workers, presenceTimeout=args.presence_timeout)
     START_TIME = datetime.datetime.now()
+    if args.async_port:
+        AsyncFrontEnd(args.async_port).start()
     connectionHandler = ThreadedServer(Connection, port = args.port, listener_timeout=2)
     connectionHandler.start()
\ No newline at end of file